@@ -0,0 +1,258 @@
+# -*- coding: cp1252 -*-
+
+## Beacon Base Client
+
+## An asyncio driver for the serial menu of an Iridium_9603N_Beacon_V5_Base
+## (see Arduino/Iridium9603NBeacon_V5_Base) so that GUIs, headless services and tests
+## can all talk to a base without Tkinter.
+## Python 3 only. Needs pyserial-asyncio (pip install pyserial-asyncio) to open a serial port;
+## any asyncio StreamReader and StreamWriter pair can be used instead (e.g. for testing).
+
+## Each menu choice has its own coroutine which sends the choice, waits (up to its own timeout) for the
+## CR LF terminated response and returns it parsed into a typed result:
+##   1: battery()              - Battery(volts)
+##   2: gnss()                 - GNSSFix
+##   3: pressure_temperature() - PressureTemperature(pascals, celsius)
+##   4: check_iridium()        - IridiumSession (BeaconRecord, or None if there was no message; and the MT queue length)
+##                               or FlushAck if the message was the RockBLOCK echo of a FLUSH_MT
+##   5: flush_mt()             - FlushAck(mtq)
+##   6: power_down()           - None (the base doesn't reply; it needs to be reset afterwards)
+##   7: send_message(text)     - MessageSent(mtq)
+## An ERROR response raises BeaconBaseError (with the numeric IridiumSBD error code when there is one).
+## No response within the timeout raises BeaconBaseTimeout.
+## The reader is read by a background task which frames the CR LF terminated lines (like Serial_Line_Reader.py)
+## so anything already received (the startup banner and menu, a late reply, ...) can be discarded before each command is sent.
+## Commands are sent one at a time: a coroutine waits for the one before it to finish.
+
+import asyncio
+import re
+from collections import namedtuple
+try:
+   import serial_asyncio # pyserial-asyncio: non-blocking serial transport
+except ImportError:
+   serial_asyncio = None
+
+# Menu choices
+BATTERY = '1'
+GNSS = '2'
+PRESSURE = '3'
+IRIDIUM = '4'
+FLUSH_MT = '5'
+POWER_DOWN = '6'
+SEND_MESSAGE = '7'
+
+# Default timeouts (seconds) for each menu choice
+default_timeouts = {
+   BATTERY: 5.,
+   GNSS: 35., # Needs to be > the GNSS timeout in Iridium9603NBeacon_V5_Base (30s)
+   PRESSURE: 5.,
+   IRIDIUM: 90., # Needs to be > IridiumSBD.adjustSendReceiveTimeout
+   FLUSH_MT: 90.,
+   SEND_MESSAGE: 90.,
+   }
+
+max_message_length = 50 # The base sends up to 50 characters
+
+Battery = namedtuple('Battery', 'volts')
+PressureTemperature = namedtuple('PressureTemperature', 'pascals celsius')
+GNSSFix = namedtuple('GNSSFix', 'datetime lat lon altitude speed heading hdop satellites')
+BeaconRecord = namedtuple('BeaconRecord', 'datetime lat lon altitude speed heading hdop satellites pressure temperature battery count serial_no base_serial_no')
+IridiumSession = namedtuple('IridiumSession', 'record mtq')
+FlushAck = namedtuple('FlushAck', 'mtq')
+MessageSent = namedtuple('MessageSent', 'mtq')
+
+class BeaconBaseError(Exception):
+   ''' The base replied with an ERROR (or a reply which couldn't be parsed) '''
+
+   def __init__(self, message, code=None):
+      Exception.__init__(self, message)
+      self.code = code # IridiumSBD error code (int); None if there isn't one
+
+class BeaconBaseTimeout(BeaconBaseError):
+   ''' The base did not reply in time '''
+
+def check_error(resp):
+   ''' Raise BeaconBaseError if resp is an ERROR '''
+   if resp.startswith('ERROR'):
+      match = re.search(r'error (-?\d+)$', resp)
+      raise BeaconBaseError(resp, int(match.group(1)) if match else None)
+
+def parse_mtq(resp):
+   ''' Return the MT queue length from a reply which is (only) the MTQ '''
+   check_error(resp)
+   try:
+      return int(resp)
+   except ValueError:
+      raise BeaconBaseError('Invalid MTQ: ' + resp)
+
+def parse_gnss(resp):
+   ''' Parse YYYYMMDDHHMMSS,lat,lon,alt,speed,heading,hdop,satellites into a GNSSFix '''
+   check_error(resp)
+   fields = resp.split(',')
+   if (len(fields) < 8) or (len(fields[0]) != 14):
+      raise BeaconBaseError('Invalid GNSS fix: ' + resp)
+   try:
+      return GNSSFix(fields[0], float(fields[1]), float(fields[2]), int(fields[3]), float(fields[4]),
+                     int(fields[5]), float(fields[6]), int(fields[7]))
+   except ValueError:
+      raise BeaconBaseError('Invalid GNSS fix: ' + resp)
+
+def parse_session(resp):
+   ''' Parse the reply to an Iridium session: [beacon data,]mtq into an IridiumSession (or a FlushAck) '''
+   check_error(resp)
+   message, _, mtq = resp.rpartition(',')
+   mtq = parse_mtq(mtq)
+   if message == '':
+      return IridiumSession(None, mtq)
+   if message.startswith('FLUSH'): # Echo of FLUSH_MT
+      return FlushAck(mtq)
+   fields = message.split(',')
+   base_serial_no = ''
+   if (len(fields[0]) == 9) and fields[0].startswith('RB'): # Serial number of the base (added by RockBLOCK forwarding)
+      base_serial_no = fields[0]
+      fields = fields[1:]
+   # YYYYMMDDHHMMSS,lat,lon,alt,speed,heading,hdop,satellites,pressure,temperature,vbat,count,rockblock_serial_no
+   if (len(fields) < 13) or (len(fields[0]) != 14):
+      raise BeaconBaseError('Invalid beacon data: ' + resp)
+   try:
+      record = BeaconRecord(fields[0], float(fields[1]), float(fields[2]), int(fields[3]), float(fields[4]),
+                            int(fields[5]), float(fields[6]), int(fields[7]), int(fields[8]), float(fields[9]),
+                            float(fields[10]), int(fields[11]), fields[12], base_serial_no)
+   except ValueError:
+      raise BeaconBaseError('Invalid beacon data: ' + resp)
+   return IridiumSession(record, mtq)
+
+class BeaconBaseClient(object):
+   ''' Talk to an Iridium_9603N_Beacon_V5_Base using asyncio streams '''
+
+   def __init__(self, reader, writer, timeouts=None):
+      self.reader = reader # asyncio StreamReader
+      self.writer = writer # asyncio StreamWriter
+      self.timeouts = dict(default_timeouts) # Menu choice : timeout (seconds)
+      if timeouts is not None:
+         self.timeouts.update(timeouts)
+      self.lock = asyncio.Lock() # One command at a time
+      self.buffer = b'' # Bytes received since the last complete line
+      self.lines = asyncio.Queue() # Complete lines (b'' when the port is closed)
+      self.read_task = None # Started by the first command
+
+   @classmethod
+   async def open(cls, port, baudrate=115200, timeouts=None):
+      ''' Open the serial port and return a BeaconBaseClient '''
+      if serial_asyncio is None:
+         raise ImportError('pyserial-asyncio is needed to open a serial port: pip install pyserial-asyncio')
+      reader, writer = await serial_asyncio.open_serial_connection(url=port, baudrate=baudrate)
+      return cls(reader, writer, timeouts)
+
+   async def close(self):
+      ''' Close the serial port '''
+      if self.read_task is not None:
+         self.read_task.cancel()
+      self.writer.close()
+      if hasattr(self.writer, 'wait_closed'):
+         await self.writer.wait_closed()
+
+   async def __aenter__(self):
+      return self
+
+   async def __aexit__(self, *exc):
+      await self.close()
+
+   async def read_lines(self):
+      ''' Background task: read the reader and put each complete line (including its CR LF) on the queue '''
+      while True:
+         data = await self.reader.read(1024)
+         if len(data) == 0: # The serial port was closed
+            self.lines.put_nowait(b'')
+            return
+         self.buffer += data
+         while b'\n' in self.buffer:
+            line, _, self.buffer = self.buffer.partition(b'\n')
+            self.lines.put_nowait(line + b'\n')
+
+   async def discard(self):
+      ''' Discard everything which has been received but not read, without waiting for anything more '''
+      if self.read_task is None:
+         self.read_task = asyncio.ensure_future(self.read_lines())
+      await asyncio.sleep(0) # Let the transport and read_lines pass on anything they have already read
+      serial = getattr(self.writer.transport, 'serial', None) # pyserial-asyncio: the Serial object
+      if serial is not None:
+         serial.reset_input_buffer() # Flush serial RX buffer
+      self.buffer = b''
+      while not self.lines.empty():
+         if self.lines.get_nowait() == b'': # Keep the end of file
+            self.lines.put_nowait(b'')
+            break
+
+   async def command(self, choice, data=None):
+      ''' Send menu choice (and then data, if there is any); return the reply without its CR LF '''
+      async with self.lock:
+         await self.discard() # Delete any old responses
+         self.writer.write((choice + '\r').encode('ascii'))
+         if data is not None:
+            self.writer.write((data + '\r').encode('ascii'))
+         await self.writer.drain()
+         try:
+            line = await asyncio.wait_for(self.lines.get(), self.timeouts[choice])
+         except asyncio.TimeoutError:
+            raise BeaconBaseTimeout('No reply to menu choice ' + choice + ' within ' + str(self.timeouts[choice]) + 's')
+         if len(line) == 0:
+            raise BeaconBaseError('The serial port was closed')
+         return line.decode('ascii', 'replace').rstrip('\r\n')
+
+   async def battery(self):
+      ''' Menu choice 1: return the battery voltage '''
+      resp = await self.command(BATTERY)
+      check_error(resp)
+      try:
+         return Battery(float(resp))
+      except ValueError:
+         raise BeaconBaseError('Invalid battery voltage: ' + resp)
+
+   async def gnss(self):
+      ''' Menu choice 2: return the base's GNSSFix '''
+      return parse_gnss(await self.command(GNSS))
+
+   async def pressure_temperature(self):
+      ''' Menu choice 3: return the pressure (Pascals) and temperature (C) '''
+      resp = await self.command(PRESSURE)
+      check_error(resp)
+      try:
+         pascals, celsius = resp.split(',')
+         return PressureTemperature(int(float(pascals)), float(celsius))
+      except ValueError:
+         raise BeaconBaseError('Invalid pressure and temperature: ' + resp)
+
+   async def check_iridium(self):
+      ''' Menu choice 4: start an Iridium session; return the IridiumSession (or a FlushAck) '''
+      return parse_session(await self.command(IRIDIUM))
+
+   async def flush_mt(self):
+      ''' Menu choice 5: send FLUSH_MT to RockBLOCK (RockBLOCK only); return the FlushAck '''
+      return FlushAck(parse_mtq(await self.command(FLUSH_MT)))
+
+   async def power_down(self):
+      ''' Menu choice 6: power down the 9603N. There is no reply '''
+      async with self.lock:
+         self.writer.write((POWER_DOWN + '\r').encode('ascii'))
+         await self.writer.drain()
+
+   async def send_message(self, text):
+      ''' Menu choice 7: send text (up to max_message_length characters, e.g. RBxxxxxxx[INTERVAL=yyy]); return MessageSent '''
+      text = text.strip()
+      if (len(text) == 0) or (len(text) > max_message_length) or ('\r' in text):
+         raise ValueError('The message must be 1 to ' + str(max_message_length) + ' characters')
+      return MessageSent(parse_mtq(await self.command(SEND_MESSAGE, text)))
+
+if __name__ == '__main__':
+   # Read the base location and check for a message
+   async def main(port):
+      async with await BeaconBaseClient.open(port) as base:
+         try:
+            print(await base.gnss())
+         except BeaconBaseError as e:
+            print(e)
+         print(await base.check_iridium())
+
+   port = input('Which serial port do you want to use? ')
+   asyncio.get_event_loop().run_until_complete(main(port))
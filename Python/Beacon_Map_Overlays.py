@@ -0,0 +1,289 @@
+# -*- coding: cp1252 -*-
+
+## Beacon Map Overlays
+
+## Helpers for the beacon paths and markers shown on the maps by
+## Iridium_Beacon_Base.py and Iridium_Beacon_Mapper_RockBLOCK.py
+## Works with both Python 2 (Base) and Python 3 (Mapper).
+
+## Paths are added to the Google Static Maps URL using the encoded polyline format:
+## https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+## https://developers.google.com/maps/documentation/maps-static/dev-guide#EncodedPolylines
+## Each waypoint costs a few characters instead of the ~22 needed for "|lat,lon"
+## so many more waypoints fit into the 8192 character URL.
+
+## Each beacon's waypoints are kept in a BeaconTrack: a fixed-size numeric ring buffer.
+## The path URL is built from the tracks on demand, sharing the URL length between the
+## beacons according to how much each one needs and how recently it was updated.
+
+## At a given zoom level, many waypoints are less than a pixel from the line through their
+## neighbours and make no visible difference. Given the zoom, the tracks are first simplified
+## in (Web Mercator) pixel space using the Douglas-Peucker algorithm, so the URL is spent on
+## the visible shape of the path and long tracks fit entirely. The simplified track is
+## remembered until the zoom changes or a waypoint is added.
+
+## When many beacons are close together (e.g. a swarm release) their markers overlap and each
+## one still costs URL characters. cluster_markers divides the world into a grid of cells a
+## few pixels square at the current zoom and merges the markers in each cell into a single
+## cluster marker showing how many markers it holds. The cells shrink (in degrees) as you zoom
+## in so the clusters split back into individual markers. All markers are grouped in one go
+## using NumPy, so the URL cost is proportional to the number of clusters, not beacons.
+
+import math
+import time
+import numpy as np
+from Web_Mercator import latlon_to_world, world_to_latlon, world_size
+try:
+   from urllib import quote # Python 2
+except ImportError:
+   from urllib.parse import quote # Python 3
+
+def encode_value(value):
+   ''' Encode a single signed integer (degrees * 1e5) using the polyline algorithm '''
+   value = value << 1 # Left shift
+   if value < 0: # Invert if negative
+      value = ~value
+   chunks = []
+   while value >= 0x20: # Break into 5-bit chunks, least significant first
+      chunks.append(chr((0x20 | (value & 0x1f)) + 63)) # Set the continuation bit
+      value >>= 5
+   chunks.append(chr(value + 63)) # Final chunk
+   return ''.join(chunks)
+
+def encode_points(lats, lons):
+   ''' Encode integer (degrees * 1e5) lats and lons as a polyline string '''
+   chunks = []
+   last_lat = 0
+   last_lon = 0
+   for lat, lon in zip(lats, lons):
+      lat = int(lat)
+      lon = int(lon)
+      chunks.append(encode_value(lat - last_lat)) # Each point is encoded as an offset from the previous one
+      chunks.append(encode_value(lon - last_lon))
+      last_lat = lat
+      last_lon = lon
+   return ''.join(chunks)
+
+def encode_polyline(waypoints):
+   ''' Encode a list of (lat,lon) waypoints (degrees) as a polyline string '''
+   lats = [int(round(lat * 1e5)) for lat, lon in waypoints] # Convert to integer 1e-5 degrees
+   lons = [int(round(lon * 1e5)) for lat, lon in waypoints]
+   return encode_points(lats, lons)
+
+def escape_polyline(encoded):
+   ''' URL-escape an encoded polyline ('?', '@', '|', '`' etc. must all be escaped) '''
+   return quote(encoded, safe='')
+
+# Escaped length of each character which can appear in an encoded polyline (chr(63) to chr(126))
+escaped_char_lengths = np.array([len(escape_polyline(chr(c))) for c in range(128)])
+
+def escaped_lengths(values):
+   ''' Vectorized escaped, encoded length of each of an array of integer (degrees * 1e5) values '''
+   values = np.asarray(values, dtype=np.int64) << 1 # Left shift
+   values = np.where(values < 0, ~values, values) # Invert if negative
+   lengths = np.zeros(values.shape, dtype=np.int64)
+   more = np.ones(values.shape, dtype=bool) # Which values still have chunks to encode
+   while np.any(more):
+      chunks = values & 0x1f # Next 5-bit chunk
+      values = values >> 5
+      chars = np.where(values > 0, (chunks | 0x20) + 63, chunks + 63) # Set the continuation bit if more chunks follow
+      lengths += np.where(more, escaped_char_lengths[chars], 0)
+      more = more & (values > 0)
+   return lengths
+
+def simplify(x, y, tolerance):
+   ''' Douglas-Peucker line simplification. Return a boolean array marking the points to keep
+   so that no dropped point is more than tolerance from the simplified line '''
+   x = np.asarray(x, dtype=float)
+   y = np.asarray(y, dtype=float)
+   keep = np.zeros(len(x), dtype=bool)
+   if len(x) == 0:
+      return keep
+   keep[0] = True # Always keep the end points
+   keep[-1] = True
+   sections = [(0, len(x) - 1)] # Sections of the line still to be simplified
+   while len(sections) > 0:
+      first, last = sections.pop()
+      if last - first < 2: # No points in between
+         continue
+      dx = x[last] - x[first]
+      dy = y[last] - y[first]
+      px = x[first + 1:last] - x[first]
+      py = y[first + 1:last] - y[first]
+      length = np.hypot(dx, dy)
+      if length > 0.:
+         distances = np.abs((px * dy) - (py * dx)) / length # Distance of each point from the line first to last
+      else:
+         distances = np.hypot(px, py) # first and last are in the same place
+      furthest = int(np.argmax(distances))
+      if distances[furthest] > tolerance: # Keep the furthest point and simplify either side of it
+         middle = first + 1 + furthest
+         keep[middle] = True
+         sections.append((first, middle))
+         sections.append((middle, last))
+   return keep
+
+class BeaconTrack(object):
+   ''' Ring buffer holding the most recent waypoints for one beacon.
+   Waypoints are stored as integer 1e-5 degrees - the resolution of the encoded polyline '''
+
+   def __init__(self, capacity=4096):
+      self.capacity = capacity # Maximum number of waypoints
+      self.lats = np.zeros(capacity, dtype=np.int32) # Latitudes (degrees * 1e5)
+      self.lons = np.zeros(capacity, dtype=np.int32) # Longitudes (degrees * 1e5)
+      self.start = 0 # Index of the oldest waypoint
+      self.count = 0 # Number of waypoints in the buffer
+      self.updated = 0.0 # time.time() when the last waypoint was added
+      self.version = 0 # Incremented each time a waypoint is added
+      self.simplified = None # (zoom, tolerance, version, indices) of the most recently simplified track
+
+   def __len__(self):
+      return self.count
+
+   def append(self, lat, lon):
+      ''' Add a waypoint (degrees); overwrite the oldest one if the buffer is full '''
+      index = (self.start + self.count) % self.capacity
+      self.lats[index] = int(round(lat * 1e5))
+      self.lons[index] = int(round(lon * 1e5))
+      if self.count < self.capacity:
+         self.count += 1
+      else:
+         self.start = (self.start + 1) % self.capacity
+      self.updated = time.time()
+      self.version += 1
+
+   def points(self, zoom=None, tolerance=1.):
+      ''' Return the integer (degrees * 1e5) lats and lons, oldest first.
+      If zoom is given, only the waypoints needed to draw the path within tolerance pixels at that zoom '''
+      indices = (self.start + np.arange(self.count)) % self.capacity
+      if zoom is not None:
+         indices = indices[self.simplify(zoom, tolerance)]
+      return self.lats[indices], self.lons[indices]
+
+   def simplify(self, zoom, tolerance=1.):
+      ''' Return the positions (oldest first) of the waypoints needed to draw the path within tolerance pixels at this zoom '''
+      if (self.simplified is None) or (self.simplified[:3] != (zoom, tolerance, self.version)):
+         lats, lons = self.points()
+         x, y = latlon_to_world(lats / 1e5, lons / 1e5, zoom)
+         size = world_size(zoom)
+         if len(x) > 1: # Allow for wrap-around at +/-180
+            x = x[0] + np.concatenate(([0.], np.cumsum(((np.diff(x) + (size / 2.)) % size) - (size / 2.))))
+         self.simplified = (zoom, tolerance, self.version, np.nonzero(simplify(x, y, tolerance))[0])
+      return self.simplified[3]
+
+   def waypoints(self, zoom=None, tolerance=1.):
+      ''' Return the lats and lons (degrees), oldest first (simplified for this zoom if zoom is given) '''
+      lats, lons = self.points(zoom, tolerance)
+      return lats / 1e5, lons / 1e5
+
+   def path_lengths(self, zoom=None):
+      ''' Return the escaped, encoded length of the path starting at each waypoint (simplified for this zoom if zoom is given) '''
+      lats, lons = self.points(zoom)
+      # The first point is encoded absolutely; all following points are encoded as offsets from the previous one
+      firsts = escaped_lengths(lats) + escaped_lengths(lons)
+      offsets = escaped_lengths(np.diff(lats)) + escaped_lengths(np.diff(lons))
+      lengths = firsts.copy()
+      lengths[:-1] += np.cumsum(offsets[::-1])[::-1] # Add the lengths of all the following offsets
+      return lengths
+
+   def encoded_length(self, zoom=None):
+      ''' Return the escaped, encoded length of the whole path (simplified for this zoom if zoom is given) '''
+      if self.count == 0:
+         return 0
+      return int(self.path_lengths(zoom)[0])
+
+   def encode(self, max_length, zoom=None):
+      ''' Return the escaped, encoded path of the most recent waypoints which fit into max_length characters
+      (simplified for this zoom if zoom is given) '''
+      if self.count == 0:
+         return ''
+      fits = np.nonzero(self.path_lengths(zoom) <= max_length)[0]
+      if len(fits) == 0:
+         return ''
+      lats, lons = self.points(zoom)
+      return escape_polyline(encode_points(lats[fits[0]:], lons[fits[0]:]))
+
+def allocate_path_budgets(demands, total, weights=None):
+   ''' Share total characters between the paths. Each path gets (at most) the characters it needs;
+   paths which need more than their (weighted) share split whatever is left over '''
+   demands = np.asarray(demands, dtype=float)
+   if weights is None:
+      weights = np.ones(len(demands))
+   weights = np.asarray(weights, dtype=float)
+   budgets = np.zeros(len(demands))
+   active = demands > 0 # Paths still waiting for characters
+   remaining = float(max(total, 0))
+   while (remaining >= 1.) and np.any(active):
+      shares = np.zeros(len(demands))
+      shares[active] = remaining * weights[active] / weights[active].sum() # Weighted share of what is left
+      needs = demands - budgets
+      satisfied = active & (needs <= shares)
+      if np.any(satisfied):
+         # Give these paths everything they need and share the rest again
+         budgets[satisfied] = demands[satisfied]
+         remaining -= needs[satisfied].sum()
+         active = active & ~satisfied
+      else:
+         # Nobody can be fully satisfied so everybody gets their share
+         budgets[active] += shares[active]
+         remaining = 0.
+   return budgets.astype(int)
+
+def recency_weights(tracks, half_life=3600.):
+   ''' Weight each track by how recently it was updated: the weight halves every half_life seconds (min 0.1) '''
+   now = time.time()
+   ages = np.array([now - track.updated for track in tracks], dtype=float)
+   return np.maximum(0.5 ** (ages / half_life), 0.1)
+
+def path_header(colour):
+   ''' Static Maps path parameter for this colour (the encoded path follows) '''
+   return '&path=color:' + colour + '|weight:5|enc:'
+
+def build_paths(tracks, colours, max_length, zoom=None):
+   ''' Assemble the path parameters for all tracks, sharing max_length URL characters between them.
+   If zoom is given, the tracks are simplified for that zoom first.
+   Only the tracks which have waypoints use up URL characters for their headers '''
+   demands = [track.encoded_length(zoom) for track in tracks]
+   # Pipes ('|') in the headers are counted as the three characters of '%7C'
+   header_lengths = [len(path_header(colours[i]).replace('|', '%7C')) for i in range(len(tracks)) if demands[i] > 0]
+   budgets = allocate_path_budgets(demands, max_length - sum(header_lengths), recency_weights(tracks))
+   paths = ''
+   for i in range(len(tracks)):
+      encoded = tracks[i].encode(budgets[i], zoom)
+      if encoded != '': # Leave the path out if not even one waypoint fits
+         paths += path_header(colours[i]) + encoded
+   return paths
+
+cluster_colour = 'black' # Colour for cluster markers (the base is white)
+
+def cluster_markers(markers, zoom, cell_size=24.):
+   ''' Merge the markers [(lat, lon, colour)] which fall into the same cell_size x cell_size pixel grid cell at this zoom.
+   Returns [(lat, lon, colour, count)]: single markers are unchanged (count 1);
+   each cluster is placed at the mean position of its markers and shown in cluster_colour '''
+   if len(markers) == 0:
+      return []
+   x, y = latlon_to_world([lat for lat, lon, colour in markers], [lon for lat, lon, colour in markers], zoom)
+   x = np.atleast_1d(x)
+   y = np.atleast_1d(y)
+   cols = int(math.ceil(world_size(zoom) / cell_size)) # Number of cells around the world
+   cells = (np.floor(y / cell_size).astype(np.int64) * cols) + (np.floor(x / cell_size).astype(np.int64) % cols)
+   # first is the first marker in each cluster; clusters is the cluster number of each marker
+   keys, first, clusters = np.unique(cells, return_index=True, return_inverse=True)
+   clusters = clusters.ravel()
+   counts = np.bincount(clusters)
+   lats, lons = world_to_latlon(np.bincount(clusters, weights=x) / counts, np.bincount(clusters, weights=y) / counts, zoom)
+   result = []
+   for c in range(len(counts)):
+      if counts[c] == 1:
+         lat, lon, colour = markers[first[c]]
+         result.append((lat, lon, colour, 1))
+      else:
+         result.append((float(lats[c]), float(lons[c]), cluster_colour, int(counts[c])))
+   return result
+
+def marker_parameter(lat, lon, colour, count=1):
+   ''' Static Maps marker parameter for a marker (count 1) or a cluster of count markers.
+   Static Maps labels are a single character (0-9 or A-Z) so clusters of more than 9 are shown without one '''
+   if 1 < count <= 9:
+      return '&markers=color:' + colour + '|label:' + str(count) + '|' + '{:.6f},{:.6f}'.format(lat, lon)
+   return '&markers=color:' + colour + '|' + '{:.6f},{:.6f}'.format(lat, lon)
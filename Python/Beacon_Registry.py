@@ -0,0 +1,94 @@
+# -*- coding: cp1252 -*-
+
+## Beacon Registry
+
+## Keeps track of the beacons shown by Iridium_Beacon_Base.py (by serial number)
+## and Iridium_Beacon_Mapper_RockBLOCK.py (by IMEI).
+## Works with both Python 2 (Base) and Python 3 (Mapper).
+
+## There is no limit on the number of beacons. Each beacon is looked up by its serial number
+## or IMEI in a dictionary so finding it doesn't depend on how many beacons there are.
+
+## Each beacon gets its own colour. The first eight are the named colours used previously.
+## After that the colours are generated by stepping the hue around the colour wheel by the
+## golden ratio, so consecutive beacons are always easy to tell apart. Generated colours are
+## '#rrggbb' (understood by Tkinter, Qt and PIL); static_maps_colour converts them into the
+## '0xrrggbb' form needed by Google Static Maps.
+
+## Beacons can be hidden. Hidden beacons are still logged and listed in the menus but their
+## markers and paths are left off the map (and out of the map URL).
+
+import colorsys
+from Beacon_Map_Overlays import BeaconTrack
+
+named_colours = ['red','yellow','green','blue','purple','gray','brown','orange'] # Colours for the first eight beacons
+golden_ratio = 0.618033988749895 # Hue step for the generated colours
+
+def beacon_colour(number):
+   ''' Return the colour for beacon number (0, 1, 2, ...) '''
+   if number < len(named_colours):
+      return named_colours[number]
+   number -= len(named_colours)
+   hue = (number * golden_ratio) % 1.
+   value = (0.95, 0.75)[(number // 3) % 2] # Alternate the brightness too so nearby hues are still distinct
+   red, green, blue = colorsys.hsv_to_rgb(hue, 0.85, value)
+   return '#%02x%02x%02x' % (int(round(red * 255.)), int(round(green * 255.)), int(round(blue * 255.)))
+
+def static_maps_colour(colour):
+   ''' Convert colour into the form used by Google Static Maps ('#rrggbb' becomes '0xrrggbb') '''
+   if colour.startswith('#'):
+      return '0x' + colour[1:]
+   return colour
+
+class Beacon(object):
+   ''' Everything we know about one beacon '''
+
+   def __init__(self, name, number, colour):
+      self.name = name # Serial number (Base) or IMEI (Mapper)
+      self.number = number # Order in which the beacon was first seen (0, 1, 2, ...)
+      self.colour = colour # Colour for the beacon marker and path
+      self.track = BeaconTrack() # Waypoints for the beacon path
+      self.location = '' # Most recent location in lat,lon format; '' if unknown
+      self.speed = 0. # Most recent speed (m/s)
+      self.heading = 0. # Most recent heading (degrees)
+      self.log_file = '' # Log file name; '' if not yet created
+      self.visible = True # Show this beacon on the map?
+
+   def latlon(self):
+      ''' Return the most recent location (lat, lon degrees); or None if it is unknown '''
+      if self.location == '':
+         return None
+      lat, lon = self.location.split(',')
+      return float(lat), float(lon)
+
+class BeaconRegistry(object):
+   ''' All the beacons seen so far, in the order in which they were first seen '''
+
+   def __init__(self):
+      self.beacons = [] # Beacon objects
+      self.index = {} # name : Beacon
+
+   def __len__(self):
+      return len(self.beacons)
+
+   def __iter__(self):
+      return iter(self.beacons)
+
+   def __contains__(self, name):
+      return name in self.index
+
+   def get(self, name):
+      ''' Return the beacon with this serial number or IMEI; or None if it hasn't been seen '''
+      return self.index.get(name)
+
+   def add(self, name):
+      ''' Add a new beacon with this serial number or IMEI and return it '''
+      number = len(self.beacons)
+      beacon = Beacon(name, number, beacon_colour(number))
+      self.beacons.append(beacon)
+      self.index[name] = beacon
+      return beacon
+
+   def visible(self):
+      ''' Return the beacons which are shown on the map '''
+      return [beacon for beacon in self.beacons if beacon.visible]
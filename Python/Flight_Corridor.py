@@ -0,0 +1,141 @@
+# -*- coding: cp1252 -*-
+
+## Flight Corridor
+
+## Works out which offline map tiles cover the corridor along a flight track, so that
+## Google_Static_Maps_Tiler.py only downloads the tiles close to the track instead of every tile in
+## the track's bounding box (which is mostly empty countryside or ocean for a balloon flight).
+## Works with both Python 2 and Python 3.
+
+## read_track reads the track from:
+##   a KML file - every <coordinates> element in the file, in order (e.g. the _flightpath.kml made by
+##                Iridium_Beacon_DateTime_CSV_to_KML_RockBLOCK.py, or a predicted track)
+##   a CSV file - a Base Beacon_Log file, a stitched RockBLOCK .csv (before or after Iridium_Beacon_CSV_DateTime.py)
+##                or a file of lat,lon lines (e.g. a predicted track). The RockBLOCK serial number and the
+##                date and time columns at the start of each line are skipped; the next two columns are lat, lon
+
+## corridor_cells returns the cells of the grid of map tiles at a zoom level (see grid_cells in Web_Mercator.py)
+## which come within buffer meters of the track. The track is converted into world pixels (taking the shortest
+## way across the antimeridian), each segment is cut into pieces no more than a few tiles long, and the distance
+## from every piece to every nearby cell is calculated in one go using NumPy. A cell is needed if the distance
+## is no more than the buffer width (in pixels at that latitude: the buffer grows toward the poles on the map).
+
+import re
+import numpy as np
+from Web_Mercator import latlon_to_world, world_size, meters_per_pixel
+
+def read_track(filename):
+   ''' Return the lats, lons (degrees) of the track in filename (KML or CSV) as NumPy arrays '''
+   lats = []
+   lons = []
+   with open(filename, 'r') as f:
+      text = f.read()
+   if filename.lower().endswith('.kml'):
+      for coordinates in re.findall(r'<coordinates>(.*?)</coordinates>', text, re.DOTALL):
+         for point in coordinates.split(): # lon,lat[,alt] separated by whitespace
+            fields = point.split(',')
+            lons.append(float(fields[0]))
+            lats.append(float(fields[1]))
+   else:
+      for line in text.splitlines():
+         fields = [field.strip() for field in line.split(',')]
+         # Skip the RockBLOCK serial number and the date and time (YYYYMMDDHHMMSS or DD/MM/YY,HH:MM:SS)
+         while (len(fields) > 0) and ((fields[0][:2] == 'RB') or (len(fields[0]) == 14 and fields[0].isdigit()) or ('/' in fields[0]) or (':' in fields[0])):
+            fields = fields[1:]
+         try:
+            lat = float(fields[0])
+            lon = float(fields[1])
+         except (ValueError, IndexError): # e.g. a header line
+            continue
+         if (lat == 0.) and (lon == 0.): # No GNSS fix
+            continue
+         lats.append(lat)
+         lons.append(lon)
+   return np.array(lats), np.array(lons)
+
+def point_rect_distance(px, py, left, top, right, bottom):
+   ''' Return the distance from points px, py to the rectangles left, top, right, bottom '''
+   dx = np.maximum(np.maximum(left - px, px - right), 0.)
+   dy = np.maximum(np.maximum(top - py, py - bottom), 0.)
+   return np.hypot(dx, dy)
+
+def point_segment_distance(px, py, ax, ay, bx, by):
+   ''' Return the distance from points px, py to the line segments ax, ay to bx, by '''
+   dx = bx - ax
+   dy = by - ay
+   length = np.maximum((dx * dx) + (dy * dy), 1e-12) # (Zero length segments are points)
+   t = np.clip((((px - ax) * dx) + ((py - ay) * dy)) / length, 0., 1.)
+   return np.hypot(px - (ax + (t * dx)), py - (ay + (t * dy)))
+
+def segment_rect_distance(ax, ay, bx, by, left, top, right, bottom):
+   ''' Return the distance from the line segments ax, ay to bx, by to the rectangles left, top, right, bottom '''
+   # Zero if the segment passes through the rectangle (Liang-Barsky clipping)
+   dx = bx - ax
+   dy = by - ay
+   t0 = np.zeros(np.shape(ax))
+   t1 = np.ones(np.shape(ax))
+   crosses = np.ones(np.shape(ax), dtype=bool)
+   for p, q in ((-dx, ax - left), (dx, right - ax), (-dy, ay - top), (dy, bottom - ay)):
+      parallel = (p == 0.)
+      crosses &= ~(parallel & (q < 0.)) # Parallel to this edge and outside it
+      t = q / np.where(parallel, 1., p)
+      t0 = np.where(~parallel & (p < 0.), np.maximum(t0, t), t0)
+      t1 = np.where(~parallel & (p > 0.), np.minimum(t1, t), t1)
+   crosses &= (t0 <= t1)
+   # Otherwise the closest points are an end of the segment or a corner of the rectangle
+   distance = np.minimum(point_rect_distance(ax, ay, left, top, right, bottom), point_rect_distance(bx, by, left, top, right, bottom))
+   for cx, cy in ((left, top), (right, top), (left, bottom), (right, bottom)):
+      distance = np.minimum(distance, point_segment_distance(cx, cy, ax, ay, bx, by))
+   return np.where(crosses, 0., distance)
+
+def corridor_cells(lats, lons, buffer, zoom, width=640, height=480):
+   ''' Return the rows, cols of the width x height pixel grid cells at this zoom which come within
+   buffer (m) of the track lats, lons (degrees) '''
+   lats = np.atleast_1d(np.asarray(lats, dtype=float))
+   lons = np.atleast_1d(np.asarray(lons, dtype=float))
+   size = world_size(zoom)
+   x, y = latlon_to_world(lats, lons, zoom)
+   dx = ((np.diff(x) + (size / 2.)) % size) - (size / 2.) # Take the shortest way around the world
+   x = x[0] + np.concatenate(([0.], np.cumsum(dx)))
+   radius = buffer / meters_per_pixel(lats, zoom) # Buffer width in world pixels at each point
+   if len(x) == 1: # A single point: a segment of zero length
+      x = np.repeat(x, 2)
+      y = np.repeat(y, 2)
+      radius = np.repeat(radius, 2)
+
+   # Cut each segment into pieces no more than two tiles long so each piece only has a few cells nearby
+   ax = x[:-1]
+   ay = y[:-1]
+   sx = np.diff(x)
+   sy = np.diff(y)
+   r = np.maximum(radius[:-1], radius[1:])
+   pieces = np.maximum(np.ceil(np.hypot(sx, sy) / (2. * max(width, height))), 1).astype(int)
+   segment = np.repeat(np.arange(len(pieces)), pieces)
+   step = np.arange(len(segment)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+   t0 = step / pieces[segment].astype(float)
+   t1 = (step + 1) / pieces[segment].astype(float)
+   x0 = ax[segment] + (t0 * sx[segment])
+   y0 = ay[segment] + (t0 * sy[segment])
+   x1 = ax[segment] + (t1 * sx[segment])
+   y1 = ay[segment] + (t1 * sy[segment])
+   r = r[segment]
+
+   # The cells within r of each piece's bounding box are the candidates
+   first_row = np.floor((np.minimum(y0, y1) - r) / height).astype(int)
+   first_col = np.floor((np.minimum(x0, x1) - r) / width).astype(int)
+   num_rows = np.floor((np.maximum(y0, y1) + r) / height).astype(int) - first_row + 1
+   num_cols = np.floor((np.maximum(x0, x1) + r) / width).astype(int) - first_col + 1
+   count = num_rows * num_cols
+   piece = np.repeat(np.arange(len(count)), count)
+   n = np.arange(len(piece)) - np.repeat(np.cumsum(count) - count, count)
+   rows = first_row[piece] + (n // num_cols[piece])
+   cols = first_col[piece] + (n % num_cols[piece])
+
+   # Keep the candidates which come within r of their piece
+   distance = segment_rect_distance(x0[piece], y0[piece], x1[piece], y1[piece],
+                                    cols * float(width), rows * float(height), (cols + 1) * float(width), (rows + 1) * float(height))
+   near = (distance <= r[piece]) & (rows >= 0) & (rows * height < size) # (Cells beyond the top or bottom of the world are not needed)
+   if not np.any(near):
+      return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+   cells = np.unique(np.column_stack((rows[near], cols[near])), axis=0)
+   return cells[:, 0], cells[:, 1]
@@ -3,61 +3,55 @@
 ## Google Static Maps Tiler
 ## Grabs the selected Google Static Map tiles
 
+## The tiles are stored in a single-file package: StaticMapTiles.sqlite (see Offline_Map_Tiles.py)
+## which is used by Iridium_Beacon_Base.py for its offline maps. A pyramid of tiles can be built in
+## one run: the first zoom level is set by the tile size; each extra (more detailed) zoom level uses
+## tiles half the size of the one before. Any StaticMapTile_*.png files left in this directory by
+## earlier versions of the Tiler (or in its subdirectories) are added to the package first.
+
+## By default (aligned = True) the tile size only sets the first zoom level. The tiles are then laid out
+## on the exact Web Mercator pixel grid for each zoom level (see Web_Mercator.py): neighbouring 640x480
+## tiles abut exactly, with no overlap, so the fewest tiles cover the area and the Base can stitch them
+## together seamlessly. Set aligned to False to step the tile centers by tile_size degrees instead
+## (the tiles then overlap, most of all at low latitudes).
+
+## Instead of a lat/lon box, the Tiler can cover a flight corridor: enter a track file (KML or CSV, e.g. a predicted
+## track, a Base Beacon_Log file or a RockBLOCK .csv; see Flight_Corridor.py) and a buffer width. Only the
+## (aligned) tiles which come within the buffer width of the track are downloaded, which is usually a small
+## fraction of the tiles in the track's bounding box.
+
 ## Requires a Google Static Maps API key
 ## Create one using: https://developers.google.com/maps/documentation/static-maps/get-api-key
 ## Then copy and paste it into a file called Google_Static_Maps_API_Key.txt
 
-import urllib
+## The tiles are downloaded by a pool of worker threads (workers at once, starting no more than
+## max_rate downloads per second). A tile which fails is tried again (after backoff, 2*backoff, ...
+## seconds) up to tile_retries more times; tiles which still fail are listed at the end instead of
+## stopping the run. Each completed tile is added to the package (which serves as the manifest) as it finishes.
+## Running the Tiler again for the same area skips the tiles which are already in the package,
+## so an interrupted run can simply be restarted.
+
 from PIL import Image, ImageTk
 import math
 import numpy as np
+import os
+import io
+import time
+import threading
+import Queue
+from Static_Maps_Client import download, http_client, MapImageCache, RateLimiter, HTTPStatusError
+from Web_Mercator import fit_zoom, max_zoom, world_size, latlon_to_world, grid_cells, grid_centers
+from Offline_Map_Tiles import StaticMapTilePackage, package_filename, import_tile_files
+from Flight_Corridor import read_track, corridor_cells
 
 frame_height = 480 # Google Static Map window width
 frame_width = 640 # Google Static Map window height
 map_type = 'hybrid' # Maps can be: roadmap , satellite , terrain or hybrid
-
-# Google static map API pixel scales
-# https://gis.stackexchange.com/questions/7430/what-ratio-scales-do-google-maps-zoom-levels-correspond-to
-# ---
-# Radius of the Earth at the Equator = 6378137m
-# Circumference at the Equator = 2*pi*r = 40075017m
-# Zoom level 24 uses 2^32 (4294967296) pixels at circumference
-# Pixel scale at zoom level 24 is 0.009330692m/pixel
-# Pixel scale doubles with each zoom level
-# Pixel scale at zoom level 21 is 0.074645535m/pixel
-# Pixel scale at zoom level 1 is 78271.5170m/pixel
-# ---
-# Zoom level 24 uses 2^32 (4294967296) pixels at circumference
-# Each pixel represents an angle of 2*pi/2^32 radians = 1.46291808e-9 radians
-# Angle doubles with each zoom level
-# Zoom level 21 is 1.17033446e-8 radians per pixel
-# In degrees:
-# Zoom level 21 is 6.70552254e-7 degrees per pixel
-# Zoom level 1 is 0.703125 degrees per pixel
-# ---
-# These values need to be adjusted with increasing latitude due to the Mercator projection
-scales = np.array([
-   [1,7.03125000E-01], # Zoom level 1 is 0.703125 degrees per pixel at the Equator
-   [2,3.51562500E-01],
-   [3,1.75781250E-01],
-   [4,8.78906250E-02],
-   [5,4.39453125E-02],
-   [6,2.19726562E-02],
-   [7,1.09863281E-02],
-   [8,5.49316406E-03],
-   [9,2.74658203E-03],
-   [10,1.37329102E-03],
-   [11,6.86645508E-04],
-   [12,3.43322754E-04],
-   [13,1.71661377E-04],
-   [14,8.58306885E-05],
-   [15,4.29153442E-05],
-   [16,2.14576721E-05],
-   [17,1.07288361E-05],
-   [18,5.36441803E-06],
-   [19,2.68220901E-06],
-   [20,1.34110451E-06],
-   [21,6.70552254E-07]]) # Zoom level 21 is 6.70552254e-7 degrees per pixel at the Equator
+aligned = True # Align the tiles to the Web Mercator pixel grid? (False: step the tile centers by tile_size degrees)
+workers = 4 # Download up to this many tiles at once
+max_rate = 10. # Start no more than this many downloads per second
+tile_retries = 3 # Try a failed tile up to this many more times
+backoff = 2. # Wait this long (seconds) before trying a failed tile again; doubles for each retry after that
 
 # Read the Google Static Maps API key
 # Create one using: https://developers.google.com/maps/documentation/static-maps/get-api-key
@@ -71,59 +65,159 @@ except:
    print 'then copy and paste it into a file called Google_Static_Maps_API_Key.txt'
    raise ValueError('Could not read API Key!')
 
-# Ask the user for the lat and lon extents and tile size
-try:
-   max_lat = float(raw_input('Enter the maximum (northern-most) latitude in degrees: '))
-except:
-   raise ValueError('Invalid value!')
-if (max_lat < -90.) or (max_lat > 90.): raise ValueError('Invalid value!')
+# Ask the user for a track file (to cover a corridor along the track) or the lat and lon extents, and the tile size
+track_file = raw_input('Enter a track file (KML or CSV) to tile a corridor along it, or press Enter to enter the lat and lon extents: ')
+if track_file != '':
+   try:
+      track_lats, track_lons = read_track(track_file)
+   except:
+      raise ValueError('Could not read the track file!')
+   if len(track_lats) == 0: raise ValueError('No track points in ' + track_file + '!')
+   try:
+      buffer_width = float(raw_input('Enter the corridor width either side of the track in km: ')) * 1000.
+   except:
+      raise ValueError('Invalid value!')
+   if (buffer_width < 0.): raise ValueError('Invalid value!')
+   max_lat = float(track_lats.max())
+   min_lat = float(track_lats.min())
+   print 'Read',len(track_lats),'track points from',track_file
+else:
+   try:
+      max_lat = float(raw_input('Enter the maximum (northern-most) latitude in degrees: '))
+   except:
+      raise ValueError('Invalid value!')
+   if (max_lat < -90.) or (max_lat > 90.): raise ValueError('Invalid value!')
+   try:
+      min_lat = float(raw_input('Enter the minimum (southern-most) latitude in degrees: '))
+   except:
+      raise ValueError('Invalid value!')
+   if (min_lat < -90.) or (min_lat > 90.): raise ValueError('Invalid value!')
+   if (max_lat < min_lat): raise ValueError('Invalid value!')
+   try:
+      min_lon = float(raw_input('Enter the minimum (western-most) longitude in degrees: '))
+   except:
+      raise ValueError('Invalid value!')
+   if (min_lon < -180.) or (min_lon > 180.): raise ValueError('Invalid value!')
+   try:
+      max_lon = float(raw_input('Enter the maximum (eastern-most) longitude in degrees: '))
+   except:
+      raise ValueError('Invalid value!')
+   if (max_lon < -180.) or (max_lon > 180.): raise ValueError('Invalid value!')
+   if (max_lon < min_lon): raise ValueError('Invalid value!')
 try:
-   min_lat = float(raw_input('Enter the minimum (southern-most) latitude in degrees: '))
-except:
-   raise ValueError('Invalid value!')
-if (min_lat < -90.) or (min_lat > 90.): raise ValueError('Invalid value!')
-if (max_lat < min_lat): raise ValueError('Invalid value!')
-try:
-   min_lon = float(raw_input('Enter the minimum (western-most) longitude in degrees: '))
-except:
-   raise ValueError('Invalid value!')
-if (min_lon < -180.) or (min_lon > 180.): raise ValueError('Invalid value!')
-try:
-   max_lon = float(raw_input('Enter the maximum (eastern-most) longitude in degrees: '))
+   tile_size = float(raw_input('Enter the tile size in degrees: '))
 except:
    raise ValueError('Invalid value!')
-if (max_lon < -180.) or (max_lon > 180.): raise ValueError('Invalid value!')
-if (max_lon < min_lon): raise ValueError('Invalid value!')
 try:
-   tile_size = float(raw_input('Enter the tile size in degrees: '))
+   levels = raw_input('Enter the number of extra (more detailed) zoom levels for the pyramid (default 0): ')
+   if levels == '':
+      levels = 0
+   levels = int(levels)
 except:
    raise ValueError('Invalid value!')
+if (levels < 0): raise ValueError('Invalid value!')
 
 # Find the largest absolute latitude
 abs_max_lat = abs(max_lat)
 if abs(min_lat) > abs_max_lat: abs_max_lat = abs(min_lat)
 
-adjusted_scales = np.array(scales) # Make a copy of the zoom vs pixel scale angle look-up table
-# Calculate latitude scale multiplier based on current latitude to correct for Mercator projection
-scale_multiplier_lat = math.cos(math.radians(abs_max_lat))
-# Adjust the pixel scale angles in the zoom look up table to compensate for latitude
-for entry in adjusted_scales:
-   entry[1] = entry[1] * scale_multiplier_lat
-# Calculate the maximum pixel scale required to display the full tile
-min_pixel_scale = tile_size / frame_height
-# Set zoom to the highest zoom level which will display the tile_size
-zoom = int(adjusted_scales[np.where(min_pixel_scale<=adjusted_scales[:,1])][-1][0])
-
-# Calculate loop limits
-num_tiles_lat = int(math.ceil((max_lat - min_lat) / tile_size))
-num_tiles_lon = int(math.ceil((max_lon - min_lon) / tile_size))
+# Set zoom to the highest zoom level which will display a full tile at the largest absolute latitude
+# (the Mercator projection stretches the tiles most there)
+zoom = fit_zoom([abs_max_lat - tile_size, abs_max_lat], [0., tile_size], frame_width, frame_height)
+levels = min(levels, max_zoom - zoom) # Google Static Maps stops at max_zoom
 
-num_files = 0
+def valid_tile(data):
+   ''' Return True if data is a complete image '''
+   try:
+      Image.open(io.BytesIO(data)).verify()
+      return True
+   except Exception:
+      return False
+
+def fetch_tile(url):
+   ''' Return (data, source) for this tile URL: from the cache if possible; else downloaded.
+   Raises the last error if the tile still can't be downloaded after tile_retries more tries '''
+   data = map_cache.get(url) # Check the cache first
+   if (data is not None) and valid_tile(data):
+      return data, 'From cache: '
+   for attempt in range(tile_retries + 1):
+      if attempt > 0:
+         time.sleep(backoff * (2 ** (attempt - 1))) # Exponential backoff
+      rate_limiter.wait()
+      try:
+         data = download(url) # Attempt map image download (a single HTTP request: the HTTP client doesn't retry)
+      except HTTPStatusError as e:
+         error = e
+         if (e.status < 500) and (e.status != 429): # e.g. an invalid key: trying again won't help
+            break
+         continue
+      except Exception as e:
+         error = e
+         continue
+      if valid_tile(data):
+         map_cache.put(url, data)
+         return data, 'Downloaded: '
+      error = ValueError('Invalid image data')
+   raise error
+
+def worker():
+   ''' Worker thread: fetch the tiles from the tiles queue. The main thread adds them to the package '''
+   while True:
+      name, url, tile_zoom, lat, lon = tiles.get()
+      try:
+         data, source = fetch_tile(url)
+         results.put((name, tile_zoom, lat, lon, data, source, None))
+      except Exception as e:
+         results.put((name, tile_zoom, lat, lon, None, None, e))
+
+# Open (or create) the tile package
+package = StaticMapTilePackage(package_filename)
+if 'format' not in package.metadata(): # (Don't relabel a package which Static_Map_Tile_Compressor.py has recompressed)
+   package.set_metadata('format', 'png')
+package.set_metadata('map_type', map_type)
+package.set_metadata('size', str(frame_width) + 'x' + str(frame_height))
+
+# Add any loose tile files left by earlier versions of the Tiler (here or in a subdirectory) to the package
+for filename in import_tile_files(package):
+   print 'Added to package: ',filename
+
+# Tiles downloaded before (by the Tiler or the Base) are copied from the cache instead of using API quota
+map_cache = MapImageCache()
+
+# Make a list of the tiles which are still needed, from the least detailed zoom level to the most
+needed = []
+num_present = 0
+for level in range(levels + 1):
+   tile_zoom = zoom + level
+   if track_file != '':
+      # Use the grid cells which come within buffer_width of the track
+      rows, cols = corridor_cells(track_lats, track_lons, buffer_width, tile_zoom, frame_width, frame_height)
+      lats, lons = grid_centers(rows, cols, tile_zoom, frame_width, frame_height)
+      centers = [(round(float(lats[t]), 6), round(float(lons[t]), 6)) for t in range(len(lats))]
+   elif aligned:
+      # Find the grid cells which contain the corners of the area and use every cell in between
+      top, left = grid_cells(max_lat, min_lon, tile_zoom, frame_width, frame_height)
+      x, y = latlon_to_world(min_lat, max_lon, tile_zoom)
+      x = min(float(x), world_size(tile_zoom) - 1.) # max_lon = 180 is the right hand edge of the world, not the next cell
+      bottom, right = int(math.floor(y / frame_height)), int(math.floor(x / frame_width))
+      rows, cols = np.meshgrid(np.arange(int(top), bottom + 1), np.arange(int(left), right + 1), indexing='ij')
+      lats, lons = grid_centers(rows.ravel(), cols.ravel(), tile_zoom, frame_width, frame_height)
+      centers = [(round(float(lats[t]), 6), round(float(lons[t]), 6)) for t in range(len(lats))]
+   else:
+      level_size = tile_size / (2 ** level) # Each zoom level doubles the magnification
+      # Calculate loop limits
+      num_tiles_lat = int(math.ceil((max_lat - min_lat) / level_size))
+      num_tiles_lon = int(math.ceil((max_lon - min_lon) / level_size))
+      centers = [(lat, lon) for lat in np.arange((min_lat + (level_size / 2.)), ((min_lat + (level_size / 2.)) + (num_tiles_lat * level_size)), level_size)
+                 for lon in np.arange((min_lon + (level_size / 2.)), ((min_lon + (level_size / 2.)) + (num_tiles_lon * level_size)), level_size)]
+
+   for lat, lon in centers:
+      # Skip the tile if it is already in the package
+      # (tiles added from files were named using 3 decimal places)
+      if (package.find(tile_zoom, lat, lon) is not None) or (package.find(tile_zoom, round(lat, 3), round(lon, 3)) is not None):
+         num_present += 1
+         continue
 
-# Loop though tiles
-for lat in np.arange((min_lat + (tile_size / 2.)), ((min_lat + (tile_size / 2.)) + (num_tiles_lat * tile_size)), tile_size):
-   for lon in np.arange((min_lon + (tile_size / 2.)), ((min_lon + (tile_size / 2.)) + (num_tiles_lon * tile_size)), tile_size):
-   
       # Assemble map center
       center = ("%.6f"%lat) + ',' + ("%.6f"%lon)
 
@@ -131,7 +225,7 @@ for lat in np.arange((min_lat + (tile_size / 2.)), ((min_lat + (tile_size / 2.))
       path_url = 'https://maps.googleapis.com/maps/api/staticmap?center='
       path_url += center
       path_url += '&zoom='
-      path_url += str(zoom)
+      path_url += str(tile_zoom)
       path_url += '&size='
       path_url += str(frame_width)
       path_url += 'x'
@@ -139,15 +233,55 @@ for lat in np.arange((min_lat + (tile_size / 2.)), ((min_lat + (tile_size / 2.))
       path_url += '&maptype=' + map_type + '&format=png&key='
       path_url += key
 
-      # Download the API map image from Google
-      filename = ("StaticMapTile_Zoom_%i"%zoom) + ("_Lat_%.3f"%lat) + ("_Lon_%.3f_.png"%lon) # Download map to this file
+      name = ("StaticMapTile_Zoom_%i"%tile_zoom) + ("_Lat_%.6f"%lat) + ("_Lon_%.6f"%lon) # Used in the messages
+      needed.append((name, path_url, tile_zoom, lat, lon))
+
+print 'Zoom levels',zoom,'to',zoom + levels
+print 'Skipping',num_present,'tiles which are already in',package_filename
+print 'Fetching',len(needed),'tiles using',workers,'workers'
+
+# Start the workers
+tiles = Queue.Queue()
+results = Queue.Queue()
+rate_limiter = RateLimiter(max_rate)
+http_client.max_idle = workers # Keep a connection open for each worker
+http_client.retries = 0 # fetch_tile does the retrying so every request is paced by the rate limiter
+for tile in needed:
+   tiles.put(tile)
+for w in range(workers):
+   thread = threading.Thread(target=worker)
+   thread.daemon = True # Don't hold the program open (e.g. if it is interrupted)
+   thread.start()
+
+# Collect the results. Each completed tile is added to the package straight away
+num_files = 0
+failed = []
+start = time.time()
+for n in range(len(needed)):
+   while True:
       try:
-         urllib.urlretrieve(path_url, filename) # Attempt map image download
-         print 'Downloaded: ',filename
-         num_files += 1
-      except:
-         raise ValueError('Map tile download failed!')      
+         name, tile_zoom, lat, lon, data, source, error = results.get(timeout=1.) # (A timeout lets Ctrl-C interrupt the wait)
+         break
+      except Queue.Empty:
+         pass
+   if error is None:
+      package.add(tile_zoom, lat, lon, data)
+      print source,name
+      num_files += 1
+   else:
+      print 'Failed:',name,'(' + str(error) + ')'
+      failed.append(name)
 
-print 'Downloaded',num_files,'files'
-print 'Finished!'
+# Record the extent of the package
+minzoom, maxzoom = package.db.execute('SELECT MIN(zoom_level), MAX(zoom_level) FROM tiles').fetchone()
+if minzoom is not None:
+   package.set_metadata('minzoom', minzoom)
+   package.set_metadata('maxzoom', maxzoom)
 
+print 'Fetched',num_files,'tiles in',("%.1f"%(time.time() - start)),'seconds'
+print package_filename,'now holds',len(package),'tiles'
+package.close()
+if len(failed) > 0:
+   print len(failed),'tiles failed. Run the Tiler again with the same settings to fetch them'
+print 'HTTP:',http_client.summary() # The tiles are downloaded over a few reused (keep-alive) connections
+print 'Finished!'
@@ -22,6 +22,16 @@
 ## starts an IridiumSBD session and downloads a packet from the mobile terminated queue
 ## (if any are present).
 
+## The serial port is read by a background thread which collects each complete (CR LF terminated)
+## response from the base (see Serial_Line_Reader.py). The GUI sends a command and carries on; the
+## timer collects the response (or notices the timeout) and passes it on to be processed, so the
+## GUI stays responsive during the Iridium sessions.
+
+## If the base reports that there are more messages waiting in the mobile terminated queue (MTQ > 0),
+## further Iridium sessions are started straight away (without requesting the base location again) until the
+## queue is empty, up to max_drain_sessions extra sessions per update. So a backlog of messages (e.g. after a
+## comms gap) is downloaded in minutes instead of one message per update interval.
+
 ## The GUI and base provide access to the RockBLOCK FLUSH_MT function, so an excess of
 ## unread Mobile Terminated messages can be discarded if required
 ## (note that you are still charged from these messages!).
@@ -32,12 +42,25 @@
 ## The displayed map is automatically centered on a new beacon position.
 ## The center position can be changed by left-clicking in the image.
 ## A right-click will copy the click location (lat,lon) to the clipboard.
-## The zoom level is set automatically when a new beacon is displayed to show both beacon and base.
+## The center and zoom are set automatically when a new beacon is displayed to show the base and all the beacons
+## (and their paths). "Fit All" on the menu bar does the same at any time.
 ## The zoom can be changed using the buttons.
 
 ## Each beacon's path is displayed as a coloured line on the map.
 ## The oldest waypoints may be deleted as the map URL is limited to 8192 characters.
 
+## By default (local_overlay = True) only the map itself (the basemap) is downloaded from Google.
+## The markers and paths are drawn on it locally, so new beacon data only needs a new map
+## image when the view (center or zoom) changes. Set local_overlay to False to have Google
+## draw the markers and paths (which needs a new map image for every update).
+
+## Any number of beacons can be tracked. The first eight are shown in the named colours
+## (red, yellow, green, blue, purple, gray, brown, orange); after that each beacon gets a generated colour.
+## The "Show Beacons" pull-down menu shows or hides each beacon on the map. Hidden beacons are still logged
+## but are left out of the map URL (and Fit All).
+## Markers which are close together at the current zoom are merged into a single black cluster marker
+## labelled with the number of markers it holds. Zoom in to see them separately.
+
 ## A pull-down menu lists the locations of all the beacons being tracked.
 ## Clicking on a menu entry will center the map on that location and will copy the location
 ## to the clipboard.
@@ -63,7 +86,20 @@
 ## premium plan with Google.
 
 ## Offline maps can be collected using Google_Static_Map_Tiler.py
-## Base and beacon locations will be shown on the offline maps but not path information
+## The tiles (for all zoom levels) are stored in a single file: StaticMapTiles.sqlite (see Offline_Map_Tiles.py)
+## Loose StaticMapTile_*.png files left by earlier versions of the Tiler are added to the package by running the Tiler again
+## The offline map is assembled from the tiles around the map center and shows the base and
+## beacon locations and the beacon paths
+
+## While the network connection is available, the Base also prefetches offline map tiles around each beacon
+## and along the track it is expected to follow (from its latest speed and heading) for the next
+## prefetch_seconds, at the current zoom and the zoom levels either side (see Tile_Prefetcher.py).
+## The tiles are downloaded in the background, when no map image is being downloaded, into
+## StaticMapTiles.sqlite and are added to the offline map straight away.
+
+## If a directory of standard XYZ map tiles (Map_Tiles/<z>/<x>/<y>.png) or an MBTiles package
+## (Map_Tiles.mbtiles) is found, the map is assembled from those tiles instead of using
+## Google Static Maps - no network connection or API quota is needed (see Map_Providers.py)
 
 import Tkinter as tk
 import tkMessageBox
@@ -71,13 +107,20 @@ import tkSimpleDialog
 import tkFont
 import serial
 import time
-import urllib
-from PIL import Image, ImageTk, ImageDraw
+from PIL import Image, ImageTk
 import math
 import numpy as np
 from sys import platform
-from shutil import copyfile
 import os
+import io
+from Beacon_Map_Overlays import build_paths, cluster_markers, marker_parameter
+from Beacon_Registry import BeaconRegistry, static_maps_colour
+from Static_Maps_Client import MapFetcher, MapImageCache, http_client
+from Offline_Map_Tiles import OfflineTileIndex, StaticMapTilePackage, package_filename, draw_overlay
+from Web_Mercator import fit_bounds, pixels_to_latlon
+from Map_Providers import find_tile_provider
+from Tile_Prefetcher import TilePrefetcher, plan_prefetch
+from Serial_Line_Reader import SerialLineReader
 
 class BeaconBase(object):
 
@@ -103,86 +146,71 @@ class BeaconBase(object):
       self.map_lon = 0.0 # Map longitude (degrees)
       self.frame_height = 480 # Google Static Map window width
       self.frame_width = 640 # Google Static Map window height
-      self.delta_limit_pixels = 200 # If base to beacon angle (delta) exceeds this many pixels, decrease the zoom level accordingly
+      self.fit_margin = 20 # Leave this many pixels around the edge of the map when fitting it to the base and beacons
+      self.fit_paths = True # Include the beacon paths when fitting the map?
+      self.max_fit_zoom = 15 # Don't zoom in further than this when fitting the map (e.g. to a single beacon)
       self.map_type = 'hybrid' # Maps can be: roadmap , satellite , terrain or hybrid
       self.base_choice = '2\r' # Send this choice to the beacon base to request the base GNSS position etc.
       self.beacon_choice = '4\r' # Send this choice to the beacon base to request the beacon data via Iridium
       self.flush_mt_choice = '5\r' # Send this choice to the beacon base to request a flush of the mobile terminated queue
       self.power_down_choice = '6\r' # Send this choice to the beacon base to power down the 9603N
       self.send_message_choice = '7\r' # Send this to the beacon prior to sending a message for transmission
+      self.command = None # (response handler, deadline) of the command waiting for a response from the base; None if there isn't one
+      self.update_in_progress = False # Are we part way through an update?
+      self.mtq = 0 # Mobile terminated queue length reported by the most recent Iridium session
+      self.drain_mtq = True # Start extra Iridium sessions straight away while there are messages waiting in the MT queue?
+      self.max_drain_sessions = 10 # Start no more than this many extra sessions per update
+      self.drain_sessions = 0 # Number of extra sessions started during this update
       self.enable_clicks = False # Are mouse clicks enabled? False until first map has been loaded
-      self.beacons = 0 # How many beacons are currently being tracked
-      self.max_beacons = 8 # Track up to this many beacons
-      self.beacon_serials = {} # Dictionary of the serial numbers of the beacons currently being tracked
-      self.beacon_log_files = [] # List of log file names
-      self.beacon_paths = [] # List of beacon paths for Static Map
-      self.beacon_locations = [] # List of current location for each beacon
-      self.beacon_colours = ['red','yellow','green','blue','purple','gray','brown','orange'] # Colours for beacon markers and paths
+      self.beacons = BeaconRegistry() # The beacons currently being tracked (location, path, colour, log file), by serial number
+      self.show_beacons = {} # Serial number : tk.BooleanVar for the Show Beacons menu
       self.base_colour = 'white' # Use this colour for the base marker
       self.first_base = True # Is this the first time we have received a base location?
-      self.do_zoom = False # Should we set the map zoom? (When a new beacon is detected)
+      self.do_zoom = False # Should we fit the map to the base and beacons? (When a new beacon is detected)
       self.do_map_update = False # Should we update the map? (When new data is detected)
       self.offline_marker_radius = 5 # Radius of the offline marker circle (int)
-      # Limit path lengths to this many characters depending on how many beacons are being tracked
-      # (Google allows combined URLs of up to 8192 characters)
-      # The first entry is redundant (i.e. would be used when tracking zero beacons)
-      # These limits take into account that each pipe ('|') is expanded to '%7C' by urllib
-      self.max_path_lengths = [7000, 7000, 3400, 2200, 1600, 1300, 1050, 900, 780]
-
-      # Google static map API pixel scales to help with map moves
-      # https://gis.stackexchange.com/questions/7430/what-ratio-scales-do-google-maps-zoom-levels-correspond-to
-      # ---
-      # Radius of the Earth at the Equator = 6378137m
-      # Circumference at the Equator = 2*pi*r = 40075017m
-      # Zoom level 24 uses 2^32 (4294967296) pixels at circumference
-      # Pixel scale at zoom level 24 is 0.009330692m/pixel
-      # Pixel scale doubles with each zoom level
-      # Pixel scale at zoom level 21 is 0.074645535m/pixel
-      # Pixel scale at zoom level 1 is 78271.5170m/pixel
-      # ---
-      # Zoom level 24 uses 2^32 (4294967296) pixels at circumference
-      # Each pixel represents an angle of 2*pi/2^32 radians = 1.46291808e-9 radians
-      # Angle doubles with each zoom level
-      # Zoom level 21 is 1.17033446e-8 radians per pixel
-      # In degrees:
-      # Zoom level 21 is 6.70552254e-7 degrees per pixel
-      # Zoom level 1 is 0.703125 degrees per pixel
-      # ---
-      # These values need to be adjusted with increasing latitude due to the Mercator projection
-      self.scales = np.array([
-         [1,7.03125000E-01], # Zoom level 1 is 0.703125 degrees per pixel at the Equator
-         [2,3.51562500E-01],
-         [3,1.75781250E-01],
-         [4,8.78906250E-02],
-         [5,4.39453125E-02],
-         [6,2.19726562E-02],
-         [7,1.09863281E-02],
-         [8,5.49316406E-03],
-         [9,2.74658203E-03],
-         [10,1.37329102E-03],
-         [11,6.86645508E-04],
-         [12,3.43322754E-04],
-         [13,1.71661377E-04],
-         [14,8.58306885E-05],
-         [15,4.29153442E-05],
-         [16,2.14576721E-05],
-         [17,1.07288361E-05],
-         [18,5.36441803E-06],
-         [19,2.68220901E-06],
-         [20,1.34110451E-06],
-         [21,6.70552254E-07]]) # Zoom level 21 is 6.70552254e-7 degrees per pixel at the Equator
-
-      # Read the Google Static Maps API key
+      self.prefetch = True # Prefetch offline map tiles along the beacon tracks?
+      self.prefetch_seconds = 1800. # Prefetch the tiles the beacons will reach within this many seconds
+      self.prefetch_zooms = 1 # Prefetch tiles for this many zoom levels either side of the current zoom
+      self.cluster_pixels = 24 # Markers in the same cluster_pixels x cluster_pixels square of the map are shown as one cluster marker
+      self.map_cache = MapImageCache() # Recently used map images (in memory and in Map_Image_Cache)
+      self.map_fetcher = MapFetcher(self.map_cache) # Downloads the map images on a background thread so the GUI doesn't freeze
+      self.map_poll_job = None # Keep track of the timer calls which poll for the map image
+      self.local_overlay = True # Draw the markers and paths locally on the basemap? (False: Google draws them)
+      self.basemap = None # The most recent map image without markers or paths (PIL Image)
+      self.basemap_view = None # (lat, lon, zoom) of basemap
+      self.map_request_view = None # (lat, lon, zoom) of the most recent map request
+      self.shown_view = None # (lat, lon, zoom) of the map image being displayed (None if it is blank)
+      # Map update requests (from the timer, the zoom buttons and mouse clicks) which arrive within
+      # map_update_delay of each other are coalesced into a single update of the final view
+      self.map_update_delay = 300 # milliseconds
+      self.map_update_job = None # Keep track of the timer call which will do the map update
+      # Google allows combined URLs of up to 8192 characters
+      # Whatever is left after the center, markers, zoom, size, maptype and key is shared between the beacon paths
+      # (beacons with short paths get all they need; the rest is shared giving priority to recently updated beacons)
+      self.max_url_length = 8000 # Leave a little margin
+
+      # Map pixel positions are converted to and from lat, lon using the Web Mercator projection (see Web_Mercator.py)
+
+      # Check for local XYZ map tiles
+      self.tile_provider = find_tile_provider(self.frame_width, self.frame_height) # None if there are none: use Google Static Maps
+      if self.tile_provider is not None:
+         print 'Using local map tiles (zoom levels',self.tile_provider.available,') instead of Google Static Maps'
+         print
+
+      # Read the Google Static Maps API key (not needed if we are using local map tiles)
       # Create one using: https://developers.google.com/maps/documentation/static-maps/get-api-key
       try:
          with open('Google_Static_Maps_API_Key.txt', 'r') as myfile:
             self.key = myfile.read().replace('\n', '')
             myfile.close()
       except:
-         print 'Could not read the API key!'
-         print 'Create one here: https://developers.google.com/maps/documentation/static-maps/get-api-key'
-         print 'then copy and paste it into a file called Google_Static_Maps_API_Key.txt'
-         raise ValueError('Could not read API Key!')
+         if self.tile_provider is None:
+            print 'Could not read the API key!'
+            print 'Create one here: https://developers.google.com/maps/documentation/static-maps/get-api-key'
+            print 'then copy and paste it into a file called Google_Static_Maps_API_Key.txt'
+            raise ValueError('Could not read API Key!')
+         self.key = ''
 
       # Get the serial port name
       if platform.startswith('linux'):
@@ -208,30 +236,24 @@ class BeaconBase(object):
       except:
          raise NameError('COULD NOT OPEN SERIAL PORT!')
       self.ser.flushInput() # Flush RX buffer
+      self.serial = SerialLineReader(self.ser) # Read the responses on a background thread
 
       # Check for offline map tiles
       print 'Looking for offline map tiles...'
-      self.tile_num = 0 # tile number
-      self.tile_filenames = [] # tile long filenames
-      self.tile_lats = [] # tile latitudes
-      self.tile_lons = [] # tile longitudes
-      self.tile_zooms = [] # tile zooms
-      for root, dirs, files in os.walk("."):
-         if len(files) > 0:
-            #if root != ".": # Ignore files in this directory - only process subdirectories
-            #if root == ".": # Ignore subdirectories - only process this directory
-               for filename in files:
-                  if (filename[:13] == 'StaticMapTile') and (filename[-4:] == '.png'): # check for tile file
-                     fields = filename.split("_") # split the filename into fields
-                     longfilename = os.path.join(root, filename)
-                     self.tile_filenames.append(longfilename) # add the filename to the dictionary
-                     self.tile_zooms.append(fields[2])
-                     self.tile_lats.append(float(fields[4]))
-                     self.tile_lons.append(float(fields[6]))
-                     self.tile_num += 1 # increment the tile number
-      print 'Found',self.tile_num,'offline map tiles'
+      self.offline_tiles = OfflineTileIndex(self.frame_width, self.frame_height) # spatial index of the tiles
+      self.prefetch = self.prefetch and (self.tile_provider is None) # Prefetching is only needed if we are using Google Static Maps
+      self.offline_package = None
+      if os.path.isfile(package_filename) or self.prefetch: # (The package is created if we are going to prefetch tiles into it)
+         self.offline_package = StaticMapTilePackage(package_filename)
+         self.offline_tiles.add_package(self.offline_package) # Read the zoom and center of every tile from the package index
+      print 'Found',len(self.offline_tiles),'offline map tiles'
       print
 
+      # Prefetch offline map tiles into the package
+      self.prefetcher = None
+      if self.prefetch:
+         self.prefetcher = TilePrefetcher(package_filename, cache=self.map_cache, busy=self.map_fetcher.waiting)
+
       # Create and clear the console log file
       tn = time.localtime() # Extract the time and date as strings
       date_str = str(tn[0])+str(tn[1]).zfill(2)+str(tn[2]).zfill(2)
@@ -266,8 +288,8 @@ class BeaconBase(object):
       # Load default blank image into imageFrame
       # Image must be self.frame_width x self.frame_height pixels
       filename = "map_image_blank.png"
-      image = Image.open(filename)
-      photo = ImageTk.PhotoImage(image)
+      self.blank_image = Image.open(filename) # Keep the blank image so it can be reused if there is no map to display
+      photo = ImageTk.PhotoImage(self.blank_image)
       self.label = tk.Label(self.imageFrame,image=photo)
       self.label.pack(fill=tk.BOTH) # Make the image fill the frame
       self.image = photo # Store the image to avoid garbage collection
@@ -494,6 +516,14 @@ class BeaconBase(object):
       self.menubar.add_cascade(label="Beacon Locations", menu=self.beacon_menu)
       self.window.config(menu=self.menubar)
 
+      # Menu to show or hide the beacons on the map
+      self.show_menu = tk.Menu(self.menubar, tearoff=0)
+      self.menubar.add_cascade(label="Show Beacons", menu=self.show_menu)
+      self.show_menu.add_command(label="Show All",command=lambda: self.show_all_beacons(True))
+      self.show_menu.add_command(label="Hide All",command=lambda: self.show_all_beacons(False))
+      self.show_menu.add_separator()
+      self.window.config(menu=self.menubar)
+
       # Menu to list base location
       self.base_menu = tk.Menu(self.menubar, tearoff=0)
       self.menubar.add_cascade(label="Base Location", menu=self.base_menu)
@@ -510,6 +540,9 @@ class BeaconBase(object):
       self.interval_menu = tk.Menu(self.menubar, tearoff=0)
       self.menubar.add_cascade(label="Set Update Interval", menu=self.interval_menu)
       self.window.config(menu=self.menubar)
+
+      # Menu command to fit the map to the base and all the beacons
+      self.menubar.add_command(label="Fit All", command=self.fit_all)
       # Add intervals
       for update_interval in self.update_intervals:
          interval_str = str(update_interval)
@@ -521,6 +554,7 @@ class BeaconBase(object):
 
       # Timer
       self.window.after(2000,self.timer) # First timer event after 2 secs
+      self.window.after(50,self.poll_serial) # Check for serial responses every 0.05s
 
       # Start GUI
       self.window.mainloop()
@@ -530,18 +564,20 @@ class BeaconBase(object):
       do_update = False # Flag to indicate if an update is required
       now = time.time() # Get the current time      
       time_since_last_update = now - self.last_update_at # Calculate interval since last update
-      last_update_str = time.strftime('%H:%M:%S', time.gmtime(time_since_last_update))
-      self.time_since_last_update.configure(state='normal') # Unlock entry box
-      self.time_since_last_update.delete(0, tk.END) # Delete existing value
-      self.time_since_last_update.insert(0, last_update_str) # Update the indicated time since last update
-      self.time_since_last_update.config(state='readonly') # Lock entry box
+      if not self.update_in_progress: # (Leave 'In Progress...' showing during an update)
+         last_update_str = time.strftime('%H:%M:%S', time.gmtime(time_since_last_update))
+         self.time_since_last_update.configure(state='normal') # Unlock entry box
+         self.time_since_last_update.delete(0, tk.END) # Delete existing value
+         self.time_since_last_update.insert(0, last_update_str) # Update the indicated time since last update
+         self.time_since_last_update.config(state='readonly') # Lock entry box
 
       # Check if it is time to do an update
       # Do an update if it has been at least interval seconds since the last update
       # and there are no message boxes open
       # or this is the first update
+      # (but not while the base is still busy with a command)
       interval = sum(float(n) * m for n, m in zip(reversed(self.interval.get().split(':')), (1, 60, 3600))) # https://stackoverflow.com/a/45971056
-      if ((time_since_last_update >= interval) and (self.message_boxes_open == 0)) or (self.first_update == True): 
+      if (self.command is None) and (not self.update_in_progress) and (((time_since_last_update >= interval) and (self.message_boxes_open == 0)) or (self.first_update == True)):
          do_update = True # Do update
          self.first_update = False # Clear flag
          self.last_update_at = now # Update time of last update
@@ -555,22 +591,39 @@ class BeaconBase(object):
          # Disable Flush_MT and Message_Menu during update
          self.flush_mt_button.config(state='disabled') # Disable Flush MT button
          self.menubar.entryconfig("Beacon Messaging", state='disabled') # Disable Beacon Messaging
-         self.get_base_location() # Read 'base_location' from Beacon Base GNSS
-         self.get_beacon_data() # Contact Iridium and download a new message (if available)
-         self.distance_between() # Update distance
-         self.course_to() # Update heading
-         if self.do_zoom: # Do we need to update the zoom?
-            self.update_zoom() # Update zoom
-            self.do_zoom = False
-         if self.do_map_update: # Do we need to update the map?
-            self.update_map() # Update the Google Static Maps image
-            self.do_map_update = False
-         # Enable Flush_MT and Message_Menu after update
-         self.flush_mt_button.config(state='active') # Enable Flush MT button
-         self.menubar.entryconfig("Beacon Messaging", state='active') # Enable Beacon Messaging
+         self.update_in_progress = True
+         self.get_base_location() # Read 'base_location' from Beacon Base GNSS; then get_beacon_data; then finish_update
+
+      # Add any prefetched tiles to the offline map
+      if self.prefetcher is not None:
+         for tile_id, lat, lon, zoom in self.prefetcher.completed():
+            self.offline_tiles.add((self.offline_package, tile_id), lat, lon, zoom)
 
       self._job = self.window.after(250, self.timer) # Schedule another timer event in 0.25s
 
+   def finish_update(self):
+      ''' Finish the update once the base location and beacon data have been received (or timed out).
+      Start another Iridium session straight away if there are more messages waiting in the MT queue '''
+      self.distance_between() # Update distance
+      self.course_to() # Update heading
+      if self.do_zoom: # Do we need to update the center and zoom?
+         self.fit_all() # Fit the map to the base and all the beacons
+         self.do_zoom = False
+      if self.do_map_update: # Do we need to update the map?
+         self.request_map_update() # Update the Google Static Maps image
+         self.do_map_update = False
+      if self.drain_mtq and (self.mtq > 0) and (self.drain_sessions < self.max_drain_sessions):
+         self.drain_sessions += 1
+         console_message = 'Messages waiting (MTQ ' + str(self.mtq) + '): starting session ' + str(self.drain_sessions) + ' of ' + str(self.max_drain_sessions)
+         self.writeToConsole(self.console_1, console_message) # Update message console
+         self.get_beacon_data() # Skip the base location; then finish_update again
+         return
+      self.drain_sessions = 0
+      # Enable Flush_MT and Message_Menu after update
+      self.flush_mt_button.config(state='active') # Enable Flush MT button
+      self.menubar.entryconfig("Beacon Messaging", state='active') # Enable Beacon Messaging
+      self.update_in_progress = False
+
    def get_base_location(self):
       ''' Talk to Beacon Base using serial; get current base location '''
       # Base will respond with:
@@ -578,7 +631,10 @@ class BeaconBase(object):
       # or an error message starting with "ERROR".
       console_message = 'Requesting base location (could take ' + str(self.gnss_timeout) + 's)'
       self.writeToConsole(self.console_1, console_message) # Update message console
-      resp = self.writeWait(self.base_choice, self.gnss_timeout) # Send menu choice '1'; wait for response for gnss_timeout seconds
+      self.send_command(self.base_choice, self.gnss_timeout, self.base_location_received) # Send menu choice '2'; wait for response for gnss_timeout seconds
+
+   def base_location_received(self, resp):
+      ''' Process the base location response (resp is '' if there wasn't one); then get the beacon data '''
       if resp != '': # Did we get a response?
          try:
             self.writeToConsole(self.console_2,resp[:-2]) # If we did, copy it into the console
@@ -623,6 +679,7 @@ class BeaconBase(object):
                self.writeToConsole(self.console_1, 'ERROR received!') # Update message console
       else:
          self.writeToConsole(self.console_1, 'No serial data received!') # Update message console
+      self.get_beacon_data() # Contact Iridium and download a new message (if available)
 
    def get_beacon_data(self):
       ''' Talk to Beacon Base using serial; start Iridium session and download new data '''
@@ -636,7 +693,11 @@ class BeaconBase(object):
       # If the RockBLOCK option wasn't selected, the serial number will be missing and the parse will fail.
       console_message = 'Requesting beacon data (could take ' + str(self.beacon_timeout) + 's)'
       self.writeToConsole(self.console_1, console_message) # Update message console
-      resp = self.writeWait(self.beacon_choice, self.beacon_timeout) # Send menu choice '3'; wait for response for beacon_timeout secs
+      self.mtq = 0 # (Stays 0 if there is no response or an ERROR so we don't keep trying)
+      self.send_command(self.beacon_choice, self.beacon_timeout, self.beacon_data_received) # Send menu choice '4'; wait for response for beacon_timeout secs
+
+   def beacon_data_received(self, resp):
+      ''' Process the beacon data response (resp is '' if there wasn't one); then finish the update '''
       if resp != '': # Did we get a response?
          try:
             self.writeToConsole(self.console_2,resp[:-2]) # If we did, copy it into the console
@@ -659,42 +720,24 @@ class BeaconBase(object):
                   if (len(parse) >= 14) and (len(parse[0]) == 14): # DateTime should always be 14 characters
                      # If DateTime is the correct length, assume the rest of the response contains valid data
                      # Update beacon Mobile Terminated Queue length
-                     self.beacon_MTQ.config(state='normal')
-                     self.beacon_MTQ.delete(0, tk.END)
-                     self.beacon_MTQ.insert(0, parse[13])
-                     self.beacon_MTQ.config(state='readonly')
-                     if (int(parse[13]) > 0):
-                        self.beacon_MTQ_txt.config(background='black',foreground='white')
-                     else:
-                        self.beacon_MTQ_txt.config(background=self.background,foreground=self.foreground)
+                     self.show_mtq(int(parse[13]))
                      # Have we seen data from this beacon before?
-                     if self.beacon_serials.has_key(parse[12]):
-                        pass # We have seen this one before
-                     else:
-                        # This is a new beacon
-                        # Check that we haven't reached the maximum number of beacons
-                        if self.beacons < self.max_beacons:
-                           # Maximum hasn't been reached so get things ready for this new beacon
-                           self.beacon_serials[parse[12]] = self.beacons # Add this serial number and its beacon number
-                           self.beacon_log_files.append('') # Append a NULL filename for this beacon
-                           self.beacon_paths.append('&path=color:'+self.beacon_colours[self.beacons]+'|weight:5') # Append an empty path for this beacon
-                           self.beacon_locations.append('') # Append a NULL location for this beacon
-                           self.beacons += 1 # Increment the number of beacons being tracked
-                           # This is a new beacon so center map on its location this time only
-                           self.map_lat = float(parse[1])
-                           self.map_lon = float(parse[2])
-                           self.do_zoom = True
-                           console_message = 'New beacon found (' + parse[12] + ')'
-                           self.writeToConsole(self.console_1, console_message) # Update message console
-                           # Add it to the Beacon Location menu
-                           # https://stackoverflow.com/q/7542164
-                           ser_no = parse[12]
-                           self.beacon_menu.add_command(label=ser_no,command=lambda ser_no=ser_no: self.copy_location(ser_no))
-                           self.message_menu.add_command(label=ser_no,command=lambda ser_no=ser_no: self.send_message(ser_no))
-                        else:
-                           # Return now - maximum has been reached - don't process data from this beacon
-                           self.writeToConsole(self.console_1, 'Beacon limit reached!') # Update message console
-                           return
+                     beacon = self.beacons.get(parse[12])
+                     if beacon is None:
+                        # This is a new beacon so get things ready for it
+                        beacon = self.beacons.add(parse[12]) # Empty path, NULL location and NULL log file name
+                        # This is a new beacon so fit the map to the base and all the beacons this time only
+                        self.do_zoom = True
+                        console_message = 'New beacon found (' + parse[12] + ')'
+                        self.writeToConsole(self.console_1, console_message) # Update message console
+                        # Add it to the Beacon Location, Show Beacons and Beacon Messaging menus
+                        # https://stackoverflow.com/q/7542164
+                        ser_no = parse[12]
+                        self.beacon_menu.add_command(label=ser_no,command=lambda ser_no=ser_no: self.copy_location(ser_no))
+                        self.show_beacons[ser_no] = tk.BooleanVar(value=True)
+                        self.show_menu.add_checkbutton(label=ser_no,variable=self.show_beacons[ser_no],background=beacon.colour,
+                                                       command=lambda ser_no=ser_no: self.show_beacon(ser_no))
+                        self.message_menu.add_command(label=ser_no,command=lambda ser_no=ser_no: self.send_message(ser_no))
                      # Construct 'base_time' in HH:MM:SS format
                      time_str = parse[0][8:10] + ':' + parse[0][10:12] + ':' + parse[0][12:]
                      self.beacon_time.config(state='normal') # Unlock beacon_time
@@ -703,21 +746,17 @@ class BeaconBase(object):
                      self.beacon_time.config(state='readonly') # Lock beacon_time
                      # Construct 'beacon_location' in lat,lon (float) format
                      beacon_location = parse[1] + ',' + parse[2]
-                     self.beacon_locations[self.beacon_serials[parse[12]]] = beacon_location # Update location for this beacon
+                     beacon.location = beacon_location # Update location for this beacon
                      self.beacon_location.config(state='normal')
                      self.beacon_location.delete(0, tk.END)
                      self.beacon_location.insert(0, beacon_location)
                      self.beacon_location.config(state='readonly')
-                     self.beacon_location_txt.config(background=self.beacon_colours[self.beacon_serials[parse[12]]])
+                     self.beacon_location_txt.config(background=beacon.colour)
                      # Update beacon path (append this location to the path for this beacon)
-                     self.beacon_paths[self.beacon_serials[parse[12]]] += '|' + beacon_location
-                     # Check path length hasn't exceeded the maximum
-                     def find_char(s, ch): # https://stackoverflow.com/a/11122355
-                        return [i for i, ltr in enumerate(s) if ltr == ch]
-                     while len(self.beacon_paths[self.beacon_serials[parse[12]]]) > self.max_path_lengths[self.beacons]:
-                        # Delete path from second to third pipe character ('|') (first '|' preceeds the line weight)
-                        pipes = find_char(self.beacon_paths[self.beacon_serials[parse[12]]],'|')
-                        self.beacon_paths[self.beacon_serials[parse[12]]] = self.beacon_paths[self.beacon_serials[parse[12]]][:pipes[1]] + self.beacon_paths[self.beacon_serials[parse[12]]][pipes[2]:]
+                     # (the oldest waypoints are left out of the map URL if there isn't room for them)
+                     beacon.track.append(float(parse[1]), float(parse[2]))
+                     beacon.speed = float(parse[4]) # Used to prefetch the offline map tiles
+                     beacon.heading = float(parse[5])
                      # Update beacon_altitude
                      self.beacon_altitude.config(state='normal')
                      self.beacon_altitude.delete(0, tk.END)
@@ -755,22 +794,23 @@ class BeaconBase(object):
                      self.beacon_serial_no.config(state='readonly')
                      # Update Beacon Location menu
                      label_str = parse[12] + ' : ' + beacon_location
-                     self.beacon_menu.entryconfig(self.beacon_serials[parse[12]], label=label_str, background=self.beacon_colours[self.beacon_serials[parse[12]]])
+                     self.beacon_menu.entryconfig(beacon.number, label=label_str, background=beacon.colour)
                      # Update Send Message menu
-                     # Add 1 to parse[12] to account for RB0000000 entry
-                     self.message_menu.entryconfig(self.beacon_serials[parse[12]] + 1, background=self.beacon_colours[self.beacon_serials[parse[12]]])
+                     # Add 1 to the beacon number to account for RB0000000 entry
+                     self.message_menu.entryconfig(beacon.number + 1, background=beacon.colour)
                      # Check if the log file is empty (file name is NULL)
-                     if self.beacon_log_files[self.beacon_serials[parse[12]]] == '':
+                     if beacon.log_file == '':
                         # Create and clear the log file
                         # Construct the filename from the beacon GNSS datetime and the beacon serial number
-                        self.beacon_log_files[self.beacon_serials[parse[12]]] = 'Beacon_Log_' + parse[0] + '_' + parse[12] + '.csv'
-                        self.fp = open(self.beacon_log_files[self.beacon_serials[parse[12]]], 'wb') # Create / clear the file
+                        beacon.log_file = 'Beacon_Log_' + parse[0] + '_' + parse[12] + '.csv'
+                        self.fp = open(beacon.log_file, 'wb') # Create / clear the file
                         self.fp.close()
                      # Now that the log file exists, append the new beacon data
-                     self.fp = open(self.beacon_log_files[self.beacon_serials[parse[12]]], 'ab') # Open log file for append in binary mode
+                     self.fp = open(beacon.log_file, 'ab') # Open log file for append in binary mode
                      self.fp.write(resp) # Write the beacon response to the log file
                      self.fp.close() # Close the log file
                      self.do_map_update = True # Update map with new beacon data
+                     self.prefetch_tiles(beacon) # Prefetch the offline map tiles along this beacon's track
                      self.writeToConsole(self.console_1, 'Beacon data received') # Update message console
                except:
                   self.writeToConsole(self.console_1, 'Serial parse failed!') # Update message console
@@ -783,14 +823,7 @@ class BeaconBase(object):
                      parse = resp[:-2].split(',') # Try parsing the response
                      if (len(parse) >= 2):
                         # Update beacon Mobile Terminated Queue length
-                        self.beacon_MTQ.config(state='normal')
-                        self.beacon_MTQ.delete(0, tk.END)
-                        self.beacon_MTQ.insert(0, parse[1])
-                        self.beacon_MTQ.config(state='readonly')
-                        if (int(parse[1]) > 0):
-                           self.beacon_MTQ_txt.config(background='black',foreground='white')
-                        else:
-                           self.beacon_MTQ_txt.config(background=self.background,foreground=self.foreground)
+                        self.show_mtq(int(parse[1]))
                   except:
                      self.writeToConsole(self.console_1, 'Serial parse failed!') # Update message console
          else:
@@ -804,24 +837,17 @@ class BeaconBase(object):
                # MTQ should be zero (otherwise a full response should have been received)
                # but we'll give it the benefit of doubt and process it as if it could be non-zero:
                # Update beacon Mobile Terminated Queue length
-               self.beacon_MTQ.config(state='normal')
-               self.beacon_MTQ.delete(0, tk.END)
-               self.beacon_MTQ.insert(0, str(mtq))
-               self.beacon_MTQ.config(state='readonly')
-               if (mtq > 0):
-                  self.beacon_MTQ_txt.config(background='black',foreground='white')
-               else:
-                  self.beacon_MTQ_txt.config(background=self.background,foreground=self.foreground)
+               self.show_mtq(mtq)
                self.writeToConsole(self.console_1, 'No beacon data - only MTQ received') # Update message console
       else:
          self.writeToConsole(self.console_1, 'No serial data received!') # Update message console
+      self.finish_update()
 
    def distance_between(self):
       ''' Calculate distance. Gratefully plagiarised from Mikal Hart's TinyGPS. '''
       # https://github.com/mikalhart/TinyGPS/blob/master/TinyGPS.cpp
       # Calculate the great circle distance between 'base_location' and 'beacon_location'
       # See https://en.wikipedia.org/wiki/Great-circle_distance#Computational_formulas
-      self.delta = 0.0 # Clear delta
       try: # Read base_location from entry box
          lat1,long1 = self.base_location.get().split(',')
          lat1 = math.radians(float(lat1))
@@ -842,7 +868,6 @@ class BeaconBase(object):
       self.distance_to_beacon.delete(0,tk.END) # Delete old distance
       self.distance_to_beacon.insert(0,str(int(delta * 6378137.))) # Set distance
       self.distance_to_beacon.configure(state='readonly') # Lock entry box
-      self.delta = math.degrees(delta) # Store the delta in degrees so update_zoom can use it
 
    def calculate_delta(self,lat1,long1,lat2,long2):
       ''' Calculate delta (angle) between lat1,long1 and lat2,long2. All values are in radians. '''
@@ -889,141 +914,236 @@ class BeaconBase(object):
       self.course_to_beacon.insert(0, str(int(math.degrees(a2)))) # Set heading
       self.course_to_beacon.configure(state='readonly') # Lock entry box
 
-   def update_zoom(self):
-      ''' Update Google StaticMap zoom based on angular separation of base_location and beacon_location '''
-      # ** Run after distance_between() : requires updated self.delta **
-      # delta is the angular separation of base_location and beacon_location
-
-      adjusted_scales = np.array(self.scales) # Make a copy of the zoom vs pixel scale angle look-up table
-      # Calculate latitude scale multiplier based on current latitude to correct for Mercator projection
-      scale_multiplier_lat = math.cos(math.radians(self.map_lat))
-      # Adjust the pixel scale angles in the zoom look up table to compensate for latitude
-      # And convert them into angular limits for delta by also multiplying by delta_limit_pixels
-      for entry in adjusted_scales:
-         entry[1] = entry[1] * scale_multiplier_lat * self.delta_limit_pixels
-      # Now set map zoom based on delta between base and beacon
-      if (self.delta > adjusted_scales[0][1]): # Is delta greater than the useful radius for zoom 1?
-         self.zoom = str('0') # If it is: set zoom 0
-      else:
-         # Else: set zoom to the lowest zoom level which will display this delta
-         # Only zoom out, don't zoom in
-         min_zoom = int(adjusted_scales[np.where(self.delta<=adjusted_scales[:,1])][-1][0])
-         if min_zoom < int(self.zoom):
-            self.zoom = str(min_zoom)
+   def fit_all(self):
+      ''' Center and zoom the map so it shows the base, all the visible beacons and (if fit_paths) their paths '''
+      lats = []
+      lons = []
+      if self.base_location.get() != '': # Do we have a valid base location?
+         base_lat,base_lon = self.base_location.get().split(',')
+         lats.append([float(base_lat)])
+         lons.append([float(base_lon)])
+      for beacon in self.beacons.visible():
+         if beacon.location != '':
+            beacon_lat,beacon_lon = beacon.latlon()
+            lats.append([beacon_lat])
+            lons.append([beacon_lon])
+         if self.fit_paths and (len(beacon.track) > 0):
+            path_lats, path_lons = beacon.track.waypoints()
+            lats.append(path_lats)
+            lons.append(path_lons)
+      if len(lats) == 0: # Nothing to fit
+         return
+      self.writeToConsole(self.console_1, 'Fitting map') # Update message console
+      self.map_lat, self.map_lon, zoom = fit_bounds(np.concatenate(lats), np.concatenate(lons),
+                                                    self.frame_width - (2 * self.fit_margin), self.frame_height - (2 * self.fit_margin))
+      self.zoom = str(min(zoom, self.max_fit_zoom))
+      self.request_map_update()
+
+   def prefetch_tiles(self, beacon):
+      ''' Queue the offline map tiles around this beacon and along its projected track for prefetching '''
+      if (self.prefetcher is None) or (beacon.location == ''):
+         return
+      lat, lon = beacon.latlon()
+      tiles = []
+      for tile_lat, tile_lon, zoom in plan_prefetch(lat, lon, beacon.speed, beacon.heading, int(self.zoom), self.frame_width, self.frame_height,
+                                                    self.prefetch_seconds, self.prefetch_zooms):
+         if len(self.offline_tiles.covering(tile_lat, tile_lon, zoom)) == 0: # Skip any tiles we already have
+            tiles.append((self.tile_url(tile_lat, tile_lon, zoom), tile_lat, tile_lon, zoom))
+      self.prefetcher.request(tiles)
+
+   def tile_url(self, lat, lon, zoom):
+      ''' Google Static Maps URL for an offline map tile (no markers or paths) centered on lat, lon at this zoom '''
+      tile_url = 'https://maps.googleapis.com/maps/api/staticmap?center='
+      tile_url += ("%.6f"%lat) + ',' + ("%.6f"%lon)
+      tile_url += '&zoom=' + str(zoom)
+      tile_url += '&size=' + str(self.frame_width) + 'x' + str(self.frame_height)
+      tile_url += '&maptype=' + self.map_type + '&format=png&key=' + self.key
+      return tile_url
+
+   def request_map_update(self):
+      ''' Request a map update. The update is done once no more requests have arrived for map_update_delay '''
+      if self.map_update_job is not None: # Is an update already waiting?
+         self.window.after_cancel(self.map_update_job) # Restart the wait
+      self.map_update_job = self.window.after(self.map_update_delay, self.run_map_update)
+
+   def run_map_update(self):
+      ''' Timer function - update the map once the requests have stopped arriving '''
+      self.map_update_job = None
+      self.update_map()
+
+   def current_view(self):
+      ''' Return the (lat, lon, zoom) the map should show. lat and lon are rounded the same way as the map center '''
+      return (round(self.map_lat, 6), round(self.map_lon, 6), int(self.zoom))
 
    def update_map(self):
       ''' Show base location, beacon locations and the beacon routes using Google Static Maps API '''
 
       self.writeToConsole(self.console_1, 'Updating map') # Update message console      
 
+      if self.tile_provider is not None: # Are we using local map tiles?
+         self.show_local_map()
+         return
+
       # Assemble map center
-      center = ("%.6f"%self.map_lat) + ',' + ("%.6f"%self.map_lon)
+      view = self.current_view()
+      center = ("%.6f"%view[0]) + ',' + ("%.6f"%view[1])
+
+      map_params = '&zoom=' # 8 chars
+      map_params += self.zoom
+      map_params += '&size=' # 13 chars
+      map_params += str(self.frame_width)
+      map_params += 'x'
+      map_params += str(self.frame_height)
+      map_params += '&maptype=' + self.map_type + '&format=png&key=' # 35 chars
+      map_params += self.key # 40 chars
 
       # Update the Google Maps API StaticMap URL
       self.path_url = 'https://maps.googleapis.com/maps/api/staticmap?center=' # 54 chars
       self.path_url += center # 22 chars
-      if self.base_location.get() != '': # Do we have a valid base location?
-         self.path_url += '&markers=color:' + self.base_colour + '|' + self.base_location.get() # 15+6+3+22 chars
-      if self.beacons > 0: # Do we have any valid beacons?
-         for beacon in range(self.beacons):
-            self.path_url += '&markers=color:' + self.beacon_colours[beacon] + '|' # beacons*(15+6+3+22) chars
-            self.path_url += self.beacon_locations[beacon]
-         # Path 'header' is 29 chars
-         # Minimum length for each waypoint is 18 chars but will grow to 20 when pipe is expanded
-         # This needs to be included in the max_path_length
-         for beacon in range(self.beacons): 
-            self.path_url += self.beacon_paths[beacon]
-      self.path_url += '&zoom=' # 8 chars
-      self.path_url += self.zoom
-      self.path_url += '&size=' # 13 chars
-      self.path_url += str(self.frame_width)
-      self.path_url += 'x'
-      self.path_url += str(self.frame_height)
-      self.path_url += '&maptype=' + self.map_type + '&format=png&key=' # 35 chars
-      self.path_url += self.key # 40 chars
-
-      # Download the API map image from Google
-      filename = "map_image.png" # Download map to this file
-      try:
-         urllib.urlretrieve(self.path_url, filename) # Attempt map image download
+      self.map_request_view = view
+      if self.local_overlay: # Only download the basemap - the markers and paths are drawn locally
+         if (self.basemap is not None) and (self.map_request_view == self.basemap_view): # Has the view changed?
+            # No: just redraw the markers and paths on the basemap we already have
+            self.map_fetcher.cancel() # Any download which hasn't completed yet is now stale
+            self.display_image(self.overlay_basemap(), self.basemap_view)
+            return
+      else:
+         # Add the base and beacon markers (clustered for this zoom): clusters*(15+8+9+22) chars
+         for lat, lon, colour, count in self.map_markers(view[2]):
+            marker = marker_parameter(lat, lon, static_maps_colour(colour), count)
+            # Leave out any markers which won't fit (the URL is limited to max_url_length once escaped)
+            if len((self.path_url + marker + map_params).replace('|', '%7C')) <= self.max_url_length:
+               self.path_url += marker
+         beacons = self.beacons.visible() # Only the beacons being viewed go into the URL
+         if len(beacons) > 0: # Do we have any valid beacons?
+            # Share whatever is left of the URL between the beacon paths
+            # Pipes ('|') are counted as the three characters of '%7C'
+            # Each waypoint is encoded as a polyline offset from the previous one (typically 4-10 chars once escaped)
+            max_length = self.max_url_length - len((self.path_url + map_params).replace('|', '%7C'))
+            # The paths are simplified for this zoom first so only the visible shape uses up the URL
+            self.path_url += build_paths([beacon.track for beacon in beacons], [static_maps_colour(beacon.colour) for beacon in beacons],
+                                         max_length, view[2])
+      self.path_url += map_params
+
+      # Have we downloaded this exact map before? If we have, display it straight away
+      data = self.map_cache.get(self.path_url)
+      if data is not None:
+         self.map_fetcher.cancel() # Any download which hasn't completed yet is now stale
+         self.show_map(data)
+         return
+
+      # Download the API map image from Google on the background thread
+      # Any earlier download which hasn't completed yet is now stale and will be ignored
+      self.map_fetcher.request(self.path_url)
+      if self.map_poll_job is None: # Start polling for the image (if we aren't already)
+         self.map_poll_job = self.window.after(50, self.poll_map)
+
+   def poll_map(self):
+      ''' Timer function - check if the map image download has completed and display it if it has '''
+      result = self.map_fetcher.poll()
+      if result is not None: # Has the download completed?
+         self.map_poll_job = None
+         self.show_map(result[0])
+      elif self.map_fetcher.waiting(): # Still downloading?
+         self.map_poll_job = self.window.after(50, self.poll_map) # Check again in 0.05s
+      else: # Download was cancelled
+         self.map_poll_job = None
+
+   def show_map(self, data):
+      ''' Display the downloaded map image (data); or an offline map tile if the download failed (data is None) '''
+      # Images are decoded straight from memory: there is no temporary map_image.png file
+      image = None
+      if data is not None: # Did the map image download succeed?
+         try:
+            image = Image.open(io.BytesIO(data))
+            image.load() # Decode it now so a corrupt image is caught here
+         except IOError:
+            image = None
+      if image is not None: # Do we have a valid map image?
+         if self.local_overlay: # Keep the basemap and draw the markers and paths on it
+            self.basemap = image.convert("RGBA")
+            self.basemap_view = self.map_request_view
+            image = self.overlay_basemap()
+         view = self.map_request_view
          # Enable zoom buttons and mouse clicks since valid map was downloaded
          self.zoom_in_button.config(state='normal') # Enable zoom+
          self.zoom_out_button.config(state='normal') # Enable zoom-
          self.enable_clicks = True # Enable mouse clicks
-      except:
+      else:
          self.writeToConsole(self.console_1, 'Map image download failed!') # Update message console
          # Check if we have any offline files
-         if (self.tile_num > 0):
-            # we have offline tiles so choose the one closest to the map center
-            distances = []
-            for tile in range(self.tile_num):
-               distances.append(self.calculate_delta(math.radians(self.map_lat),math.radians(self.map_lon),math.radians(self.tile_lats[tile]),math.radians(self.tile_lons[tile])) * 6378137.)
-            distances = np.array(distances) # convert to numpy array for argmin
-            tile = distances.argmin()
-            # copy chosen tile into map_image.png
-            copyfile(self.tile_filenames[tile], 'map_image.png')
-            # update map lat, lon and zoom
-            self.map_lat = self.tile_lats[tile]
-            self.map_lon = self.tile_lons[tile]
-            self.zoom = self.tile_zooms[tile]
-            # add markers to image
-            # https://infohost.nmt.edu/tcc/help/pubs/pil/image-draw.html
-            # open the image
-            im = Image.open("map_image.png").convert("RGBA")
-            draw = ImageDraw.Draw(im) # instantiate the Draw object
-            if self.base_location.get() != '': # check if base location is known
-               base_lat,base_lon = self.base_location.get().split(',') # get base lat and lon
-               base_lat = float(base_lat) # convert lat to float
-               base_lon = float(base_lon) # convert lon to float
-               pixel_scale = self.scales[np.where(self.scales[:,0]==float(self.zoom))][0][1]
-               x_dist = base_lon - self.map_lon # calculate x offset from tile centre in degrees
-               x_dist = x_dist / pixel_scale # convert x offset into pixels
-               pixel_scale = pixel_scale * math.cos(math.radians(self.map_lat)) # Adjust the pixel scale to compensate for latitude
-               y_dist = base_lat - self.map_lat # calculate y offset from tile centre in degrees
-               y_dist = y_dist / pixel_scale # convert y offset into pixels
-               # check if the base can be shown on this tile
-               if (abs(y_dist) < ((self.frame_height / 2) - (2 * self.offline_marker_radius))) and (abs(x_dist) < ((self.frame_width / 2) - (2 * self.offline_marker_radius))):
-                  # calculate the bounding box top left
-                  bby = int((self.frame_height / 2) - (y_dist + self.offline_marker_radius))
-                  bbx = int((self.frame_width / 2) + x_dist - self.offline_marker_radius)
-                  # add the marker (circle)
-                  draw.ellipse([(bbx,bby),((bbx + (2 * self.offline_marker_radius)),(bby + (2 * self.offline_marker_radius)))],fill=self.base_colour,outline="black")
-            if self.beacons > 0: # Do we have any valid beacons?
-               for beacon in range(self.beacons):
-                  beacon_lat,beacon_lon = self.beacon_locations[beacon].split(',') # get beacon lat and lon
-                  beacon_lat = float(beacon_lat) # convert lat to float
-                  beacon_lon = float(beacon_lon) # convert lon to float
-                  pixel_scale = self.scales[np.where(self.scales[:,0]==float(self.zoom))][0][1]
-                  x_dist = beacon_lon - self.map_lon # calculate x offset from tile centre in degrees
-                  x_dist = x_dist / pixel_scale # convert x offset into pixels
-                  pixel_scale = pixel_scale * math.cos(math.radians(self.map_lat)) # Adjust the pixel scale to compensate for latitude
-                  y_dist = beacon_lat - self.map_lat # calculate y offset from tile centre in degrees
-                  y_dist = y_dist / pixel_scale # convert y offset into pixels
-                  # check if the beacon can be shown on this tile
-                  if (abs(y_dist) < ((self.frame_height / 2) - (2 * self.offline_marker_radius))) and (abs(x_dist) < ((self.frame_width / 2) - (2 * self.offline_marker_radius))):
-                     # calculate the bounding box top left
-                     bby = int((self.frame_height / 2) - (y_dist + self.offline_marker_radius))
-                     bbx = int((self.frame_width / 2) + x_dist - self.offline_marker_radius)
-                     # add the marker (circle)
-                     draw.ellipse([(bbx,bby),((bbx + (2 * self.offline_marker_radius)),(bby + (2 * self.offline_marker_radius)))],fill=self.beacon_colours[beacon],outline="black")
-            del draw
-            # save the image
-            im.save("map_image.png")
+         if (len(self.offline_tiles) > 0):
+            # we have offline tiles so assemble a map from the ones around the map center
+            # (preferably at the current zoom; centered on the closest tile if none of them cover the map center)
+            im, self.map_lat, self.map_lon, zoom = self.offline_tiles.render(self.map_lat, self.map_lon, int(self.zoom))
+            self.zoom = str(zoom) # update map zoom
+            # add the beacon paths and the base and beacon markers to the map
+            markers, paths = self.map_overlay(zoom)
+            draw_overlay(im, self.map_lat, self.map_lon, zoom, markers, paths, self.offline_marker_radius)
+            image = im # display the offline map
+            view = (self.map_lat, self.map_lon, zoom)
             # Disable zoom buttons only as we are using offline maps
             self.zoom_in_button.config(state='disabled') # Disable zoom+
             self.zoom_out_button.config(state='disabled') # Disable zoom-
             self.enable_clicks = True # Enable mouse clicks
-            self.writeToConsole(self.console_1, 'Using offline map tile') # Update message console
+            self.writeToConsole(self.console_1, 'Using offline map tiles') # Update message console
          else:
             # No offline files available so default to blank image
-            filename = "map_image_blank.png"
+            image = self.blank_image
+            view = None
             # Disable zoom buttons and mouse clicks as there is no map image to display
             self.zoom_in_button.config(state='disabled') # Disable zoom+
             self.zoom_out_button.config(state='disabled') # Disable zoom-
             self.enable_clicks = False # Disable mouse clicks
 
+      self.display_image(image, view)
+
+   def show_local_map(self):
+      ''' Assemble the map from the local XYZ map tiles and add the beacon paths and the base and beacon markers '''
+      view = self.current_view()
+      if (self.basemap is None) or (view != self.basemap_view): # Only reassemble the basemap if the view has changed
+         self.basemap, zoom = self.tile_provider.render(view[0], view[1], view[2])
+         self.zoom = str(zoom) # The closest zoom level which is available
+         self.basemap_view = (view[0], view[1], zoom)
+      # Enable zoom buttons and mouse clicks
+      self.zoom_in_button.config(state='normal') # Enable zoom+
+      self.zoom_out_button.config(state='normal') # Enable zoom-
+      self.enable_clicks = True # Enable mouse clicks
+      self.display_image(self.overlay_basemap(), self.basemap_view)
+
+   def overlay_basemap(self):
+      ''' Return a copy of the basemap with the beacon paths and the base and beacon markers drawn on it '''
+      image = self.basemap.copy()
+      lat, lon, zoom = self.basemap_view
+      markers, paths = self.map_overlay(zoom)
+      draw_overlay(image, lat, lon, zoom, markers, paths, self.offline_marker_radius)
+      return image
+
+   def map_markers(self, zoom):
+      ''' Return the base and visible beacon markers [(lat, lon, colour, count)], clustered for this zoom '''
+      markers = []
+      if self.base_location.get() != '': # check if base location is known
+         base_lat,base_lon = self.base_location.get().split(',') # get base lat and lon
+         markers.append((float(base_lat), float(base_lon), self.base_colour))
+      for beacon in self.beacons.visible():
+         if beacon.location != '':
+            beacon_lat,beacon_lon = beacon.latlon() # get beacon lat and lon
+            markers.append((beacon_lat, beacon_lon, beacon.colour))
+      return cluster_markers(markers, zoom, self.cluster_pixels)
+
+   def map_overlay(self, zoom):
+      ''' Return the markers [(lat, lon, colour, count)] and paths [(lats, lons, colour)] to draw on locally assembled maps.
+      The markers are clustered and the paths are simplified for this zoom '''
+      paths = []
+      for beacon in self.beacons.visible():
+         lats, lons = beacon.track.waypoints(zoom)
+         paths.append((lats, lons, beacon.colour))
+      return self.map_markers(zoom), paths
+
+   def display_image(self, image, view):
+      ''' Display this map image (PIL Image) showing view (lat, lon, zoom) '''
+      self.shown_view = view # Mouse clicks are converted into lat, lon using the view which is displayed
       # Update label using image
-      image = Image.open(filename)
       photo = ImageTk.PhotoImage(image)
       self.label.configure(image=photo)
       self.image = photo
@@ -1037,7 +1157,7 @@ class BeaconBase(object):
       # Increment zoom if zoom is less than 21
       if int(self.zoom) < 21:
          self.zoom = str(int(self.zoom) + 1)
-         self.update_map()
+         self.request_map_update()
 
    def zoom_map_out(self):
       ''' Zoom out '''
@@ -1045,7 +1165,7 @@ class BeaconBase(object):
       # Decrement zoom if zoom is greater than 0
       if int(self.zoom) > 0:
          self.zoom = str(int(self.zoom) - 1)
-         self.update_map()
+         self.request_map_update()
 
    def left_click(self, event):
       ''' Left mouse click - move map based on click position '''
@@ -1059,19 +1179,16 @@ class BeaconBase(object):
 
    def image_click(self, event, button):
       ''' Handle mouse click event '''
-      if (self.enable_clicks) and (int(self.zoom) > 0) and (int(self.zoom) <= 21): # Are clicks enabled and is zoom 1-21?
-         x_move = event.x - (self.frame_width / 2) # Required x move in pixels
-         y_move = event.y - (self.frame_height / 2) # Required y move in pixels
-         scale_x = self.scales[np.where(int(self.zoom)==self.scales[:,0])][0][1] # Select scale from scales using current zoom
-         # Compensate y scale (Mercator projection) using current latitude
-         scale_multiplier_lat = math.cos(math.radians(self.map_lat))
-         scale_y = scale_x * scale_multiplier_lat # Calculate y scale
-         new_lat = self.map_lat - (y_move * scale_y) # Calculate new latitude
-         new_lon = self.map_lon + (x_move * scale_x) # Calculate new longitude
+      if (self.enable_clicks) and (self.shown_view is not None) and (self.shown_view[2] > 0) and (self.shown_view[2] <= 21): # Are clicks enabled and is zoom 1-21?
+         # Convert the click position on the displayed map into lat, lon (Web Mercator)
+         lat, lon, zoom = self.shown_view
+         new_lat, new_lon = pixels_to_latlon(event.x, event.y, lat, lon, zoom, self.frame_width, self.frame_height)
+         new_lat = float(new_lat)
+         new_lon = float(new_lon)
          if button == 'left':
             self.map_lat = new_lat # Update lat
             self.map_lon = new_lon # Update lon
-            self.update_map() # Update map
+            self.request_map_update() # Update map
          else:
             # Copy the location to the clipboard so it can be pasted into (e.g.) a browser
             self.window.clipboard_clear() # Clear clipboard
@@ -1083,17 +1200,29 @@ class BeaconBase(object):
       ''' Copy the location of the beacon with this serial number to the clipboard '''
       self.writeToConsole(self.console_1, 'Copying beacon location to clipboard') # Update message console      
       self.window.clipboard_clear() # Clear clipboard
-      loc = self.beacon_locations[self.beacon_serials[ser_no]] # Get location
+      loc = self.beacons.get(ser_no).location # Get location
       self.window.clipboard_append(loc) # Copy location to clipboard
       self.window.update() # Update window
       try:
          lat,lon = loc.split(',')
          self.map_lat = float(lat)
          self.map_lon = float(lon)
-         self.update_map()
+         self.request_map_update()
       except:
          pass
 
+   def show_beacon(self, ser_no):
+      ''' Show or hide the beacon with this serial number (as set by its Show Beacons menu entry) '''
+      self.beacons.get(ser_no).visible = self.show_beacons[ser_no].get()
+      self.request_map_update()
+
+   def show_all_beacons(self, visible):
+      ''' Show (visible = True) or hide (visible = False) all of the beacons '''
+      for beacon in self.beacons:
+         beacon.visible = visible
+         self.show_beacons[beacon.name].set(visible) # Update the Show Beacons menu
+      self.request_map_update()
+
    def goto_base(self):
       ''' Copy the location of the base to the clipboard and center the map on its location '''
       self.writeToConsole(self.console_1, 'Copying base location to clipboard') # Update message console      
@@ -1105,7 +1234,7 @@ class BeaconBase(object):
          lat,lon = loc.split(',')
          self.map_lat = float(lat)
          self.map_lon = float(lon)
-         self.update_map()
+         self.request_map_update()
       except:
          pass
 
@@ -1120,28 +1249,29 @@ class BeaconBase(object):
       if tkMessageBox.askokcancel("Flush MT Queue", "Are you sure?\nAny messages in the MT queue will be deleted!"):
          console_message = 'Requesting FLUSH_MT (could take ' + str(self.beacon_timeout) + 's)'
          self.writeToConsole(self.console_1, console_message) # Update message console      
-         resp = self.writeWait(self.flush_mt_choice, self.beacon_timeout) # Send menu choice '4'; wait for response for beacon_timeout seconds
-         mtq = -1
-         if resp != '': # Did we get a response?
-            try:
-               mtq = int(resp) # Try and extract MTQ value
-            except:
-               # ERROR received?
-               mtq = -1
-            if mtq != -1:
-               # Update beacon Mobile Terminated Queue length
-               self.beacon_MTQ.config(state='normal')
-               self.beacon_MTQ.delete(0, tk.END)
-               self.beacon_MTQ.insert(0, str(mtq))
-               self.beacon_MTQ.config(state='readonly')
-               if (mtq > 0):
-                  self.beacon_MTQ_txt.config(background='black',foreground='white')
-               else:
-                  self.beacon_MTQ_txt.config(background=self.background,foreground=self.foreground)
-               self.writeToConsole(self.console_1, 'Request sent') # Update message console
-         else:
-            self.writeToConsole(self.console_1, 'No serial data received!') # Update message console
-      # Enable Flush_MT and Message_Menu after Flush_MT
+         self.send_command(self.flush_mt_choice, self.beacon_timeout, lambda resp: self.mtq_received(resp, 'Request sent')) # Send menu choice '5'; wait for response for beacon_timeout seconds
+      else:
+         self.mtq_received(None, '')
+
+   def mtq_received(self, resp, message):
+      ''' Process the response to FLUSH_MT or a beacon message: either (only) the MTQ; or an ERROR
+      (resp is '' if there wasn't one; None if the command was cancelled). Write message to the console if the MTQ was received '''
+      mtq = -1
+      if resp is None: # Cancelled
+         pass
+      elif resp != '': # Did we get a response?
+         try:
+            mtq = int(resp) # Try and extract MTQ value
+         except:
+            # ERROR received?
+            mtq = -1
+         if mtq != -1:
+            # Update beacon Mobile Terminated Queue length
+            self.show_mtq(mtq)
+            self.writeToConsole(self.console_1, message) # Update message console
+      else:
+         self.writeToConsole(self.console_1, 'No serial data received!') # Update message console
+      # Enable Flush_MT and Message_Menu after Flush_MT / Send_Message
       self.flush_mt_button.config(state='active') # Enable Flush MT button
       self.menubar.entryconfig("Beacon Messaging", state='active') # Enable Beacon Messaging
       self.message_boxes_open = self.message_boxes_open - 1 # Update the number of open message boxes
@@ -1167,31 +1297,9 @@ class BeaconBase(object):
          self.writeToConsole(self.console_1, message) # Update message console
          message = message + '\r' # Terminate with a CR
          self.writeNoWait(self.send_message_choice) # Send menu choice '7'
-         resp = self.writeWait(message, self.beacon_timeout) # Send message; wait for response for beacon_timeout seconds
-         mtq = -1
-         if resp != '': # Did we get a response?
-            try:
-               mtq = int(resp) # Try and extract MTQ value
-            except:
-               # ERROR received?
-               mtq = -1
-            if mtq != -1:
-               # Update beacon Mobile Terminated Queue length
-               self.beacon_MTQ.config(state='normal')
-               self.beacon_MTQ.delete(0, tk.END)
-               self.beacon_MTQ.insert(0, str(mtq))
-               self.beacon_MTQ.config(state='readonly')
-               if (mtq > 0):
-                  self.beacon_MTQ_txt.config(background='black',foreground='white')
-               else:
-                  self.beacon_MTQ_txt.config(background=self.background,foreground=self.foreground)
-               self.writeToConsole(self.console_1, 'Message sent') # Update message console
-         else:
-            self.writeToConsole(self.console_1, 'No serial data received!') # Update message console
-      # Enable Flush_MT and Message_Menu after Send_Message
-      self.flush_mt_button.config(state='active') # Enable Flush MT button
-      self.menubar.entryconfig("Beacon Messaging", state='active') # Enable Beacon Messaging
-      self.message_boxes_open = self.message_boxes_open - 1 # Update the number of open message boxes
+         self.send_command(message, self.beacon_timeout, lambda resp: self.mtq_received(resp, 'Message sent'), flush=False) # Send message; wait for response for beacon_timeout seconds
+      else:
+         self.mtq_received(None, '')
 
    def writeToConsole(self, console, msg):
       ''' Write msg to the console; check if console is full; delete oldest entry if it is '''
@@ -1204,62 +1312,66 @@ class BeaconBase(object):
          console.insert('end', '\n') # Append a new line character
       console.insert('end', msg) # Append the message
       console.configure(state = 'disabled') # Lock the console
-      self.window.update() # Update the window
+      self.window.update_idletasks() # Redraw the window (without processing any other events)
       self.fp = open(self.console_log_file, 'ab') # Open log file for append in binary mode
       self.fp.write(msg+'\n') # Write the console message to the log file
       self.fp.close() # Close the log file
     
-   def writeWaitWithCancel(self, data, delay):
-      ''' Write data to serial; wait for up to delay seconds for a reply '''
-      cancel = tk.Toplevel(self.window)
-      cancel.geometry("%dx%d%+d%+d" % (300, 75, 600, 400))
-      cancel.title("Cancel")
-      msg = tk.Message(cancel, text="Waiting for serial data.\rDo you want to cancel?", aspect=600)
-      msg.pack()
-      button = tk.Button(cancel, text="Cancel", command=cancel.destroy)
-      button.pack()
-      self.ser.flushInput() # Flush serial RX buffer (delete any old responses)
-      self.ser.write(data) # Send data (command)
-      for i in range(4*delay): # Wait for up to delay seconds (timeout is 0.25 secs)
-         try:
-            cancel.update()
-         except:
-            pass
-         try:
-            exists = cancel.winfo_exists()
-         except:
-            exists = 0
-         resp = self.ser.read(200) # Attempt to read a 200 character reply (forcing a timeout)
-         if (resp != '') or (exists == 0): # If the response was non-NULL or cancel window was closed, quit the loop
+   def show_mtq(self, mtq):
+      ''' Record and display the mobile terminated queue length '''
+      self.mtq = mtq
+      self.beacon_MTQ.config(state='normal')
+      self.beacon_MTQ.delete(0, tk.END)
+      self.beacon_MTQ.insert(0, str(mtq))
+      self.beacon_MTQ.config(state='readonly')
+      if (mtq > 0):
+         self.beacon_MTQ_txt.config(background='black',foreground='white')
+      else:
+         self.beacon_MTQ_txt.config(background=self.background,foreground=self.foreground)
+
+   def send_command(self, data, delay, handler, flush=True):
+      ''' Write data to serial. handler(resp) is called by poll_serial with the reply; or with '' if there is no reply within delay seconds '''
+      if flush:
+         self.serial.flush() # Delete any old responses
+      self.command = (handler, time.time() + delay)
+      self.serial.write(data) # Send data (command)
+
+   def poll_serial(self):
+      ''' Timer function - pass each response from the base to the handler of the command waiting for it '''
+      self.serial_job = self.window.after(50, self.poll_serial) # Check again in 0.05s (scheduled first so an error in a handler can't stop the polling)
+      while True:
+         resp = self.serial.get_line()
+         if resp is None:
             break
-      # If the cancel window is still open, destroy it
+         if self.command is None: # A response which isn't expected (e.g. one which arrived after the timeout)
+            self.writeToConsole(self.console_2, resp.rstrip('\r\n')) # Show it anyway
+            continue
+         handler, deadline = self.command
+         self.command = None # (The handler may send the next command)
+         self.call_handler(handler, resp)
+      if (self.command is not None) and (time.time() > self.command[1]): # Timed out?
+         handler, deadline = self.command
+         self.command = None
+         self.call_handler(handler, '')
+
+   def call_handler(self, handler, resp):
+      ''' Call the response handler. If it fails, abandon the update (if there is one) so the next one can start '''
       try:
-         cancel.destroy()
-      except:
-         pass
-      if resp != '': # If the response was non-NULL, return the response
-         return resp
-      else: # else return NULL
-         return ''
-
-   def writeWait(self, data, delay):
-      ''' Write data to serial; wait for up to delay seconds for a reply '''
-      self.ser.flushInput() # Flush serial RX buffer (delete any old responses)
-      self.ser.write(data) # Send data (command)
-      for i in range(4*delay): # Wait for up to delay seconds (timeout is 0.25 secs)
-         self.window.update() # Update the window
-         resp = self.ser.read(200) # Attempt to read a 200 character reply (forcing a timeout)
-         if (resp != ''): # If the response was non-NULL, quit the loop
-            break
-      if resp != '': # If the response was non-NULL, return the response
-         return resp
-      else: # else return NULL
-         return ''
+         handler(resp)
+      except Exception:
+         self.command = None
+         self.writeToConsole(self.console_1, 'Response processing failed!') # Update message console
+         if self.update_in_progress:
+            self.drain_sessions = 0
+            self.update_in_progress = False
+            # Enable Flush_MT and Message_Menu
+            self.flush_mt_button.config(state='active') # Enable Flush MT button
+            self.menubar.entryconfig("Beacon Messaging", state='active') # Enable Beacon Messaging
 
    def writeNoWait(self, data):
       ''' Write data to serial; do not wait for a reply '''
-      self.ser.flushInput() # Flush serial RX buffer (delete any old responses)
-      self.ser.write(data) # Send data (command)
+      self.serial.flush() # Delete any old responses
+      self.serial.write(data) # Send data (command)
 
    def set_update_interval(self, interval):
       ''' Update the update interval '''
@@ -1281,9 +1393,13 @@ class BeaconBase(object):
    def close(self):
       ''' Close the program: close the serial port; make sure the log file is closed '''
 ##      try:
-##         self.writeWait(self.power_down_choice, 0) # Power down the 9603N
+##         self.writeNoWait(self.power_down_choice) # Power down the 9603N
 ##      except:
 ##         pass
+      try:
+         self.serial.close() # Stop the serial thread
+      except:
+         pass
       try:
          print 'Closing port...'
          self.ser.close() # Close the serial port
@@ -1294,11 +1410,12 @@ class BeaconBase(object):
          self.fp.close() # Close the log file
       except:
          pass
-      if self.beacons > 0:
+      if len(self.beacons) > 0:
          print 'Beacon data was logged to:'
-         for beacon in range(self.beacons):
-            print self.beacon_log_files[beacon]
+         for beacon in self.beacons:
+            print beacon.log_file
       print 'Console messages were logged to:',self.console_log_file
+      print 'Map downloads:',http_client.summary()
 
 if __name__ == "__main__":
    try:
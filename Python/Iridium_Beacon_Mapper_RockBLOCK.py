@@ -18,10 +18,24 @@
 ## The center position can be changed by left-clicking in the image.
 ## A right-click will copy the click location (lat,lon) to the clipboard.
 ## The zoom can be changed using the buttons.
+## The center and zoom are set automatically when a new beacon is displayed to show all the beacons
+## (and their paths). "Fit All" on the menu bar does the same at any time.
 
 ## Each beacon's path is displayed as a coloured line on the map.
 ## The oldest waypoints may be deleted as the map URL is limited to 8192 characters.
 
+## By default (local_overlay = True) only the map itself (the basemap) is downloaded from Google.
+## The markers and paths are drawn on it locally, so a new SBD file only needs a new map
+## image when the view (center or zoom) changes. Set local_overlay to False to have Google
+## draw the markers and paths (which needs a new map image for every update).
+
+## Any number of beacons can be tracked. The first eight are shown in the named colours
+## (red, yellow, green, blue, purple, gray, brown, orange); after that each beacon gets a generated colour.
+## The "Show Beacons" pull-down menu shows or hides each beacon on the map. Hidden beacons are
+## left out of the map URL (and Fit All).
+## Markers which are close together at the current zoom are merged into a single black cluster marker
+## labelled with the number of markers it holds. Zoom in to see them separately.
+
 ## A pull-down menu lists the locations of all the beacons being tracked.
 ## Clicking on a menu entry will center the map on that location and will copy that location
 ## to the clipboard.
@@ -29,6 +43,10 @@
 ## The GUI uses 640x480 pixel map images. Higher resolution images are available
 ## if you have a premium plan with Google.
 
+## If a directory of standard XYZ map tiles (Map_Tiles/<z>/<x>/<y>.png) or an MBTiles package
+## (Map_Tiles.mbtiles) is found, the map is assembled from those tiles instead of using
+## Google Static Maps - no network connection or API quota is needed (see Map_Providers.py)
+
 # sbd file contains the following in csv format:
 # (Optional) Column 0 = The Base's RockBLOCK serial number (see Iridium9603NBeacon_V4.ino)
 # Column 1 = GPS Tx Time (YYYYMMDDHHMMSS)
@@ -45,19 +63,48 @@
 # Column 12 = Iteration Count (int)
 # (Optional) Column 13 = The Beacon's RockBLOCK serial number (see Iridium9603NBeacon_V4.ino)
 
-from PyQt5.QtCore import QSettings, QProcess, QTimer, Qt
+from PyQt5.QtCore import QSettings, QProcess, QTimer, Qt, QThreadPool, QRunnable, QObject, pyqtSignal
 from PyQt5.QtWidgets import QWidget, QLabel, QComboBox, QGridLayout, QPushButton, \
     QApplication, QLineEdit, QFileDialog, QPlainTextEdit, QCheckBox, QMessageBox, \
     QMenuBar
-from PyQt5.QtGui import QCloseEvent, QTextCursor, QPixmap, QClipboard
+from PyQt5.QtGui import QCloseEvent, QTextCursor, QPixmap, QImage, QClipboard
 import time
-import urllib.request
-import math
 import numpy as np
 from sys import platform
 import os
+import io
+from PIL import Image
 import matplotlib.dates as mdates
 import re
+from Beacon_Map_Overlays import build_paths, cluster_markers, marker_parameter
+from Beacon_Registry import BeaconRegistry, static_maps_colour
+from Static_Maps_Client import download, http_client, MapImageCache
+from Web_Mercator import fit_bounds, pixels_to_latlon
+from Offline_Map_Tiles import draw_overlay
+from Map_Providers import find_tile_provider
+
+class MapFetchSignals(QObject):
+   ''' Signals from MapFetchTask. (QRunnable is not a QObject so cannot have its own) '''
+   finished = pyqtSignal(int, object) # request_id, image data (None if the download failed)
+
+class MapFetchTask(QRunnable):
+   ''' Download a map image on a QThreadPool thread '''
+
+   def __init__(self, request_id, url, cache, timeout=30.):
+      super().__init__()
+      self.request_id = request_id
+      self.url = url
+      self.cache = cache # Add the downloaded image to this MapImageCache
+      self.timeout = timeout
+      self.signals = MapFetchSignals()
+
+   def run(self):
+      try:
+         data = download(self.url, self.timeout) # Attempt map image download
+         self.cache.put(self.url, data)
+      except:
+         data = None
+      self.signals.finished.emit(self.request_id, data) # Queued back to the GUI thread
 
 class BeaconMapper(QWidget):
 
@@ -78,66 +125,38 @@ class BeaconMapper(QWidget):
       self.map_lon = 0.0 # Map longitude (degrees)
       self.frame_height = 480 # Google Static Map window width
       self.frame_width = 640 # Google Static Map window height
-      self.delta_limit_pixels = 200 # If base to beacon angle (delta) exceeds this many pixels, decrease the zoom level accordingly
+      self.fit_margin = 20 # Leave this many pixels around the edge of the map when fitting it to the beacons
+      self.fit_paths = True # Include the beacon paths when fitting the map?
+      self.max_fit_zoom = 15 # Don't zoom in further than this when fitting the map (e.g. to a single beacon)
+      self.do_zoom = False # Should we fit the map to the beacons? (When a new beacon is detected)
       self.map_type = 'hybrid' # Maps can be: roadmap , satellite , terrain or hybrid
       self.enable_clicks = False # Are mouse clicks enabled? False until first map has been loaded
-      self.beacons = 0 # How many beacons are currently being tracked
-      self.max_beacons = 8 # Track up to this many beacons
-      self.beacon_imeis = {} # Dictionary of the serial numbers of the beacons currently being tracked
-      self.beacon_paths = [] # List of beacon paths for Static Map
-      self.beacon_locations = [] # List of current location for each beacon
-      # Colours for beacon markers and paths - supported by both Tkinter and Google Static Maps API
-      self.beacon_colours = ['red','yellow','green','blue','purple','gray','brown','orange']
+      self.beacons = BeaconRegistry() # The beacons currently being tracked (location, path and colour), by imei
+      self.show_actions = {} # imei : checkable QAction in the Show Beacons menu
+      self.cluster_pixels = 24 # Markers in the same cluster_pixels x cluster_pixels square of the map are shown as one cluster marker
       self.sbd = [] # List of existing sbd filenames
+      self.map_pool = QThreadPool() # Downloads the map images in the background so the GUI doesn't freeze
+      self.map_pool.setMaxThreadCount(1) # One download at a time: newer requests replace any which are still waiting
+      self.map_request_id = 0 # Identifies the most recent map request (older ones are stale)
+      self.map_cache = MapImageCache() # Recently used map images (in memory and in Map_Image_Cache)
+      self.local_overlay = True # Draw the markers and paths locally on the basemap? (False: Google draws them)
+      self.basemap = None # The most recent map image without markers or paths (PIL Image)
+      self.basemap_view = None # (lat, lon, zoom) of basemap
+      self.map_request_view = None # (lat, lon, zoom) of the most recent map request
+      self.shown_view = None # (lat, lon, zoom) of the map image being displayed (None if it is blank)
+      # Map update requests (from the timer, the zoom buttons and mouse clicks) which arrive within
+      # map_update_delay of each other are coalesced into a single update of the final view
+      self.map_update_timer = QTimer()
+      self.map_update_timer.setSingleShot(True)
+      self.map_update_timer.setInterval(300) # milliseconds
+      self.map_update_timer.timeout.connect(self.update_map)
       
-      # Limit path lengths to this many characters depending on how many beacons are being tracked
-      # (Google allows combined URLs of up to 8192 characters)
-      # The first entry is redundant (i.e. would be used when tracking zero beacons)
-      # These limits take into account that each pipe ('|') is expanded to '%7C' by urllib
-      self.max_path_lengths = [7000, 7000, 3400, 2200, 1600, 1300, 1050, 900, 780]
-
-      # Google static map API pixel scales to help with map moves
-      # https://gis.stackexchange.com/questions/7430/what-ratio-scales-do-google-maps-zoom-levels-correspond-to
-      # ---
-      # Radius of the Earth at the Equator = 6378137m
-      # Circumference at the Equator = 2*pi*r = 40075017m
-      # Zoom level 24 uses 2^32 (4294967296) pixels at circumference
-      # Pixel scale at zoom level 24 is 0.009330692m/pixel
-      # Pixel scale doubles with each zoom level
-      # Pixel scale at zoom level 21 is 0.074645535m/pixel
-      # Pixel scale at zoom level 1 is 78271.5170m/pixel
-      # ---
-      # Zoom level 24 uses 2^32 (4294967296) pixels at circumference
-      # Each pixel represents an angle of 2*pi/2^32 radians = 1.46291808e-9 radians
-      # Angle doubles with each zoom level
-      # Zoom level 21 is 1.17033446e-8 radians per pixel
-      # In degrees:
-      # Zoom level 21 is 6.70552254e-7 degrees per pixel
-      # Zoom level 1 is 0.703125 degrees per pixel
-      # ---
-      # These values need to be adjusted with increasing latitude due to the Mercator projection
-      self.scales = np.array([
-         [1,7.03125000E-01], # Zoom level 1 is 0.703125 degrees per pixel at the Equator
-         [2,3.51562500E-01],
-         [3,1.75781250E-01],
-         [4,8.78906250E-02],
-         [5,4.39453125E-02],
-         [6,2.19726562E-02],
-         [7,1.09863281E-02],
-         [8,5.49316406E-03],
-         [9,2.74658203E-03],
-         [10,1.37329102E-03],
-         [11,6.86645508E-04],
-         [12,3.43322754E-04],
-         [13,1.71661377E-04],
-         [14,8.58306885E-05],
-         [15,4.29153442E-05],
-         [16,2.14576721E-05],
-         [17,1.07288361E-05],
-         [18,5.36441803E-06],
-         [19,2.68220901E-06],
-         [20,1.34110451E-06],
-         [21,6.70552254E-07]]) # Zoom level 21 is 6.70552254e-7 degrees per pixel at the Equator
+      # Google allows combined URLs of up to 8192 characters
+      # Whatever is left after the center, markers, zoom, size, maptype and key is shared between the beacon paths
+      # (beacons with short paths get all they need; the rest is shared giving priority to recently updated beacons)
+      self.max_url_length = 8000 # Leave a little margin
+
+      # Map pixel positions are converted to and from lat, lon using the Web Mercator projection (see Web_Mercator.py)
 
       # Ask the user if they want to ignore any existing sbd files
       # Answer 'n' to display all sbd files - both existing and new
@@ -169,17 +188,25 @@ class BeaconMapper(QWidget):
          print('Ignoring',len(self.sbd),'existing SBD .bin files')
       print
 
-      # Read the Google Static Maps API key
+      # Check for local XYZ map tiles
+      self.tile_provider = find_tile_provider(self.frame_width, self.frame_height) # None if there are none: use Google Static Maps
+      if self.tile_provider is not None:
+         print('Using local map tiles (zoom levels',self.tile_provider.available,') instead of Google Static Maps')
+         print()
+
+      # Read the Google Static Maps API key (not needed if we are using local map tiles)
       # Create one using: https://developers.google.com/maps/documentation/static-maps/get-api-key
       try:
          with open('Google_Static_Maps_API_Key.txt', 'r') as myfile:
             self.key = myfile.read().replace('\n', '')
             myfile.close()
       except:
-         print('Could not read the Google Static Maps API key!')
-         print('Create one here: https://developers.google.com/maps/documentation/static-maps/get-api-key')
-         print('then copy and paste it into a file called Google_Static_Maps_API_Key.txt')
-         raise ValueError('Could not read API Key!')
+         if self.tile_provider is None:
+            print('Could not read the Google Static Maps API key!')
+            print('Create one here: https://developers.google.com/maps/documentation/static-maps/get-api-key')
+            print('then copy and paste it into a file called Google_Static_Maps_API_Key.txt')
+            raise ValueError('Could not read API Key!')
+         self.key = ''
 
       # Set up UI
       
@@ -324,7 +351,8 @@ class BeaconMapper(QWidget):
       # Map Image
       self.imageLabel = QLabel()
       filename = "map_image_blank.png"
-      self.pixmap = QPixmap(filename)
+      self.blank_pixmap = QPixmap(filename) # Keep the blank image so it can be reused if there is no map to display
+      self.pixmap = self.blank_pixmap
       self.imageLabel.setPixmap(self.pixmap)
       layout.addWidget(self.imageLabel, 1, 2, row+1, 1)
       self.imageLabel.mousePressEvent = self.image_click # https://stackoverflow.com/a/6199330
@@ -334,6 +362,14 @@ class BeaconMapper(QWidget):
       layout.addWidget(self.menubar,0,0,1,2) # Add it
       self.beacon_menu = self.menubar.addMenu('Beacon Locations')
 
+      # Menu to show or hide the beacons on the map
+      self.show_menu = self.menubar.addMenu('Show Beacons')
+      action = self.show_menu.addAction('Show All')
+      action.triggered.connect(lambda state: self.show_all_beacons(True))
+      action = self.show_menu.addAction('Hide All')
+      action.triggered.connect(lambda state: self.show_all_beacons(False))
+      self.show_menu.addSeparator()
+
       # Menu to list update intervals
       self.interval_menu = self.menubar.addMenu('Set Update Interval')
       # Add intervals
@@ -342,6 +378,10 @@ class BeaconMapper(QWidget):
          action = self.interval_menu.addAction(interval_str)
          action.triggered.connect(lambda state, x=interval_str: self.set_update_interval(x)) # https://stackoverflow.com/a/35821092
 
+      # Menu action to fit the map to all the beacons
+      action = self.menubar.addAction('Fit All')
+      action.triggered.connect(self.fit_all)
+
       # Set the layout
       self.setLayout(layout)
 
@@ -381,7 +421,10 @@ class BeaconMapper(QWidget):
       if do_update: # If it is time to do an update
          self.time_since_last_update.setText('In Progress...') # Update the indicated time since last update
          if self.check_for_files(): # Check for new SBD files
-            self.update_map() # Update the Google Static Maps image
+            if self.do_zoom: # Do we need to update the center and zoom?
+               self.fit_all() # Fit the map to all the beacons
+               self.do_zoom = False
+            self.request_map_update() # Update the Google Static Maps image
 
    def check_for_files(self):
       ''' Check for the appearance of any new SBD .bin files and parse them '''
@@ -429,163 +472,276 @@ class BeaconMapper(QWidget):
                            position_str = "{:.6f},{:.6f}".format(latitude, longitude) # Construct position
 
                            # Check if this new file is from a beacon imei we haven't seen before
-                           if imei in self.beacon_imeis:
-                              pass # We have seen this one before
-                           else:
-                              # This is a new beacon
-                              # Check that we haven't reached the maximum number of beacons
-                              if self.beacons < self.max_beacons:
-                                 # Maximum hasn't been reached so get things ready for this new beacon
-                                 self.beacon_imeis[imei] = self.beacons # Add this imei and its beacon number
-                                 self.beacon_paths.append('&path=color:'+self.beacon_colours[self.beacons]+'|weight:5') # Append an empty path for this beacon
-                                 self.beacon_locations.append('') # Append a NULL location for this beacon
-                                 self.beacons += 1 # Increment the number of beacons being tracked
-                                 # This is a new beacon so center map on its location this time only
-                                 self.map_lat = latitude
-                                 self.map_lon = longitude
-                                 # Add it to the Beacon Location menu
-                                 # https://stackoverflow.com/q/7542164
-                                 # https://stackoverflow.com/a/35821092
-                                 action = self.beacon_menu.addAction(imei)
-                                 action.triggered.connect(lambda state, x=imei: self.copy_location(x))
-                              else:
-                                 # Maximum has been reached - don't process data from this beacon
-                                 print('Unable to process file: maximum number of beacons reached!')
-                                 ignore_me = True # Limit reached so ignore this file
-
-                           if (ignore_me == False):
-                              # Update beacon location
-                              self.beacon_locations[self.beacon_imeis[imei]] = position_str # Update location for this beacon
-
-##                              # Change beacon location background colour
-##                              self.beacon_location_txt.setStyleSheet(background=self.beacon_colours[self.beacon_imeis[imei]])
-                              
-                              # Update beacon path (append this location to the path for this beacon)
-                              self.beacon_paths[self.beacon_imeis[imei]] += '|' + position_str
+                           beacon = self.beacons.get(imei)
+                           if beacon is None:
+                              # This is a new beacon so get things ready for it
+                              beacon = self.beacons.add(imei) # Empty path and NULL location
+                              # This is a new beacon so fit the map to all the beacons this time only
+                              self.do_zoom = True
+                              # Add it to the Beacon Location and Show Beacons menus
+                              # https://stackoverflow.com/q/7542164
+                              # https://stackoverflow.com/a/35821092
+                              action = self.beacon_menu.addAction(imei)
+                              action.triggered.connect(lambda state, x=imei: self.copy_location(x))
+                              action = self.show_menu.addAction(imei)
+                              action.setCheckable(True)
+                              action.setChecked(True)
+                              action.triggered.connect(lambda state, x=imei: self.show_beacon(x, state))
+                              self.show_actions[imei] = action
+
+                           # Update beacon location
+                           beacon.location = position_str # Update location for this beacon
+
+##                           # Change beacon location background colour
+##                           self.beacon_location_txt.setStyleSheet(background=beacon.colour)
+                           
+                           # Update beacon path (append this location to the path for this beacon)
+                           # (the oldest waypoints are left out of the map URL if there isn't room for them)
+                           beacon.track.append(float(latitude), float(longitude))
                               
-                              # Check path length hasn't exceeded the maximum
-                              def find_char(s, ch): # https://stackoverflow.com/a/11122355
-                                 return [i for i, ltr in enumerate(s) if ltr == ch]
-                              while len(self.beacon_paths[self.beacon_imeis[imei]]) > self.max_path_lengths[self.beacons]:
-                                 # Delete path from second to third pipe character ('|') (first '|' preceeds the line weight)
-                                 pipes = find_char(self.beacon_paths[self.beacon_imeis[imei]],'|')
-                                 self.beacon_paths[self.beacon_imeis[imei]] = self.beacon_paths[self.beacon_imeis[imei]][:pipes[1]] + self.beacon_paths[self.beacon_imeis[imei]][pipes[2]:]
-                                 
-                              # Update imei
-                              self.beacon_imei.setText(imei)
-                              # Update beacon time
-                              self.beacon_time.setText(time_str)
-                              # Update beacon location
-                              self.beacon_location.setText(position_str)
-                              # Update beacon_altitude
-                              self.beacon_altitude.setText(str(altitude))
-                              # Update beacon_speed
-                              self.beacon_speed.setText(str(speed))
-                              # Update beacon_heading
-                              self.beacon_heading.setText(str(heading))
-                              # Update beacon_pressure
-                              self.beacon_pressure.setText(str(pressure))
-                              # Update beacon_temperature
-                              self.beacon_temperature.setText(str(temperature))
-                              # Update beacon_voltage
-                              self.beacon_voltage.setText(str(battery))
-                              # Update beacon_msn
-                              self.beacon_msn.setText(msnum)
-##                              # Update Beacon Location menu
-##                              label_str = imei + ' : ' + position_str
-##                              self.beacon_menu.entryconfig(self.beacon_imeis[imei], label=label_str, background=self.beacon_colours[self.beacon_imeis[imei]])
-
-                              new_files = True # Update new_files now that entire file has been processed
+                           # Update imei
+                           self.beacon_imei.setText(imei)
+                           # Update beacon time
+                           self.beacon_time.setText(time_str)
+                           # Update beacon location
+                           self.beacon_location.setText(position_str)
+                           # Update beacon_altitude
+                           self.beacon_altitude.setText(str(altitude))
+                           # Update beacon_speed
+                           self.beacon_speed.setText(str(speed))
+                           # Update beacon_heading
+                           self.beacon_heading.setText(str(heading))
+                           # Update beacon_pressure
+                           self.beacon_pressure.setText(str(pressure))
+                           # Update beacon_temperature
+                           self.beacon_temperature.setText(str(temperature))
+                           # Update beacon_voltage
+                           self.beacon_voltage.setText(str(battery))
+                           # Update beacon_msn
+                           self.beacon_msn.setText(msnum)
+##                           # Update Beacon Location menu
+##                           label_str = imei + ' : ' + position_str
+##                           self.beacon_menu.entryconfig(beacon.number, label=label_str, background=beacon.colour)
+
+                           new_files = True # Update new_files now that entire file has been processed
       return new_files
    
+   def fit_all(self):
+      ''' Center and zoom the map so it shows all the visible beacons and (if fit_paths) their paths '''
+      lats = []
+      lons = []
+      for beacon in self.beacons.visible():
+         if beacon.location != '':
+            beacon_lat,beacon_lon = beacon.latlon()
+            lats.append([beacon_lat])
+            lons.append([beacon_lon])
+         if self.fit_paths and (len(beacon.track) > 0):
+            path_lats, path_lons = beacon.track.waypoints()
+            lats.append(path_lats)
+            lons.append(path_lons)
+      if len(lats) == 0: # Nothing to fit
+         return
+      self.map_lat, self.map_lon, zoom = fit_bounds(np.concatenate(lats), np.concatenate(lons),
+                                                    self.frame_width - (2 * self.fit_margin), self.frame_height - (2 * self.fit_margin))
+      self.zoom = str(min(zoom, self.max_fit_zoom))
+      self.request_map_update()
+
+   def request_map_update(self):
+      ''' Request a map update. The update is done once no more requests have arrived for the map_update_timer interval '''
+      self.map_update_timer.start() # (Re)start the wait
+
+   def current_view(self):
+      ''' Return the (lat, lon, zoom) the map should show. lat and lon are rounded the same way as the map center '''
+      return (round(self.map_lat, 6), round(self.map_lon, 6), int(self.zoom))
+
    def update_map(self):
       ''' Show beacon locations and the beacon routes using Google Maps API StaticMap '''
 
+      if self.tile_provider is not None: # Are we using local map tiles?
+         self.show_local_map()
+         return
+
       # Assemble map center
-      center = ("%.6f"%self.map_lat) + ',' + ("%.6f"%self.map_lon)
+      view = self.current_view()
+      center = ("%.6f"%view[0]) + ',' + ("%.6f"%view[1])
+
+      map_params = '&zoom=' # 8 chars
+      map_params += self.zoom
+      map_params += '&size=' # 13 chars
+      map_params += str(self.frame_width)
+      map_params += 'x'
+      map_params += str(self.frame_height)
+      map_params += '&maptype=' + self.map_type + '&format=png&key=' # 35 chars
+      map_params += self.key # 40 chars
+
+      # Cancel any earlier request which hasn't started yet; the result of one which has is now stale
+      self.map_request_id += 1
+      self.map_pool.clear()
 
       # Update the Google Maps API StaticMap URL
       self.path_url = 'https://maps.googleapis.com/maps/api/staticmap?center=' # 54 chars
       self.path_url += center # 22 chars
-      if self.beacons > 0: # Do we have any valid beacons?
-         for beacon in range(self.beacons):
-            self.path_url += '&markers=color:' + self.beacon_colours[beacon] + '|' # beacons*(15+6+3+22) chars
-            self.path_url += self.beacon_locations[beacon]
-         # Path 'header' is 29 chars
-         # Minimum length for each waypoint is 18 chars but will grow to 20 when pipe is expanded
-         # This needs to be included in the max_path_length
-         for beacon in range(self.beacons): 
-            self.path_url += self.beacon_paths[beacon]
-      self.path_url += '&zoom=' # 8 chars
-      self.path_url += self.zoom
-      self.path_url += '&size=' # 13 chars
-      self.path_url += str(self.frame_width)
-      self.path_url += 'x'
-      self.path_url += str(self.frame_height)
-      self.path_url += '&maptype=' + self.map_type + '&format=png&key=' # 35 chars
-      self.path_url += self.key # 40 chars
-
-      # Download the API map image from Google
-      filename = "map_image.png" # Download map to this file
-      try:
-         urllib.request.urlretrieve(self.path_url, filename) # Attempt map image download
-      except:
-         filename = "map_image_blank.png" # If download failed, default to blank image
-
-      # Update label using image
-      self.pixmap = QPixmap(filename)
-      self.imageLabel.setPixmap(self.pixmap)
-      
-      # Enable zoom buttons and mouse clicks if a map image was displayed
-      if filename == "map_image.png":
+      self.map_request_view = view
+      if self.local_overlay: # Only download the basemap - the markers and paths are drawn locally
+         if (self.basemap is not None) and (self.map_request_view == self.basemap_view): # Has the view changed?
+            # No: just redraw the markers and paths on the basemap we already have
+            self.show_image(self.overlay_basemap(), self.basemap_view)
+            return
+      elif len(self.beacons.visible()) > 0: # Do we have any valid beacons? (Only the beacons being viewed go into the URL)
+         beacons = self.beacons.visible()
+         # Add the beacon markers (clustered for this zoom): clusters*(15+8+9+22) chars
+         for lat, lon, colour, count in self.map_markers(view[2]):
+            marker = marker_parameter(lat, lon, static_maps_colour(colour), count)
+            # Leave out any markers which won't fit (the URL is limited to max_url_length once escaped)
+            if len((self.path_url + marker + map_params).replace('|', '%7C')) <= self.max_url_length:
+               self.path_url += marker
+         # Share whatever is left of the URL between the beacon paths
+         # Pipes ('|') are counted as the three characters of '%7C'
+         # Each waypoint is encoded as a polyline offset from the previous one (typically 4-10 chars once escaped)
+         max_length = self.max_url_length - len((self.path_url + map_params).replace('|', '%7C'))
+         # The paths are simplified for this zoom first so only the visible shape uses up the URL
+         self.path_url += build_paths([beacon.track for beacon in beacons], [static_maps_colour(beacon.colour) for beacon in beacons],
+                                      max_length, view[2])
+      self.path_url += map_params
+
+      # Have we downloaded this exact map before? If we have, display it straight away
+      data = self.map_cache.get(self.path_url)
+      if data is not None:
+         self.map_fetched(self.map_request_id, data)
+         return
+
+      # Download the API map image from Google in the background
+      task = MapFetchTask(self.map_request_id, self.path_url, self.map_cache)
+      task.signals.finished.connect(self.map_fetched)
+      self.map_pool.start(task)
+
+   def map_fetched(self, request_id, data):
+      ''' Display the downloaded map image (data) '''
+      if request_id != self.map_request_id: # Ignore stale map images
+         return
+      # Decode the image straight from memory: there is no temporary map_image.png file
+      pixmap = None
+      if (data is not None) and self.local_overlay: # Keep the basemap and draw the markers and paths on it
+         try:
+            self.basemap = Image.open(io.BytesIO(data)).convert("RGBA")
+            self.basemap_view = self.map_request_view
+            pixmap = self.pixmap_from_image(self.overlay_basemap())
+         except IOError:
+            pixmap = None
+      elif data is not None:
+         pixmap = QPixmap()
+         if not pixmap.loadFromData(data): # Is the image valid?
+            pixmap = None
+      if pixmap is not None: # Did the download succeed and is the image valid?
+         self.pixmap = pixmap
+         self.shown_view = self.map_request_view
+         # Enable zoom buttons and mouse clicks since a map image is displayed
          self.zoom_in_button.setEnabled(True) # Enable zoom+
          self.zoom_out_button.setEnabled(True) # Enable zoom-
          self.enable_clicks = True # Enable mouse clicks
-      else: # Else disable them again
+      else: # If download failed, default to blank image and disable them again
+         self.pixmap = self.blank_pixmap
+         self.shown_view = None
          self.zoom_in_button.setEnabled(False) # Disable zoom+
          self.zoom_out_button.setEnabled(False) # Disable zoom-
          self.enable_clicks = False # Disable mouse clicks
 
+      # Update label using image
+      self.imageLabel.setPixmap(self.pixmap)
+
+   def show_local_map(self):
+      ''' Assemble the map from the local XYZ map tiles and add the beacon paths and markers '''
+      view = self.current_view()
+      if (self.basemap is None) or (view != self.basemap_view): # Only reassemble the basemap if the view has changed
+         self.basemap, zoom = self.tile_provider.render(view[0], view[1], view[2])
+         self.zoom = str(zoom) # The closest zoom level which is available
+         self.basemap_view = (view[0], view[1], zoom)
+      # Enable zoom buttons and mouse clicks
+      self.zoom_in_button.setEnabled(True) # Enable zoom+
+      self.zoom_out_button.setEnabled(True) # Enable zoom-
+      self.enable_clicks = True # Enable mouse clicks
+      self.show_image(self.overlay_basemap(), self.basemap_view)
+
+   def overlay_basemap(self):
+      ''' Return a copy of the basemap with the beacon paths and markers drawn on it '''
+      image = self.basemap.copy()
+      lat, lon, zoom = self.basemap_view
+      paths = []
+      for beacon in self.beacons.visible():
+         lats, lons = beacon.track.waypoints(zoom) # Simplified for this zoom
+         paths.append((lats, lons, beacon.colour))
+      draw_overlay(image, lat, lon, zoom, self.map_markers(zoom), paths)
+      return image
+
+   def map_markers(self, zoom):
+      ''' Return the visible beacon markers [(lat, lon, colour, count)], clustered for this zoom '''
+      markers = []
+      for beacon in self.beacons.visible():
+         if beacon.location != '':
+            beacon_lat,beacon_lon = beacon.latlon() # get beacon lat and lon
+            markers.append((beacon_lat, beacon_lon, beacon.colour))
+      return cluster_markers(markers, zoom, self.cluster_pixels)
+
+   def pixmap_from_image(self, image):
+      ''' Convert a PIL RGBA image into a QPixmap (QPixmap.fromImage copies the data) '''
+      data = image.tobytes('raw', 'RGBA')
+      return QPixmap.fromImage(QImage(data, image.size[0], image.size[1], QImage.Format_RGBA8888))
+
+   def show_image(self, image, view):
+      ''' Display this map image (PIL Image) showing view (lat, lon, zoom) '''
+      self.shown_view = view # Mouse clicks are converted into lat, lon using the view which is displayed
+      self.pixmap = self.pixmap_from_image(image)
+      self.imageLabel.setPixmap(self.pixmap)
+
    def zoom_map_in(self):
       ''' Zoom in '''
       # Increment zoom if zoom is less than 21
       if int(self.zoom) < 21:
          self.zoom = str(int(self.zoom) + 1)
-         self.update_map()
+         self.request_map_update()
 
    def zoom_map_out(self):
       ''' Zoom out '''
       # Decrement zoom if zoom is greater than 0
       if int(self.zoom) > 0:
          self.zoom = str(int(self.zoom) - 1)
-         self.update_map()
+         self.request_map_update()
 
    def image_click(self, event):
       ''' Handle mouse click event '''
-      if (self.enable_clicks) and (int(self.zoom) > 0) and (int(self.zoom) <= 21): # Are clicks enabled and is zoom 1-21?
-         x_move = event.pos().x() - (self.frame_width / 2) # Required x move in pixels
-         y_move = event.pos().y() - (self.frame_height / 2) # Required y move in pixels
-         scale_x = self.scales[np.where(int(self.zoom)==self.scales[:,0])][0][1] # Select scale from scales using current zoom
-         # Compensate y scale (Mercator projection) using current latitude
-         scale_multiplier_lat = math.cos(math.radians(self.map_lat))
-         scale_y = scale_x * scale_multiplier_lat # Calculate y scale
-         new_lat = self.map_lat - (y_move * scale_y) # Calculate new latitude
-         new_lon = self.map_lon + (x_move * scale_x) # Calculate new longitude
+      if (self.enable_clicks) and (self.shown_view is not None) and (self.shown_view[2] > 0) and (self.shown_view[2] <= 21): # Are clicks enabled and is zoom 1-21?
+         # Convert the click position on the displayed map into lat, lon (Web Mercator)
+         lat, lon, zoom = self.shown_view
+         new_lat, new_lon = pixels_to_latlon(event.pos().x(), event.pos().y(), lat, lon, zoom, self.frame_width, self.frame_height)
+         new_lat = float(new_lat)
+         new_lon = float(new_lon)
          self.map_lat = new_lat # Update lat
          self.map_lon = new_lon # Update lon
-         self.update_map() # Update map
+         self.request_map_update() # Update map
 
    def copy_location(self, imei):
       ''' Move the map to the location of this imei '''
-      loc = self.beacon_locations[self.beacon_imeis[imei]] # Get location
+      loc = self.beacons.get(imei).location # Get location
       try:
          lat,lon = loc.split(',')
          self.map_lat = float(lat)
          self.map_lon = float(lon)
-         self.update_map()
+         self.request_map_update()
       except:
          pass
 
+   def show_beacon(self, imei, visible):
+      ''' Show (visible = True) or hide (visible = False) the beacon with this imei '''
+      self.beacons.get(imei).visible = visible
+      self.request_map_update()
+
+   def show_all_beacons(self, visible):
+      ''' Show (visible = True) or hide (visible = False) all of the beacons '''
+      for beacon in self.beacons:
+         beacon.visible = visible
+         self.show_actions[beacon.name].setChecked(visible) # Update the Show Beacons menu
+      self.request_map_update()
+
    def set_update_interval(self, new_interval):
       ''' Update the update interval '''
       self.interval.setText(new_interval) # Update the indicated time since last update
@@ -600,6 +756,7 @@ class BeaconMapper(QWidget):
    def closeEvent(self, event: QCloseEvent) -> None:
       """Handle Close event of the Widget."""
       #self.timer.stop()
+      print('Map downloads:',http_client.summary())
       event.accept()
 
 if __name__ == "__main__":
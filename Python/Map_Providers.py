@@ -0,0 +1,141 @@
+# -*- coding: cp1252 -*-
+
+## Map Providers
+
+## Local map tile providers for Iridium_Beacon_Base.py and Iridium_Beacon_Mapper_RockBLOCK.py
+## which can be used instead of Google Static Maps when there is no network connection.
+## Works with both Python 2 (Base) and Python 3 (Mapper).
+
+## LocalTileProvider composites the view from standard XYZ ("slippy map") 256 x 256 tiles
+## read from a tile source. Refresh time then depends on the local disk, not on the network.
+## The markers and paths are drawn on top using Offline_Map_Tiles.draw_overlay.
+
+## Tile sources are pluggable. Two are provided:
+## DirectoryTileSource reads a directory tree of tiles: <directory>/<z>/<x>/<y>.png
+## MBTilesSource reads a single-file MBTiles (SQLite) tile package: https://github.com/mapbox/mbtiles-spec
+## Any object with zooms() and get(z, x, y) (returning the encoded image data or None) can be used.
+
+## find_tile_provider looks for Map_Tiles (directory) or Map_Tiles.mbtiles in the current directory.
+
+import math
+import os
+import io
+import sqlite3
+from collections import OrderedDict
+from PIL import Image
+from Web_Mercator import latlon_to_world, tile_size
+
+class DirectoryTileSource(object):
+   ''' Tiles stored as <directory>/<z>/<x>/<y><extension> '''
+
+   def __init__(self, directory, extension='.png'):
+      self.directory = directory
+      self.extension = extension
+
+   def zooms(self):
+      ''' Return a sorted list of the zoom levels in the directory '''
+      return sorted([int(name) for name in os.listdir(self.directory) if name.isdigit()])
+
+   def get(self, z, x, y):
+      ''' Return the encoded image data for this tile; or None if there isn't one '''
+      try:
+         with open(os.path.join(self.directory, str(z), str(x), str(y) + self.extension), 'rb') as f:
+            return f.read()
+      except (IOError, OSError):
+         return None
+
+class MBTilesSource(object):
+   ''' Tiles stored in a single-file MBTiles (SQLite) package.
+   MBTiles rows are numbered from the South (TMS) so y is flipped '''
+
+   def __init__(self, filename):
+      self.filename = filename
+      self.db = sqlite3.connect(filename)
+
+   def zooms(self):
+      ''' Return a sorted list of the zoom levels in the package '''
+      return [row[0] for row in self.db.execute('SELECT DISTINCT zoom_level FROM tiles ORDER BY zoom_level')]
+
+   def get(self, z, x, y):
+      ''' Return the encoded image data for this tile; or None if there isn't one '''
+      row = self.db.execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                            (z, x, (2 ** z) - 1 - y)).fetchone()
+      if row is None:
+         return None
+      return bytes(row[0])
+
+def open_tile_source(path):
+   ''' Return the tile source for path (a tile directory or an .mbtiles file); or None if there isn't one '''
+   if os.path.isdir(path):
+      return DirectoryTileSource(path)
+   if os.path.isfile(path) and (path[-8:].lower() == '.mbtiles'):
+      return MBTilesSource(path)
+   return None
+
+class LocalTileProvider(object):
+   ''' Composite width x height map images from the XYZ tiles in source '''
+
+   def __init__(self, source, width=640, height=480, max_tiles=64):
+      self.source = source # DirectoryTileSource, MBTilesSource or similar
+      self.width = width # Map width in pixels
+      self.height = height # Map height in pixels
+      self.tiles = OrderedDict() # (z, x, y) : decoded tile image (or None). Least recently used first
+      self.max_tiles = max_tiles # Keep up to this many decoded tiles
+      self.available = self.source.zooms() # Zoom levels in the source
+
+   def zoom(self, zoom):
+      ''' Return the available zoom level closest to zoom (prefer more detail on a tie) '''
+      if len(self.available) == 0:
+         return None
+      return min(self.available, key=lambda z: (abs(z - zoom), -z))
+
+   def tile(self, z, x, y):
+      ''' Return the decoded (RGBA) image of this tile; or None if there isn't one '''
+      key = (z, x, y)
+      if key in self.tiles:
+         image = self.tiles.pop(key) # Move to the most recently used end
+      else:
+         image = None
+         data = self.source.get(z, x, y)
+         if data is not None:
+            try:
+               image = Image.open(io.BytesIO(data)).convert("RGBA")
+            except IOError:
+               image = None
+         if len(self.tiles) >= self.max_tiles:
+            self.tiles.popitem(last=False) # Forget the least recently used tile
+      self.tiles[key] = image
+      return image
+
+   def render(self, lat, lon, zoom):
+      ''' Assemble the map centered on lat, lon using the available zoom level closest to zoom.
+      Returns the image and the zoom level used; or None, None if the source is empty '''
+      zoom = self.zoom(zoom)
+      if zoom is None:
+         return None, None
+      center_x, center_y = latlon_to_world(lat, lon, zoom)
+      left = float(center_x) - (self.width / 2.) # World pixel position of the top left corner of the map
+      top = float(center_y) - (self.height / 2.)
+      tiles = 2 ** zoom # Number of tiles across (and down) the world
+      image = Image.new("RGBA", (self.width, self.height), "black")
+      for ty in range(int(math.floor(top / tile_size)), int(math.floor((top + self.height - 1) / tile_size)) + 1):
+         if (ty < 0) or (ty >= tiles): # Beyond the top or bottom of the world
+            continue
+         for tx in range(int(math.floor(left / tile_size)), int(math.floor((left + self.width - 1) / tile_size)) + 1):
+            tile = self.tile(zoom, tx % tiles, ty) # Allow for wrap-around at +/-180
+            if tile is not None:
+               image.paste(tile, (int(round((tx * tile_size) - left)), int(round((ty * tile_size) - top))))
+      return image, zoom
+
+def find_tile_provider(width=640, height=480, paths=('Map_Tiles', 'Map_Tiles.mbtiles')):
+   ''' Return a LocalTileProvider for the first of paths which contains tiles; or None if none do '''
+   for path in paths:
+      try:
+         source = open_tile_source(path)
+         if source is not None:
+            provider = LocalTileProvider(source, width, height)
+            if len(provider.available) > 0:
+               return provider
+      except (OSError, sqlite3.Error): # Not a valid tile directory or package
+         pass
+   return None
@@ -0,0 +1,321 @@
+# -*- coding: cp1252 -*-
+
+## Offline Map Tiles
+
+## Helpers for the offline StaticMapTiles (collected using Google_Static_Maps_Tiler.py)
+## used by Iridium_Beacon_Base.py when the map image cannot be downloaded.
+## Works with both Python 2 and Python 3.
+
+## The tiles for all zoom levels are stored in a single-file package (StaticMapTiles.sqlite).
+## Like MBTiles (https://github.com/mapbox/mbtiles-spec) it is an SQLite database with a metadata
+## table and a tiles table, but the tiles are Static Maps images identified by their zoom level and
+## center (lat, lon) instead of XYZ tiles. The tiles table is indexed on zoom level and center, so a
+## tile can be found (or checked for) directly. StaticMapTilePackage reads and writes the package.
+## import_tile_files adds the loose StaticMapTile_Zoom_z_Lat_lat_Lon_lon_.png files made by earlier versions
+## of the Tiler (in a directory and its subdirectories) to a package, once (Google_Static_Maps_Tiler.py does this).
+
+## The tiles can be made smaller using Static_Map_Tile_Compressor.py, which re-encodes them using
+## recompress_tile (as palette PNGs, WebP or JPEG). PIL recognises the format from the data itself
+## so packages can hold a mixture of formats and the offline map decodes them all directly.
+
+## OfflineTileIndex holds the tiles in a grid keyed by zoom and cell, where each cell is
+## the width of one tile at that zoom in Web Mercator world pixels (see Web_Mercator.py).
+## Finding the tiles which cover a location only needs to look in that location's cell
+## and its neighbours - not at every tile.
+
+## OfflineTileIndex.render assembles a map the size of the view from all the tiles which
+## overlap it. draw_overlay then projects the waypoints of all the beacons at once and
+## draws their paths and markers, so the offline map shows the same information as the
+## Google Static Map.
+
+import math
+import io
+import os
+import sqlite3
+from collections import OrderedDict
+import numpy as np
+from PIL import Image, ImageDraw
+from Web_Mercator import latlon_to_pixels, latlon_to_world, world_size
+
+def draw_overlay(image, center_lat, center_lon, zoom, markers, paths, marker_radius=5, path_width=5):
+   ''' Draw the paths and markers onto image (centered on center_lat, center_lon).
+   markers is a list of (lat, lon, colour) or (lat, lon, colour, count) - see Beacon_Map_Overlays.cluster_markers.
+   Clusters (count > 1) are drawn twice the size, labelled with the count. paths is a list of (lats, lons, colour) '''
+   width, height = image.size
+   draw = ImageDraw.Draw(image)
+   # Project the waypoints of all the paths in one go
+   if len(paths) > 0:
+      lengths = [len(lats) for lats, lons, colour in paths]
+      x, y = latlon_to_pixels(np.concatenate([lats for lats, lons, colour in paths]), np.concatenate([lons for lats, lons, colour in paths]),
+                              center_lat, center_lon, zoom, width, height)
+      start = 0
+      for length, (lats, lons, colour) in zip(lengths, paths):
+         if length > 1:
+            draw.line(list(zip(x[start:start + length], y[start:start + length])), fill=colour, width=path_width)
+         start += length
+   # Draw the markers on top of the paths
+   if len(markers) > 0:
+      x, y = latlon_to_pixels([marker[0] for marker in markers], [marker[1] for marker in markers], center_lat, center_lon, zoom, width, height)
+      for i in range(len(markers)):
+         count = markers[i][3] if len(markers[i]) > 3 else 1
+         radius = marker_radius if count == 1 else 2 * marker_radius
+         # check if the marker can be shown on this map
+         if (radius <= x[i] < width - radius) and (radius <= y[i] < height - radius):
+            draw.ellipse([(x[i] - radius, y[i] - radius), (x[i] + radius, y[i] + radius)], fill=markers[i][2], outline="black")
+            if count > 1:
+               label = str(count)
+               if hasattr(draw, 'textbbox'): # Newer versions of PIL
+                  left, top, right, bottom = draw.textbbox((0, 0), label)
+                  label_width, label_height = right - left, bottom - top
+               else:
+                  label_width, label_height = draw.textsize(label)
+               draw.text((x[i] - (label_width / 2.), y[i] - (label_height / 2.)), label, fill="white")
+   del draw
+
+package_filename = 'StaticMapTiles.sqlite' # The default tile package
+tile_formats = ('palette', 'webp', 'jpeg') # Compact formats for recompress_tile
+
+def recompress_tile(data, tile_format='palette', quality=80, colours=256):
+   ''' Re-encode the tile image data in a more compact tile_format and return the new data.
+   quality (1-100) is used by webp and jpeg; palette PNGs use up to colours colours '''
+   image = Image.open(io.BytesIO(data)).convert("RGB")
+   compact = io.BytesIO()
+   if tile_format == 'palette':
+      image.quantize(colours).save(compact, 'PNG', optimize=True)
+   elif tile_format == 'webp':
+      image.save(compact, 'WEBP', quality=quality)
+   elif tile_format == 'jpeg':
+      image.save(compact, 'JPEG', quality=quality, optimize=True)
+   else:
+      raise ValueError('Unknown tile format: ' + str(tile_format))
+   return compact.getvalue()
+
+class StaticMapTilePackage(object):
+   ''' Single-file (SQLite) package of StaticMapTiles. Use each package object from one thread only '''
+
+   def __init__(self, filename=package_filename):
+      self.filename = filename
+      self.db = sqlite3.connect(filename)
+      self.db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+      self.db.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, center_lat REAL, center_lon REAL, tile_data BLOB)')
+      self.db.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, center_lat, center_lon)')
+      self.db.commit()
+
+   def __len__(self):
+      return self.db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+
+   def set_metadata(self, name, value):
+      ''' Set a metadata value (e.g. name, format, minzoom, maxzoom, bounds) '''
+      self.db.execute('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)', (name, str(value)))
+      self.db.commit()
+
+   def metadata(self):
+      ''' Return the metadata as a dictionary '''
+      return dict(self.db.execute('SELECT name, value FROM metadata').fetchall())
+
+   def add(self, zoom, lat, lon, data, commit=True):
+      ''' Add (or replace) the tile centered on lat, lon (degrees; stored to 6 decimal places) at this zoom. Returns its tile id.
+      A replaced tile keeps its tile id so any index which holds it stays valid '''
+      # INSERT OR IGNORE: the Tiler and the Base's prefetcher may both add the same tile at the same time
+      cursor = self.db.execute('INSERT OR IGNORE INTO tiles (zoom_level, center_lat, center_lon, tile_data) VALUES (?, ?, ?, ?)',
+                               (int(zoom), round(float(lat), 6), round(float(lon), 6), sqlite3.Binary(data)))
+      if cursor.rowcount == 1: # A new tile
+         tile_id = cursor.lastrowid
+      else: # Already in the package
+         tile_id = self.find(zoom, lat, lon)
+         self.replace(tile_id, data, commit=False)
+      if commit:
+         self.db.commit()
+      return tile_id
+
+   def find(self, zoom, lat, lon):
+      ''' Return the tile id of the tile centered on lat, lon at this zoom; or None if there isn't one '''
+      row = self.db.execute('SELECT rowid FROM tiles WHERE zoom_level=? AND center_lat=? AND center_lon=?',
+                            (int(zoom), round(float(lat), 6), round(float(lon), 6))).fetchone()
+      if row is None:
+         return None
+      return row[0]
+
+   def tiles(self):
+      ''' Return [(tile id, zoom, lat, lon)] of all the tiles in the package '''
+      return self.db.execute('SELECT rowid, zoom_level, center_lat, center_lon FROM tiles').fetchall()
+
+   def get(self, tile_id):
+      ''' Return the encoded image data of this tile; or None if there isn't one '''
+      row = self.db.execute('SELECT tile_data FROM tiles WHERE rowid=?', (tile_id,)).fetchone()
+      if row is None:
+         return None
+      return bytes(row[0])
+
+   def replace(self, tile_id, data, commit=True):
+      ''' Replace the image data of this tile (e.g. with a recompressed version) '''
+      self.db.execute('UPDATE tiles SET tile_data=? WHERE rowid=?', (sqlite3.Binary(data), tile_id))
+      if commit:
+         self.db.commit()
+
+   def close(self):
+      self.db.close()
+
+def import_tile_files(package, directory='.', skip=('Map_Image_Cache', 'Map_Tiles')):
+   ''' Add the loose StaticMapTile_*.png files in directory and its subdirectories (except skip) to package
+   (StaticMapTilePackage) unless they are already in it. Returns the filenames of the tiles which were added '''
+   added = []
+   for root, dirs, files in os.walk(directory):
+      dirs[:] = sorted([d for d in dirs if d not in skip]) # Don't look in the map image cache or the XYZ tiles
+      for filename in sorted(files):
+         if (filename[:13] != 'StaticMapTile') or (filename[-4:] != '.png'): # check for tile file
+            continue
+         fields = filename.split("_") # split the filename into fields
+         try:
+            zoom, lat, lon = int(fields[2]), float(fields[4]), float(fields[6])
+         except (IndexError, ValueError): # Not a tile filename
+            continue
+         if package.find(zoom, lat, lon) is not None:
+            continue
+         longfilename = os.path.join(root, filename)
+         with open(longfilename, 'rb') as f:
+            data = f.read()
+         try:
+            Image.open(io.BytesIO(data)).verify()
+         except Exception: # Incomplete image
+            continue
+         package.add(zoom, lat, lon, data, commit=False)
+         added.append(longfilename)
+   package.db.commit()
+   return added
+
+class OfflineTileIndex(object):
+   ''' Zoom-aware spatial index of the offline map tiles '''
+
+   def __init__(self, frame_width=640, frame_height=480, max_images=16):
+      self.frame_width = frame_width # Tile width in pixels
+      self.frame_height = frame_height # Tile height in pixels
+      self.images = OrderedDict() # Recently used (decoded) tile images. Least recently used first
+      self.max_images = max_images # Keep up to this many decoded tiles
+      self.sources = [] # Where each tile is: a filename; or (package, tile id)
+      self.lats = [] # Tile center latitudes (degrees)
+      self.lons = [] # Tile center longitudes (degrees)
+      self.zooms = [] # Tile zooms (int)
+      self.grids = {} # zoom : { (row, col) : [tile numbers] }
+      self.vectors = None # Unit vectors of the tile centers (built when first needed)
+
+   def __len__(self):
+      return len(self.sources)
+
+   def cell(self, lat, lon, zoom):
+      ''' Grid cell (row, col) containing lat, lon. Cells are frame_width world pixels square '''
+      x, y = latlon_to_world(lat, lon, zoom)
+      cols = int(math.ceil(world_size(zoom) / self.frame_width)) # Number of columns around the world
+      return int(math.floor(y / self.frame_width)), int(math.floor(x / self.frame_width)) % cols
+
+   def add(self, source, lat, lon, zoom):
+      ''' Add a tile to the index. source is the tile's filename; or (package, tile id) '''
+      tile = len(self.sources)
+      self.sources.append(source)
+      self.lats.append(lat)
+      self.lons.append(lon)
+      self.zooms.append(zoom)
+      self.grids.setdefault(zoom, {}).setdefault(self.cell(lat, lon, zoom), []).append(tile)
+      self.vectors = None
+
+   def add_package(self, package):
+      ''' Add all the tiles in package (StaticMapTilePackage) to the index '''
+      for tile_id, zoom, lat, lon in package.tiles():
+         self.add((package, tile_id), lat, lon, zoom)
+
+   def tile(self, tile):
+      ''' Return (source, lat, lon, zoom) for this tile number '''
+      return self.sources[tile], self.lats[tile], self.lons[tile], self.zooms[tile]
+
+   def within(self, lat, lon, zoom, half_width, half_height):
+      ''' Return the numbers of the tiles at this zoom whose centers are within half_width, half_height (pixels)
+      of lat, lon, nearest first. half_width and half_height must be no more than one tile width '''
+      grid = self.grids.get(zoom)
+      if grid is None:
+         return []
+      cols = int(math.ceil(world_size(zoom) / self.frame_width))
+      row, col = self.cell(lat, lon, zoom)
+      # The search area is never wider than a cell so tiles can only be found in this cell or a neighbour
+      tiles = []
+      for r in (row - 1, row, row + 1):
+         for c in (col - 1, col, col + 1):
+            tiles += grid.get((r, c % cols), [])
+      if len(tiles) == 0:
+         return []
+      # Pixel offsets of all the candidate tile centers from lat, lon
+      dx, dy = latlon_to_pixels([self.lats[t] for t in tiles], [self.lons[t] for t in tiles], lat, lon, zoom, 0., 0.)
+      found = [((dx[i] ** 2) + (dy[i] ** 2), tiles[i]) for i in range(len(tiles)) if (abs(dx[i]) <= half_width) and (abs(dy[i]) <= half_height)]
+      return [tile for distance, tile in sorted(found)]
+
+   def covering(self, lat, lon, zoom):
+      ''' Return the numbers of the tiles at this zoom which contain lat, lon, nearest first '''
+      return self.within(lat, lon, zoom, self.frame_width / 2., self.frame_height / 2.)
+
+   def overlapping(self, lat, lon, zoom):
+      ''' Return the numbers of the tiles at this zoom which overlap a view centered on lat, lon, nearest first '''
+      return self.within(lat, lon, zoom, self.frame_width, self.frame_height)
+
+   def image(self, tile):
+      ''' Return the decoded image for this tile; or None if its image data is missing '''
+      if tile in self.images:
+         image = self.images.pop(tile) # Move to the most recently used end
+      else:
+         source = self.sources[tile]
+         if isinstance(source, tuple): # Tile is in a package
+            package, tile_id = source
+            data = package.get(tile_id)
+            if data is None: # e.g. the tile has been deleted from the package
+               return None
+            image = Image.open(io.BytesIO(data)).convert("RGBA")
+         else:
+            try:
+               image = Image.open(source).convert("RGBA")
+            except IOError: # e.g. the file has been deleted
+               return None
+         if len(self.images) >= self.max_images:
+            self.images.popitem(last=False) # Forget the least recently used tile
+      self.images[tile] = image
+      return image
+
+   def render(self, lat, lon, zoom):
+      ''' Assemble a view-sized map from the tiles which overlap a view centered on lat, lon at this zoom.
+      If no tile covers lat, lon at this zoom the best available tile is used instead (see nearest).
+      Returns the image and the lat, lon and zoom of its center '''
+      tile = self.nearest(lat, lon, zoom)
+      zoom = self.zooms[tile]
+      if tile not in self.covering(lat, lon, zoom): # Center the view on the tile if it doesn't cover lat, lon
+         lat = self.lats[tile]
+         lon = self.lons[tile]
+      mosaic = Image.new("RGBA", (self.frame_width, self.frame_height), "black")
+      tiles = self.overlapping(lat, lon, zoom)
+      x, y = latlon_to_pixels([self.lats[t] for t in tiles], [self.lons[t] for t in tiles], lat, lon, zoom, self.frame_width, self.frame_height)
+      for i in reversed(range(len(tiles))): # Paste the nearest tile last so it is on top
+         image = self.image(tiles[i])
+         if image is None: # Skip a tile whose image is missing
+            continue
+         mosaic.paste(image, (int(round(x[i] - (self.frame_width / 2.))), int(round(y[i] - (self.frame_height / 2.)))))
+      return mosaic, lat, lon, zoom
+
+   def nearest_center(self, lat, lon):
+      ''' Return the number of the tile (any zoom) whose center is closest to lat, lon '''
+      if self.vectors is None: # Convert the tile centers into unit vectors
+         lats = np.radians(np.array(self.lats))
+         lons = np.radians(np.array(self.lons))
+         self.vectors = np.column_stack((np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)))
+      lat = math.radians(lat)
+      lon = math.radians(lon)
+      vector = np.array([math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)])
+      return int(np.argmax(np.dot(self.vectors, vector))) # Largest dot product is the smallest angle
+
+   def nearest(self, lat, lon, zoom):
+      ''' Return the number of the best tile to display for a map centered on lat, lon at this zoom:
+      a tile at this zoom which covers lat, lon; else a covering tile at the closest available zoom;
+      else the tile whose center is closest '''
+      if len(self.sources) == 0:
+         return None
+      zooms = sorted(self.grids.keys(), key=lambda z: (abs(z - zoom), -z)) # Closest zoom first (prefer more detail)
+      for z in zooms:
+         tiles = self.covering(lat, lon, z)
+         if len(tiles) > 0:
+            return tiles[0]
+      return self.nearest_center(lat, lon)
@@ -0,0 +1,98 @@
+# -*- coding: cp1252 -*-
+
+## Serial Line Reader
+
+## Reads the responses from an Iridium_9603N_Beacon_V5_Base for Iridium_Beacon_Base.py without blocking the GUI.
+## Works with both Python 2 and Python 3.
+
+## SerialLineReader reads the serial port on a background thread. The bytes are buffered until a
+## complete line has arrived (the Base ends every response with CR LF: Serial.println) so a response
+## is never truncated or split across reads, however long it is. Each complete line (including its
+## CR LF) is put on a queue. The GUI collects them using get_line() (e.g. using Tkinter's after()).
+## A line which gets longer than max_line without a LF isn't a response (e.g. noise): it is discarded up to the next LF.
+## The thread only reads the bytes which are already waiting, and reads and frames them while holding the lock,
+## so flush() (which clears the port's input buffer, the partial line and the queue under the same lock)
+## never races a read: bytes are either discarded by the flush or arrive after it.
+## Commands are written using write() so the GUI never waits for the port.
+
+import threading
+import time
+try:
+   import Queue as queue # Python 2
+except ImportError:
+   import queue # Python 3
+
+class SerialLineReader(object):
+   ''' Read CR LF terminated lines from a serial port on a background thread '''
+
+   def __init__(self, ser, max_line=1024, poll_interval=0.01):
+      self.ser = ser # pySerial Serial
+      self.max_line = max_line # A 'line' which gets this long without a LF is discarded
+      self.poll_interval = poll_interval # Check for new bytes this often (seconds)
+      self.lock = threading.Lock()
+      self.buffer = b'' # Bytes received since the last complete line
+      self.overflow = False # Discarding a line which was too long?
+      self.lines = queue.Queue() # Complete lines
+      self.running = True
+      self.thread = threading.Thread(target=self.run)
+      self.thread.daemon = True # Don't hold the program open
+      self.thread.start()
+
+   def write(self, data):
+      ''' Write data (a command) to the serial port '''
+      with self.lock:
+         self.ser.write(data)
+
+   def flush(self):
+      ''' Discard everything received so far (old responses) '''
+      with self.lock:
+         self.ser.flushInput() # Flush serial RX buffer
+         self.buffer = b''
+         self.overflow = False
+         while True:
+            try:
+               self.lines.get_nowait()
+            except queue.Empty:
+               break
+
+   def get_line(self):
+      ''' Return the oldest complete line (including its CR LF); or None if there isn't one '''
+      try:
+         return self.lines.get_nowait()
+      except queue.Empty:
+         return None
+
+   def close(self):
+      ''' Stop the thread. (The serial port is left open) '''
+      self.running = False
+      self.thread.join(1.)
+
+   def run(self):
+      ''' Background thread: read the port and frame the lines '''
+      while self.running:
+         with self.lock:
+            try:
+               waiting = self.ser.inWaiting()
+               data = b''
+               if waiting > 0:
+                  data = self.ser.read(waiting) # Only what is already waiting: doesn't block
+            except Exception: # e.g. the port has been closed
+               return
+            self.buffer += data
+            while True:
+               end = self.buffer.find(b'\n')
+               if end < 0:
+                  if len(self.buffer) >= self.max_line: # Too long: discard it up to the next LF
+                     self.buffer = b''
+                     self.overflow = True
+                  break
+               line = self.buffer[:end + 1]
+               self.buffer = self.buffer[end + 1:]
+               if self.overflow: # The end of a line which was too long
+                  self.overflow = False
+                  continue
+               if not line.endswith(b'\r\n'): # Make sure every line ends with CR LF
+                  line = line[:-1] + b'\r\n'
+               self.lines.put(line)
+         if len(data) == 0:
+            time.sleep(self.poll_interval) # Nothing waiting: check again soon
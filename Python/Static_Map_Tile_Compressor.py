@@ -0,0 +1,111 @@
+# -*- coding: cp1252 -*-
+
+## Static Map Tile Compressor
+
+## Makes the offline map tiles collected by Google_Static_Maps_Tiler.py (StaticMapTiles.sqlite) smaller.
+## The full-colour PNG tiles are re-encoded as:
+##   palette - PNG with up to 256 colours (lossless apart from the colour reduction)
+##   webp    - WebP at the chosen quality (smallest)
+##   jpeg    - JPEG at the chosen quality
+## Iridium_Beacon_Base.py decodes all of these directly (see Offline_Map_Tiles.py).
+## Works with both Python 2 and Python 3.
+
+## The tiles are re-encoded in parallel using one process per CPU core.
+## Tiles which are already compact (palette PNGs, WebP or JPEG) are left alone, as are tiles which
+## would get bigger. The size and decode time of the tiles before and after are reported.
+## The package is then vacuumed so the file itself shrinks.
+
+import io
+import os
+import time
+import multiprocessing
+from PIL import Image
+from Offline_Map_Tiles import StaticMapTilePackage, package_filename, recompress_tile, tile_formats
+
+try:
+   input = raw_input # Python 2
+except NameError:
+   pass
+
+batch_size = 64 # Read this many tiles from the package at a time (and commit the replaced tiles after each batch)
+
+def decode_time(data):
+   ''' Return how long (seconds) it takes to decode the tile image data the way the offline map does '''
+   start = time.time()
+   Image.open(io.BytesIO(data)).convert("RGBA")
+   return time.time() - start
+
+def compress(job):
+   ''' Worker process: recompress one tile.
+   Returns (tile id, new data (or None if the tile is left alone), old size, new size, old decode time, new decode time) '''
+   tile_id, data, tile_format, quality = job
+   old_time = decode_time(data)
+   image = Image.open(io.BytesIO(data))
+   if (image.format != 'PNG') or (image.mode == 'P'): # Already compact
+      return tile_id, None, len(data), len(data), old_time, old_time
+   compact = recompress_tile(data, tile_format, quality)
+   if len(compact) >= len(data): # No smaller
+      return tile_id, None, len(data), len(data), old_time, old_time
+   return tile_id, compact, len(data), len(compact), old_time, decode_time(compact)
+
+if __name__ == '__main__': # (Needed by multiprocessing on Windows)
+
+   if not os.path.isfile(package_filename):
+      raise ValueError('Could not find ' + package_filename + '! Use Google_Static_Maps_Tiler.py to create it')
+
+   # Ask the user for the format and quality
+   tile_format = input('Enter the tile format: palette, webp or jpeg (default palette): ')
+   if tile_format == '':
+      tile_format = 'palette'
+   if tile_format not in tile_formats: raise ValueError('Invalid value!')
+   quality = 80
+   if tile_format != 'palette':
+      try:
+         quality = input('Enter the quality 1-100 (default 80): ')
+         if quality == '':
+            quality = 80
+         quality = int(quality)
+      except:
+         raise ValueError('Invalid value!')
+      if (quality < 1) or (quality > 100): raise ValueError('Invalid value!')
+
+   package = StaticMapTilePackage(package_filename)
+   tile_ids = [tile_id for tile_id, zoom, lat, lon in package.tiles()]
+   file_size = os.path.getsize(package_filename)
+   print('Recompressing ' + str(len(tile_ids)) + ' tiles using ' + str(multiprocessing.cpu_count()) + ' processes')
+
+   start = time.time()
+   old_bytes = 0
+   new_bytes = 0
+   old_decode = 0.
+   new_decode = 0.
+   num_replaced = 0
+   pool = multiprocessing.Pool() # One process per CPU core
+   for first in range(0, len(tile_ids), batch_size):
+      # The package can only be read by this thread so the tiles are read here, a batch at a time
+      jobs = [(tile_id, package.get(tile_id), tile_format, quality) for tile_id in tile_ids[first:first + batch_size]]
+      for tile_id, compact, old_size, new_size, old_time, new_time in pool.imap_unordered(compress, jobs):
+         old_bytes += old_size
+         new_bytes += new_size
+         old_decode += old_time
+         new_decode += new_time
+         if compact is not None:
+            package.replace(tile_id, compact, commit=False)
+            num_replaced += 1
+      package.db.commit()
+      print('Processed ' + str(min(first + batch_size, len(tile_ids))) + ' tiles')
+   pool.close()
+   pool.join()
+   if num_replaced > 0:
+      package.set_metadata('format', tile_format) # (Any tiles added later by the Tiler or the Base are PNGs)
+
+   # Release the space freed by the smaller tiles
+   package.db.execute('VACUUM')
+   package.close()
+
+   print('Recompressed ' + str(num_replaced) + ' of ' + str(len(tile_ids)) + ' tiles in ' + ("%.1f"%(time.time() - start)) + ' seconds')
+   if len(tile_ids) > 0:
+      print('Tile data: ' + str(old_bytes) + ' bytes -> ' + str(new_bytes) + ' bytes (' + ("%.1f"%(100. * (old_bytes - new_bytes) / max(old_bytes, 1))) + '% smaller)')
+      print('Mean decode time: ' + ("%.2f"%(1000. * old_decode / len(tile_ids))) + ' ms -> ' + ("%.2f"%(1000. * new_decode / len(tile_ids))) + ' ms')
+   print(package_filename + ': ' + str(file_size) + ' bytes -> ' + str(os.path.getsize(package_filename)) + ' bytes')
+   print('Finished!')
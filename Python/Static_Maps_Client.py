@@ -0,0 +1,353 @@
+# -*- coding: cp1252 -*-
+
+## Static Maps Client
+
+## Downloads Google Static Maps images for Iridium_Beacon_Base.py and Iridium_Beacon_Mapper_RockBLOCK.py
+## without blocking the GUI.
+## Works with both Python 2 (Base) and Python 3 (Mapper).
+
+## MapFetcher downloads on a background thread. The GUI polls it for the result
+## (e.g. using Tkinter's after()). Only the most recent request matters: a newer request
+## replaces any request which is still waiting and the results of stale requests are discarded.
+
+## HTTPClient keeps the connections to the server open (HTTP/1.1 keep-alive) and reuses them,
+## so each map image doesn't need a new TCP connection and TLS handshake. Failed requests
+## are retried with exponential backoff. The latency and size of each request are recorded.
+## download() uses one HTTPClient shared by everything in the program.
+
+## RateLimiter spaces out requests made from several threads (e.g. by Google_Static_Maps_Tiler.py).
+
+## MapImageCache keeps recently used map images in memory and on disk so that zooming back out,
+## or returning to a beacon, redisplays the map instantly without using any API quota.
+## It is shared by the Base, the Mapper and Google_Static_Maps_Tiler.py.
+
+import threading
+import hashlib
+import os
+import time
+import socket
+from collections import OrderedDict, deque
+try:
+   import httplib # Python 2
+   from urlparse import urlsplit, parse_qsl
+   import Queue as queue
+except ImportError:
+   import http.client as httplib # Python 3
+   from urllib.parse import urlsplit, parse_qsl
+   import queue
+
+class HTTPStatusError(IOError):
+   ''' The server replied with an HTTP error status '''
+
+   def __init__(self, status, reason):
+      IOError.__init__(self, 'HTTP error ' + str(status) + ': ' + str(reason))
+      self.status = status
+      self.reason = reason
+
+class HTTPClient(object):
+   ''' Pooled, keep-alive HTTP(S) client with timeouts, retries and statistics. Safe to use from several threads '''
+
+   def __init__(self, timeout=30., retries=3, backoff=0.5, max_idle=4, history=1000):
+      self.timeout = timeout # Default timeout for each attempt (seconds)
+      self.retries = retries # Retry a failed request up to this many times
+      self.backoff = backoff # Wait this long (seconds) before the first retry; doubles for each retry after that
+      self.max_idle = max_idle # Keep up to this many idle connections open to each server
+      self.lock = threading.Lock()
+      self.idle = {} # (scheme, host, port) : [idle connections]
+      self.history = deque(maxlen=history) # (url, latency (seconds), bytes, attempts) of the most recent requests
+      self.requests = 0 # Statistics: number of successful requests
+      self.failures = 0 # Number of requests which failed (after all retries)
+      self.bytes = 0 # Total bytes downloaded
+      self.latency = 0. # Total latency of the successful requests (seconds)
+      self.connections = 0 # Number of connections opened
+
+   def connection(self, server, timeout):
+      ''' Return (connection, reused): an idle connection to server (scheme, host, port); or a new one '''
+      with self.lock:
+         idle = self.idle.get(server, [])
+         if len(idle) > 0:
+            connection = idle.pop()
+            connection.timeout = timeout
+            if connection.sock is not None:
+               connection.sock.settimeout(timeout)
+            return connection, True
+         self.connections += 1
+      scheme, host, port = server
+      if scheme == 'https':
+         return httplib.HTTPSConnection(host, port, timeout=timeout), False
+      return httplib.HTTPConnection(host, port, timeout=timeout), False
+
+   def release(self, server, connection):
+      ''' Return a connection to the pool so it can be reused '''
+      with self.lock:
+         idle = self.idle.setdefault(server, [])
+         if len(idle) < self.max_idle:
+            idle.append(connection)
+            return
+      connection.close()
+
+   def get(self, url, timeout=None):
+      ''' GET url and return the data (bytes). Raises HTTPStatusError or socket.error etc. if it fails '''
+      if timeout is None:
+         timeout = self.timeout
+      parts = urlsplit(url)
+      server = (parts.scheme, parts.hostname, parts.port)
+      path = parts.path or '/'
+      if parts.query != '':
+         path += '?' + parts.query
+      start = time.time()
+      attempt = 0
+      while True:
+         connection, reused = self.connection(server, timeout)
+         try:
+            connection.request('GET', path, headers={'Connection': 'keep-alive'})
+            response = connection.getresponse()
+            data = response.read()
+            if response.will_close:
+               connection.close()
+            else:
+               self.release(server, connection)
+            if response.status == 200:
+               break
+            error = HTTPStatusError(response.status, response.reason)
+            retry = (response.status >= 500) or (response.status == 429) # Server errors and rate limits are worth retrying
+         except (httplib.HTTPException, socket.error) as e: # (socket.timeout is a socket.error)
+            connection.close()
+            if reused and not isinstance(e, socket.timeout):
+               continue # The server probably closed the idle connection: try again straight away on another one
+            error = e
+            retry = True
+         if (not retry) or (attempt >= self.retries):
+            with self.lock:
+               self.failures += 1
+            raise error
+         time.sleep(self.backoff * (2 ** attempt)) # Exponential backoff
+         attempt += 1
+      latency = time.time() - start
+      with self.lock:
+         self.requests += 1
+         self.bytes += len(data)
+         self.latency += latency
+         self.history.append((url, latency, len(data), attempt + 1))
+      return data
+
+   def summary(self):
+      ''' Return the statistics as a string '''
+      with self.lock:
+         mean = 0.
+         if self.requests > 0:
+            mean = self.latency / self.requests
+         return (str(self.requests) + ' requests (' + str(self.failures) + ' failed); ' + str(self.bytes) + ' bytes; ' +
+                 ("%.1f"%(mean * 1000.)) + ' ms mean latency; ' + str(self.connections) + ' connections')
+
+class RateLimiter(object):
+   ''' Limit how often something (e.g. a download) can start. Safe to use from several threads '''
+
+   def __init__(self, rate):
+      self.rate = rate # Maximum starts per second (None or 0 for no limit)
+      self.lock = threading.Lock()
+      self.next = 0. # time.time() at which the next start is allowed
+
+   def wait(self):
+      ''' Wait until the next start is allowed '''
+      if not self.rate:
+         return
+      with self.lock:
+         now = time.time()
+         start = max(now, self.next)
+         self.next = start + (1. / self.rate)
+      if start > now:
+         time.sleep(start - now)
+
+http_client = HTTPClient() # Shared by everything which uses download()
+
+def download(url, timeout=30.):
+   ''' Download url and return the data (bytes). Raises an exception if the download fails '''
+   return http_client.get(url, timeout)
+
+def cache_key(url):
+   ''' Normalize a Static Maps URL into a cache key.
+   Uses the center, zoom, markers, paths, size, maptype and format - but not the API key '''
+   params = []
+   markers = []
+   paths = []
+   for name, value in parse_qsl(urlsplit(url).query, keep_blank_values=True):
+      if name == 'center': # Normalize the center to 6 decimal places
+         try:
+            lat, lon = value.split(',')
+            value = ("%.6f"%float(lat)) + ',' + ("%.6f"%float(lon))
+         except ValueError:
+            pass
+      if name == 'markers': # Marker order doesn't matter
+         markers.append(value)
+      elif name == 'path': # Path order does matter (later paths are drawn on top)
+         paths.append(value)
+      elif name != 'key': # The API key doesn't change the image
+         params.append((name, value))
+   params.sort()
+   params += [('markers', marker) for marker in sorted(markers)]
+   params += [('path', path) for path in paths]
+   return hashlib.sha1('&'.join([name + '=' + value for name, value in params]).encode('utf-8')).hexdigest()
+
+class MapImageCache(object):
+   ''' Two-level (memory and disk) least-recently-used cache of map images, limited by size in bytes.
+   Safe to use from several threads '''
+
+   def __init__(self, directory='Map_Image_Cache', memory_bytes=32000000, disk_bytes=256000000):
+      self.directory = directory # Directory for the disk cache (None to disable it)
+      self.memory_bytes = memory_bytes # Maximum size of the images held in memory
+      self.disk_bytes = disk_bytes # Maximum size of the images held on disk
+      self.lock = threading.Lock()
+      self.memory = OrderedDict() # key : image data. Least recently used first
+      self.memory_used = 0
+      self.disk = OrderedDict() # key : file size. Least recently used first
+      self.disk_used = 0
+      self.hits = 0 # Cache statistics
+      self.misses = 0
+      if self.directory is not None:
+         if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+         # Index any images left over from last time, oldest first
+         files = []
+         for filename in os.listdir(self.directory):
+            if filename[-4:] == '.img':
+               longfilename = os.path.join(self.directory, filename)
+               files.append((os.path.getmtime(longfilename), filename[:-4], os.path.getsize(longfilename)))
+         for mtime, key, size in sorted(files):
+            self.disk[key] = size
+            self.disk_used += size
+         self.evict()
+
+   def filename(self, key):
+      ''' Disk cache filename for this key '''
+      return os.path.join(self.directory, key + '.img')
+
+   def get(self, url):
+      ''' Return the cached image data for this URL; or None if it isn't in the cache '''
+      key = cache_key(url)
+      with self.lock:
+         if key in self.memory: # Memory hit?
+            data = self.memory.pop(key)
+            self.memory[key] = data # Move to the most recently used end
+            self.hits += 1
+            return data
+         if key in self.disk: # Disk hit?
+            try:
+               with open(self.filename(key), 'rb') as f:
+                  data = f.read()
+               os.utime(self.filename(key), None) # Mark as recently used (for next time the cache is opened)
+            except (IOError, OSError): # The file has gone missing
+               self.disk_used -= self.disk.pop(key)
+               self.misses += 1
+               return None
+            self.disk[key] = self.disk.pop(key) # Move to the most recently used end
+            self.add_to_memory(key, data)
+            self.hits += 1
+            return data
+         self.misses += 1
+         return None
+
+   def put(self, url, data):
+      ''' Add the image data for this URL to the cache '''
+      key = cache_key(url)
+      with self.lock:
+         self.add_to_memory(key, data)
+         if (self.directory is not None) and (key not in self.disk):
+            try:
+               with open(self.filename(key) + '.tmp', 'wb') as f: # Write to a temporary file first so a partial file is never used
+                  f.write(data)
+               os.rename(self.filename(key) + '.tmp', self.filename(key))
+               self.disk[key] = len(data)
+               self.disk_used += len(data)
+            except (IOError, OSError):
+               pass # Disk cache is best effort only
+         self.evict()
+
+   def add_to_memory(self, key, data):
+      ''' Add (or move) data to the most recently used end of the memory cache '''
+      if key in self.memory:
+         self.memory_used -= len(self.memory.pop(key))
+      self.memory[key] = data
+      self.memory_used += len(data)
+
+   def evict(self):
+      ''' Delete the least recently used images until the cache is within its size limits '''
+      while (self.memory_used > self.memory_bytes) and (len(self.memory) > 0):
+         key, data = self.memory.popitem(last=False)
+         self.memory_used -= len(data)
+      while (self.disk_used > self.disk_bytes) and (len(self.disk) > 0):
+         key, size = self.disk.popitem(last=False)
+         self.disk_used -= size
+         try:
+            os.remove(self.filename(key))
+         except OSError:
+            pass
+
+class MapFetcher(object):
+   ''' Download map images on a background thread. Downloaded images are added to cache (if there is one) '''
+
+   def __init__(self, cache=None, timeout=30.):
+      self.cache = cache # MapImageCache (or None)
+      self.timeout = timeout # Download timeout (seconds)
+      self.lock = threading.Lock()
+      self.wakeup = threading.Event() # Set when there is a request waiting
+      self.pending = None # (request_id, url) of the request waiting to be downloaded
+      self.latest = 0 # request_id of the most recent request
+      self.done = 0 # request_id of the most recent request which has completed (or been cancelled)
+      self.results = queue.Queue() # (request_id, data, error) of each completed download
+      self.thread = threading.Thread(target=self.run)
+      self.thread.daemon = True # Don't hold the program open
+      self.thread.start()
+
+   def request(self, url):
+      ''' Request a download. Replaces any request which hasn't started yet. Returns the request_id '''
+      with self.lock:
+         self.latest += 1
+         self.pending = (self.latest, url)
+         self.wakeup.set()
+         return self.latest
+
+   def cancel(self):
+      ''' Cancel any waiting request and make the result of any download in progress stale '''
+      with self.lock:
+         self.latest += 1
+         self.done = self.latest # Nothing to wait for
+         self.pending = None
+
+   def waiting(self):
+      ''' Return True if the most recent request hasn't completed yet '''
+      return self.done != self.latest
+
+   def poll(self):
+      ''' Return (data, error) if the most recent request has completed. Else return None.
+      data is None if the download failed. Stale results are discarded '''
+      result = None
+      while True:
+         try:
+            request_id, data, error = self.results.get_nowait()
+         except queue.Empty:
+            return result
+         if request_id == self.latest:
+            self.done = request_id
+            result = (data, error)
+
+   def run(self):
+      ''' Background thread: download each request in turn '''
+      while True:
+         self.wakeup.wait()
+         with self.lock:
+            pending = self.pending
+            self.pending = None
+            self.wakeup.clear()
+         if pending is None:
+            continue
+         request_id, url = pending
+         try:
+            data = download(url, self.timeout)
+            error = None
+            if self.cache is not None:
+               self.cache.put(url, data)
+         except Exception as e:
+            data = None
+            error = e
+         self.results.put((request_id, data, error))
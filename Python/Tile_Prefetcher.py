@@ -0,0 +1,149 @@
+# -*- coding: cp1252 -*-
+
+## Tile Prefetcher
+
+## Downloads offline map tiles (StaticMapTiles) for Iridium_Beacon_Base.py ahead of time,
+## along the track each beacon is expected to follow, so the offline map still covers the
+## beacon if the network connection is lost later.
+## Works with both Python 2 and Python 3.
+
+## plan_prefetch projects the beacon forward along its heading (a rhumb line: a straight line on
+## the Web Mercator map) for the distance it will travel at its current speed in lookahead seconds.
+## The tiles are laid out on a grid of map-sized cells in world pixels at each zoom (see Web_Mercator.py)
+## so neighbouring tiles abut and each cell is only ever downloaded once. The cells around the beacon
+## and the cells along its projected track are returned, nearest first, at the current zoom and
+## the zoom levels either side of it.
+
+## TilePrefetcher downloads the tiles on a low priority background thread: it waits while the
+## displayed map is downloading (busy) and leaves interval seconds between tiles. If a download
+## fails (e.g. the network connection has been lost) it pauses for retry_after seconds.
+## The tiles are added to the StaticMapTiles package (the same as Google_Static_Maps_Tiler.py; see
+## Offline_Map_Tiles.py) so they are found by the Base next time it starts.
+## Completed tiles are collected using completed().
+
+import math
+import threading
+import sqlite3
+import time
+from collections import deque
+import numpy as np
+from Static_Maps_Client import download
+from Offline_Map_Tiles import StaticMapTilePackage, package_filename
+from Web_Mercator import latlon_to_world, world_size, meters_per_pixel, grid_centers, min_zoom, max_zoom
+try:
+   import Queue as queue # Python 2
+except ImportError:
+   import queue # Python 3
+
+def plan_prefetch(lat, lon, speed, heading, zoom, width=640, height=480, lookahead=1800., zoom_range=1, max_steps=16):
+   ''' Return the centers (lat, lon, zoom) of the width x height pixel tiles around lat, lon (degrees) and along
+   the track it will follow in lookahead seconds at speed (m/s) and heading (degrees), nearest first.
+   Tiles are planned for zoom and zoom_range zoom levels either side of it '''
+   distance = max(float(speed), 0.) * lookahead # Distance travelled (m)
+   zooms = sorted(range(max(zoom - zoom_range, min_zoom), min(zoom + zoom_range, max_zoom) + 1), key=lambda z: (abs(z - zoom), -z))
+   tiles = []
+   for z in zooms:
+      x, y = latlon_to_world(lat, lon, z)
+      x = float(x)
+      y = float(y)
+      # Meters per world pixel at this latitude. Headings are preserved by the projection
+      meters = float(meters_per_pixel(lat, z))
+      dx = distance * math.sin(math.radians(heading)) / meters
+      dy = -distance * math.cos(math.radians(heading)) / meters # y increases South
+      # Sample the track every half a tile (at most max_steps samples)
+      steps = int(min(math.ceil(math.hypot(dx, dy) / (min(width, height) / 2.)), max_steps))
+      t = np.linspace(0., 1., steps + 1)
+      xs = x + (t * dx)
+      ys = y + (t * dy)
+      rows = np.floor(ys / height).astype(int)
+      cols = np.floor(xs / width).astype(int)
+      cells = []
+      if z == zoom: # Include the cells all around the beacon at the current zoom
+         cells = [(rows[0] + r, cols[0] + c) for r in (0, -1, 1) for c in (0, -1, 1)]
+      cells += list(zip(rows, cols))
+      max_row = int(math.ceil(world_size(z) / height)) - 1 # Cells beyond the top or bottom of the world are not needed
+      seen = set()
+      for row, col in cells:
+         if (row, col) in seen or row < 0 or row > max_row:
+            continue
+         seen.add((row, col))
+         center_lat, center_lon = grid_centers(row, col, z, width, height)
+         tiles.append((round(float(center_lat), 6), round(float(center_lon), 6), z))
+   return tiles
+
+class TilePrefetcher(object):
+   ''' Download offline map tiles on a low priority background thread '''
+
+   def __init__(self, filename=package_filename, cache=None, busy=None, interval=2., retry_after=60., max_pending=64, timeout=30.):
+      self.filename = filename # Add the tiles to this StaticMapTiles package
+      self.cache = cache # MapImageCache (or None)
+      self.busy = busy # Function which returns True while a more important download is waiting (or None)
+      self.interval = interval # Wait this long (seconds) between tiles
+      self.retry_after = retry_after # Wait this long (seconds) after a failed download
+      self.timeout = timeout # Download timeout (seconds)
+      self.lock = threading.Lock()
+      self.wakeup = threading.Event() # Set when there are tiles waiting
+      self.pending = deque(maxlen=max_pending) # (url, lat, lon, zoom) of the tiles waiting. Most important last; oldest are dropped
+      self.fetched = set() # (lat, lon, zoom) of the tiles which have been downloaded
+      self.results = queue.Queue() # (tile id, lat, lon, zoom) of each completed tile
+      self.downloads = 0 # Statistics: number of tiles downloaded
+      self.failures = 0 # Number of failed downloads
+      self.thread = threading.Thread(target=self.run)
+      self.thread.daemon = True # Don't hold the program open
+      self.thread.start()
+
+   def request(self, tiles):
+      ''' Queue tiles [(url, lat, lon, zoom)] (most important first) for download ahead of any queued earlier '''
+      with self.lock:
+         waiting = set([(lat, lon, zoom) for url, lat, lon, zoom in self.pending])
+         for url, lat, lon, zoom in reversed(tiles):
+            if ((lat, lon, zoom) not in self.fetched) and ((lat, lon, zoom) not in waiting):
+               self.pending.append((url, lat, lon, zoom))
+         if len(self.pending) > 0:
+            self.wakeup.set()
+
+   def completed(self):
+      ''' Return [(tile id, lat, lon, zoom)] of the tiles which have been added to the package since the last call '''
+      tiles = []
+      while True:
+         try:
+            tiles.append(self.results.get_nowait())
+         except queue.Empty:
+            return tiles
+
+   def run(self):
+      ''' Background thread: download the waiting tiles, one every interval seconds '''
+      package = StaticMapTilePackage(self.filename) # SQLite connections can only be used by the thread which opened them
+      while True:
+         self.wakeup.wait()
+         if (self.busy is not None) and self.busy(): # Let the displayed map download first
+            time.sleep(self.interval)
+            continue
+         with self.lock:
+            if len(self.pending) == 0:
+               self.wakeup.clear()
+               continue
+            url, lat, lon, zoom = self.pending.pop()
+         data = None
+         if self.cache is not None:
+            data = self.cache.get(url) # Check the cache first
+         if data is None:
+            try:
+               data = download(url, self.timeout)
+            except Exception:
+               self.failures += 1
+               with self.lock:
+                  self.pending.append((url, lat, lon, zoom)) # Try again later
+               time.sleep(self.retry_after) # The network connection may have been lost
+               continue
+            if self.cache is not None:
+               self.cache.put(url, data)
+         try:
+            tile_id = package.add(zoom, lat, lon, data)
+         except sqlite3.Error: # e.g. the package is locked
+            continue
+         with self.lock:
+            self.fetched.add((lat, lon, zoom))
+         self.downloads += 1
+         self.results.put((tile_id, lat, lon, zoom))
+         time.sleep(self.interval)
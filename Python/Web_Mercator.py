@@ -0,0 +1,106 @@
+# -*- coding: cp1252 -*-
+
+## Web Mercator
+
+## The Web Mercator projection used by Google Static Maps, shared by Iridium_Beacon_Base.py,
+## Iridium_Beacon_Mapper_RockBLOCK.py, Offline_Map_Tiles.py and Google_Static_Maps_Tiler.py.
+## Works with both Python 2 and Python 3.
+
+## https://developers.google.com/maps/documentation/javascript/coordinates
+## The whole world is 256 x 256 'world' pixels at zoom level 0. Each zoom level doubles this.
+## Zoom level 1 is 0.703125 degrees of longitude per pixel; zoom level 21 is 6.70552254e-7.
+## All of the functions accept NumPy arrays (or lists) as well as single values.
+
+## grid_cells and grid_centers lay map tiles out on a grid aligned with the world pixels at each zoom,
+## so the tiles abut exactly (used by Google_Static_Maps_Tiler.py and Tile_Prefetcher.py).
+
+import math
+import numpy as np
+
+tile_size = 256. # Size of the world in pixels at zoom level 0
+max_latitude = 85.0511287798 # The projection is square: latitudes beyond this are not shown
+earth_circumference = 40075016.686 # Equatorial circumference of the earth (m) (Web Mercator sphere)
+min_zoom = 0 # Zoom limits for Google Static Maps
+max_zoom = 21
+
+def world_size(zoom):
+   ''' Size of the world in pixels at this zoom level '''
+   return tile_size * (2 ** zoom)
+
+def meters_per_pixel(lats, zoom):
+   ''' Ground distance (m) covered by one world pixel at lats (degrees) at this zoom level '''
+   return earth_circumference * np.cos(np.radians(np.asarray(lats, dtype=float))) / world_size(zoom)
+
+def latlon_to_world(lats, lons, zoom):
+   ''' Convert lats, lons (degrees) into world pixel x, y at this zoom. x increases East; y increases South '''
+   lats = np.clip(np.asarray(lats, dtype=float), -max_latitude, max_latitude)
+   lons = np.asarray(lons, dtype=float)
+   size = world_size(zoom)
+   x = ((lons + 180.) / 360.) * size
+   y = (0.5 - (np.log(np.tan((math.pi / 4.) + (np.radians(lats) / 2.))) / (2. * math.pi))) * size
+   return x, y
+
+def world_to_latlon(x, y, zoom):
+   ''' Convert world pixel x, y at this zoom into lats, lons (degrees) '''
+   size = world_size(zoom)
+   lons = ((np.asarray(x, dtype=float) / size) * 360.) - 180.
+   lons = ((lons + 180.) % 360.) - 180. # Wrap into -180 to +180
+   lats = np.degrees((2. * np.arctan(np.exp((0.5 - (np.asarray(y, dtype=float) / size)) * 2. * math.pi))) - (math.pi / 2.))
+   return lats, lons
+
+def latlon_to_pixels(lats, lons, center_lat, center_lon, zoom, width, height):
+   ''' Convert lats, lons (degrees) into pixel x, y on a width x height map centered on center_lat, center_lon '''
+   x, y = latlon_to_world(lats, lons, zoom)
+   center_x, center_y = latlon_to_world(center_lat, center_lon, zoom)
+   size = world_size(zoom)
+   dx = ((x - center_x + (size / 2.)) % size) - (size / 2.) # Take the shortest way around the world
+   return (width / 2.) + dx, (height / 2.) + (y - center_y)
+
+def pixels_to_latlon(x, y, center_lat, center_lon, zoom, width, height):
+   ''' Convert pixel x, y on a width x height map centered on center_lat, center_lon into lats, lons (degrees) '''
+   center_x, center_y = latlon_to_world(center_lat, center_lon, zoom)
+   return world_to_latlon(center_x + np.asarray(x, dtype=float) - (width / 2.), center_y + np.asarray(y, dtype=float) - (height / 2.), zoom)
+
+def grid_cells(lats, lons, zoom, width, height):
+   ''' Return the rows, cols of the cells containing lats, lons (degrees) in the grid of width x height pixel
+   map tiles at this zoom. The grid starts at world pixel 0, 0 so neighbouring tiles abut exactly '''
+   x, y = latlon_to_world(lats, lons, zoom)
+   return np.floor(y / height).astype(int), np.floor(x / width).astype(int)
+
+def grid_centers(rows, cols, zoom, width, height):
+   ''' Return the lats, lons (degrees) of the centers of the width x height pixel grid cells rows, cols at this zoom '''
+   return world_to_latlon((np.asarray(cols, dtype=float) + 0.5) * width, (np.asarray(rows, dtype=float) + 0.5) * height, zoom)
+
+def world_bounds(lats, lons):
+   ''' Return the bounding box (min_x, max_x, min_y, max_y) of lats, lons (degrees) in world pixels at zoom level 0.
+   x is measured the shortest way around the world from the first point so min_x can be < 0 or max_x > tile_size '''
+   x, y = latlon_to_world(lats, lons, 0)
+   x = np.atleast_1d(x)
+   y = np.atleast_1d(y)
+   dx = ((x - x[0] + (tile_size / 2.)) % tile_size) - (tile_size / 2.) # Take the shortest way around the world
+   return x[0] + dx.min(), x[0] + dx.max(), y.min(), y.max()
+
+def bounds_zoom(bounds, width, height):
+   ''' Return the highest zoom level at which bounds (from world_bounds) fit into width x height pixels '''
+   min_x, max_x, min_y, max_y = bounds
+   span_x = max_x - min_x # Extent in pixels at zoom level 0
+   span_y = max_y - min_y
+   scale = float('inf') # How much the extent can be magnified
+   if span_x > 0.:
+      scale = min(scale, width / span_x)
+   if span_y > 0.:
+      scale = min(scale, height / span_y)
+   if scale == float('inf'): # All the points are in the same place
+      return max_zoom
+   return int(min(max(math.floor(math.log(scale, 2)), min_zoom), max_zoom)) # Each zoom level doubles the magnification
+
+def fit_zoom(lats, lons, width, height):
+   ''' Return the highest zoom level at which lats, lons (degrees) all fit into width x height pixels '''
+   return bounds_zoom(world_bounds(lats, lons), width, height)
+
+def fit_bounds(lats, lons, width, height):
+   ''' Return the center (lat, lon degrees) and the highest zoom level of the width x height pixel map which shows all of lats, lons '''
+   bounds = world_bounds(lats, lons)
+   min_x, max_x, min_y, max_y = bounds
+   lat, lon = world_to_latlon((min_x + max_x) / 2., (min_y + max_y) / 2., 0) # Center of the bounding box
+   return float(lat), float(lon), bounds_zoom(bounds, width, height)
@@ -0,0 +1,82 @@
+# -*- coding: cp1252 -*-
+
+## Tests for Beacon_Base_Client.py, using a fed asyncio StreamReader and a stub writer as a stand-in for the Iridium_9603N_Beacon_V5_Base.
+## Run with: python3 -m pytest test_Beacon_Base_Client.py (or python3 -m unittest test_Beacon_Base_Client)
+## Python 3 only.
+
+import asyncio
+import unittest
+from Beacon_Base_Client import BeaconBaseClient, BeaconBaseError, BeaconBaseTimeout, GNSSFix
+
+class StubWriter(object):
+   ''' The parts of asyncio StreamWriter used by BeaconBaseClient. replies maps a command to the bytes the base sends back '''
+
+   def __init__(self, reader, replies=None):
+      self.reader = reader
+      self.replies = replies or {}
+      self.transport = None # Not a serial port
+      self.written = []
+
+   def write(self, data):
+      self.written.append(data)
+      if data in self.replies:
+         self.reader.feed_data(self.replies[data]) # The base replies straight away
+
+   async def drain(self):
+      pass
+
+   def close(self):
+      pass
+
+class BeaconBaseClientTest(unittest.TestCase):
+
+   def run_client(self, replies, coroutine, received=b'', timeouts=None):
+      ''' Feed received, then call coroutine(client) with the base sending replies; return its result '''
+      async def main():
+         reader = asyncio.StreamReader()
+         reader.feed_data(received)
+         client = BeaconBaseClient(reader, StubWriter(reader, replies), timeouts)
+         try:
+            return await coroutine(client)
+         finally:
+            await client.close()
+      return asyncio.run(main())
+
+   def test_gnss_fix(self):
+      fix = self.run_client({b'2\r': b'20260601120000,55.123456,-3.200000,120,1.5,270,0.9,11\r\n'},
+                            lambda client: client.gnss())
+      self.assertEqual(fix, GNSSFix('20260601120000', 55.123456, -3.2, 120, 1.5, 270, 0.9, 11))
+
+   def test_rockblock_record_and_mtq(self):
+      session = self.run_client({b'4\r': b'RB0012345,20260601120000,55.123456,-3.200000,1200,5.5,90,1.2,9,95000,12.5,3.9,7,RB0054321,2\r\n'},
+                                lambda client: client.check_iridium())
+      self.assertEqual(session.mtq, 2)
+      self.assertEqual(session.record.base_serial_no, 'RB0012345')
+      self.assertEqual(session.record.serial_no, 'RB0054321')
+      self.assertEqual(session.record.altitude, 1200)
+      self.assertEqual(session.record.count, 7)
+
+   def test_error_code(self):
+      with self.assertRaises(BeaconBaseError) as context:
+         self.run_client({b'4\r': b'ERROR: sendReceiveSBDText failed with error 13\r\n'},
+                         lambda client: client.check_iridium())
+      self.assertEqual(context.exception.code, 13)
+
+   def test_timeout(self):
+      with self.assertRaises(BeaconBaseTimeout):
+         self.run_client({}, lambda client: client.battery(), timeouts={'1': 0.05})
+
+   def test_stale_banner_is_discarded(self):
+      banner = b'Iridium 9603N Beacon V5 Base\r\n1) Battery voltage\r\n2) GNSS\r\nChoice: 4.05\r\nparti'
+      battery = self.run_client({b'1\r': b'4.10\r\n'}, lambda client: client.battery(), received=banner)
+      self.assertEqual(battery.volts, 4.10)
+
+   def test_commands_in_turn(self):
+      async def both(client):
+         return await client.battery(), await client.pressure_temperature()
+      battery, pt = self.run_client({b'1\r': b'4.10\r\n', b'3\r': b'101325,21.5\r\n'}, both)
+      self.assertEqual(battery.volts, 4.10)
+      self.assertEqual(pt.pascals, 101325)
+
+if __name__ == '__main__':
+   unittest.main()
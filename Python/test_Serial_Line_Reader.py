@@ -0,0 +1,99 @@
+# -*- coding: cp1252 -*-
+
+## Tests for Serial_Line_Reader.py, using a fake serial port as a stand-in for the Iridium_9603N_Beacon_V5_Base.
+## Run with: python -m pytest test_Serial_Line_Reader.py (or python -m unittest test_Serial_Line_Reader)
+## Works with both Python 2 and Python 3.
+
+import threading
+import time
+import unittest
+from Serial_Line_Reader import SerialLineReader
+
+class FakeSerial(object):
+   ''' The parts of pySerial Serial used by SerialLineReader. replies maps a command to the bytes the base sends back '''
+
+   def __init__(self, replies=None):
+      self.replies = replies or {}
+      self.lock = threading.Lock()
+      self.incoming = b'' # Bytes waiting to be read
+      self.written = []
+
+   def receive(self, data):
+      ''' The base sends data '''
+      with self.lock:
+         self.incoming += data
+
+   def inWaiting(self):
+      with self.lock:
+         return len(self.incoming)
+
+   def read(self, size=1):
+      with self.lock:
+         data = self.incoming[:size]
+         self.incoming = self.incoming[size:]
+         return data
+
+   def write(self, data):
+      self.written.append(data)
+      if data in self.replies:
+         self.receive(self.replies[data]) # The base replies straight away
+
+   def flushInput(self):
+      with self.lock:
+         self.incoming = b''
+
+class SerialLineReaderTest(unittest.TestCase):
+
+   def setUp(self):
+      self.ser = FakeSerial({b'9\r': b'ERROR: invalid menu choice\r\n'})
+      self.reader = SerialLineReader(self.ser, max_line=64)
+
+   def tearDown(self):
+      self.reader.close()
+
+   def wait_line(self, timeout=2.):
+      ''' Return the next line from the reader; or None if there isn't one within timeout seconds '''
+      end = time.time() + timeout
+      while time.time() < end:
+         line = self.reader.get_line()
+         if line is not None:
+            return line
+         time.sleep(0.005)
+      return None
+
+   def test_lines_split_across_reads_arrive_whole(self):
+      self.ser.receive(b'20260601120000,55.1')
+      time.sleep(0.05)
+      self.assertEqual(self.reader.get_line(), None) # Not complete yet
+      self.ser.receive(b'23456,-3.2,120,1.5,270,0.9,11\r\n3\r')
+      self.assertEqual(self.wait_line(), b'20260601120000,55.123456,-3.2,120,1.5,270,0.9,11\r\n')
+      self.ser.receive(b'\n')
+      self.assertEqual(self.wait_line(), b'3\r\n')
+
+   def test_bare_lf_is_made_cr_lf(self):
+      self.ser.receive(b'0\n')
+      self.assertEqual(self.wait_line(), b'0\r\n')
+
+   def test_overlong_line_is_discarded(self):
+      self.ser.receive(b'x' * 100)
+      time.sleep(0.05)
+      self.ser.receive(b'yy\r\n1\r\n')
+      self.assertEqual(self.wait_line(), b'1\r\n')
+      self.assertEqual(self.reader.get_line(), None)
+
+   def test_flush_discards_old_responses(self):
+      self.ser.receive(b'old reply\r\npartial')
+      time.sleep(0.05)
+      self.reader.flush()
+      self.ser.receive(b'new reply\r\n')
+      self.assertEqual(self.wait_line(), b'new reply\r\n')
+
+   def test_reply_straight_after_flush_arrives_whole(self):
+      for n in range(50):
+         self.ser.receive(b'stale')
+         self.reader.flush()
+         self.reader.write(b'9\r')
+         self.assertEqual(self.wait_line(), b'ERROR: invalid menu choice\r\n')
+
+if __name__ == '__main__':
+   unittest.main()
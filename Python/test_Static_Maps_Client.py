@@ -0,0 +1,108 @@
+# -*- coding: cp1252 -*-
+
+## Tests for the HTTPClient in Static_Maps_Client.py, using a local HTTP server as a stand-in for Google Static Maps.
+## Run with: python -m pytest test_Static_Maps_Client.py (or python -m unittest test_Static_Maps_Client)
+## Works with both Python 2 and Python 3.
+
+import threading
+import unittest
+try:
+   from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler # Python 2
+   from SocketServer import ThreadingMixIn
+except ImportError:
+   from http.server import HTTPServer, BaseHTTPRequestHandler # Python 3
+   from socketserver import ThreadingMixIn
+from Static_Maps_Client import HTTPClient, HTTPStatusError
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+   daemon_threads = True
+
+class StandInHandler(BaseHTTPRequestHandler):
+   ''' /ok returns an image; /flaky returns 503 the first failures times; /missing returns 404 '''
+   protocol_version = 'HTTP/1.1' # Keep-alive
+   body = b'\x89PNG tile data'
+
+   def do_GET(self):
+      server = self.server
+      with server.lock:
+         server.requests.append(self.path)
+         flaky = server.failures > 0
+         if self.path == '/flaky' and flaky:
+            server.failures -= 1
+      if self.path == '/ok' or (self.path == '/flaky' and not flaky):
+         self.reply(200, self.body)
+      elif self.path == '/flaky':
+         self.reply(503, b'Unavailable')
+      else:
+         self.reply(404, b'Not found')
+
+   def reply(self, status, body):
+      self.send_response(status)
+      self.send_header('Content-Type', 'image/png')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, *args):
+      pass # Keep the test output quiet
+
+class HTTPClientTest(unittest.TestCase):
+
+   def setUp(self):
+      self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+      self.server.lock = threading.Lock()
+      self.server.requests = []
+      self.server.failures = 0
+      self.thread = threading.Thread(target=self.server.serve_forever)
+      self.thread.daemon = True
+      self.thread.start()
+      self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+      self.client = HTTPClient(timeout=5., retries=3, backoff=0.01)
+
+   def tearDown(self):
+      for connections in self.client.idle.values(): # Close the kept-alive connections so the handler threads finish
+         for connection in connections:
+            connection.close()
+      self.server.shutdown()
+      self.server.server_close()
+
+   def test_keep_alive_reuses_connection(self):
+      for n in range(5):
+         self.assertEqual(self.client.get(self.url + '/ok'), StandInHandler.body)
+      self.assertEqual(self.client.connections, 1)
+      self.assertEqual(self.client.requests, 5)
+
+   def test_retries_server_errors(self):
+      self.server.failures = 2
+      self.assertEqual(self.client.get(self.url + '/flaky'), StandInHandler.body)
+      self.assertEqual(len(self.server.requests), 3)
+      self.assertEqual(self.client.history[-1][3], 3) # Attempts
+
+   def test_gives_up_after_retries(self):
+      self.server.failures = 10
+      with self.assertRaises(HTTPStatusError) as context:
+         self.client.get(self.url + '/flaky')
+      self.assertEqual(context.exception.status, 503)
+      self.assertEqual(len(self.server.requests), 4) # The first attempt and 3 retries
+      self.assertEqual(self.client.failures, 1)
+
+   def test_does_not_retry_client_errors(self):
+      with self.assertRaises(HTTPStatusError) as context:
+         self.client.get(self.url + '/missing')
+      self.assertEqual(context.exception.status, 404)
+      self.assertEqual(len(self.server.requests), 1)
+      self.assertEqual(self.client.failures, 1)
+
+   def test_summary(self):
+      self.client.get(self.url + '/ok')
+      self.client.get(self.url + '/ok')
+      try:
+         self.client.get(self.url + '/missing')
+      except HTTPStatusError:
+         pass
+      summary = self.client.summary()
+      self.assertTrue(summary.startswith('2 requests (1 failed); ' + str(2 * len(StandInHandler.body)) + ' bytes; '))
+      self.assertTrue(summary.endswith(' 1 connections'))
+
+if __name__ == '__main__':
+   unittest.main()